@@ -1,29 +1,46 @@
 # app/main.py 完整版本（关联学生学号）
-from fastapi import FastAPI, Depends, Body, UploadFile, File, HTTPException
+from fastapi import FastAPI, Depends, Body, UploadFile, File, HTTPException, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, Session
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from sqlalchemy import create_engine, text, event, select, update, func, tuple_, or_, and_, bindparam
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from io import BytesIO
+from email.utils import formatdate, parsedate_to_datetime
 import jwt
 import bcrypt
 import json
+import base64
+import hashlib
+import asyncio
 import os
+import shutil
+import time
+import threading
 import uuid
+import secrets
+from collections import OrderedDict
+import re
+import math
 import mimetypes
+import numpy as np
 import zipfile
 import requests
 import dashscope
 from dashscope import MultiModalConversation
 from typing import List, Optional
 from openpyxl import load_workbook
+from PIL import Image, ImageOps
 from fastapi.security import OAuth2PasswordBearer  # 关键：导入OAuth2PasswordBearer
 from xml.etree import ElementTree as ET
+from dotenv import load_dotenv
 
 # ========== 数据库模型导入 & 配置 ==========
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Float
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Float, UniqueConstraint
 from urllib import request as urllib_request
 from urllib import error as urllib_error
 
@@ -83,6 +100,9 @@ class StudentAchievement(Base):
     audit_time = Column(DateTime, nullable=True, comment="审核时间")
     overall_score = Column(Float, nullable=True, comment="总分")
     review_completed = Column(Boolean, default=False, comment="是否完成逐项审核")
+    version = Column(Integer, default=1, comment="数据版本号（每次审核/反馈/重算递增，用于ETag）")
+    lifecycle_status = Column(String(20), nullable=True, default="已提交", comment="流转状态：已提交/已审核/待复核/已复核")
+    formula_version = Column(Integer, nullable=True, comment="overall_score 计算时使用的公式版本")
 
 # 3. 论文表
 class Paper(Base):
@@ -202,10 +222,22 @@ class AchievementDocument(Base):
     mime_type = Column(String(100), nullable=True, comment="MIME类型")
     create_time = Column(DateTime, default=datetime.now, comment="上传时间")
 
+class UploadBlob(Base):
+    __tablename__ = "upload_blob"
+    id = Column(Integer, primary_key=True, index=True)
+    sha256 = Column(String(64), nullable=False, unique=True, comment="文件内容SHA-256")
+    file_path = Column(String(500), nullable=False, unique=True, comment="存储文件名（内容哈希+后缀）")
+    file_size = Column(Integer, nullable=False, default=0, comment="文件大小（字节）")
+    mime_type = Column(String(100), nullable=True, comment="MIME类型")
+    ref_count = Column(Integer, nullable=False, default=0, comment="引用该文件的成果附件数（提交时累加，回收任务按附件表校正）")
+    create_time = Column(DateTime, default=datetime.now, comment="首次上传时间")
+    last_seen_time = Column(DateTime, nullable=True, comment="最近一次去重命中/秒传确认时间（回收保留期从这里起算）")
+
 class ScoreFormula(Base):
     __tablename__ = "score_formula"
     id = Column(Integer, primary_key=True, index=True)
     weights_json = Column(Text, nullable=False, comment="权重配置JSON")
+    version = Column(Integer, default=1, comment="公式版本号（权重变化时递增）")
     update_time = Column(DateTime, default=datetime.now, comment="更新时间")
 
 class AchievementType(Base):
@@ -213,6 +245,8 @@ class AchievementType(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), nullable=False, unique=True, comment="成果类型名称")
     fields_json = Column(Text, nullable=False, comment="字段定义JSON")
+    rules_json = Column(Text, nullable=True, comment="预评分规则JSON")
+    rules_version = Column(Integer, default=1, comment="预评分规则版本号")
     is_active = Column(Boolean, default=True, comment="是否启用")
     create_time = Column(DateTime, default=datetime.now, comment="创建时间")
     update_time = Column(DateTime, default=datetime.now, comment="更新时间")
@@ -233,10 +267,92 @@ class CustomAchievement(Base):
     student_feedback_comment = Column(String(500), nullable=True, comment="学生反馈")
     feedback_time = Column(DateTime, nullable=True, comment="反馈时间")
     rescore_comment = Column(String(500), nullable=True, comment="复核说明")
+    suggested_score = Column(Float, nullable=True, comment="规则预评分（供审核参考）")
+    suggested_rules_version = Column(Integer, nullable=True, comment="预评分使用的规则版本")
+
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_record"
+    request_key = Column(String(64), primary_key=True, comment="作用域+幂等键的SHA-256")
+    response_json = Column(Text, nullable=False, comment="首次请求的响应JSON")
+    expire_time = Column(DateTime, nullable=False, index=True, comment="过期时间")
+
+class StudentRefreshToken(Base):
+    __tablename__ = "student_refresh_token"
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(String(64), nullable=False, unique=True, comment="刷新令牌的SHA-256")
+    student_id = Column(String(20), nullable=False, index=True, comment="学号")
+    family_id = Column(String(32), nullable=False, index=True, comment="令牌族（同一次登录轮换出的令牌）")
+    expire_time = Column(DateTime, nullable=False, comment="过期时间")
+    create_time = Column(DateTime, default=datetime.now, comment="签发时间")
+    revoked_time = Column(DateTime, nullable=True, comment="作废时间（轮换或吊销）")
+
+class AuthEpoch(Base):
+    __tablename__ = "auth_epoch"
+    id = Column(Integer, primary_key=True)
+    epoch = Column(Integer, nullable=False, default=0, comment="学生认证信息变更计数（多进程缓存一致性）")
+
+class DataMigration(Base):
+    __tablename__ = "data_migration"
+    name = Column(String(100), primary_key=True, comment="一次性数据迁移名称")
+    finish_time = Column(DateTime, default=datetime.now, comment="完成时间")
+
+class AchievementScoreAggregate(Base):
+    __tablename__ = "achievement_score_aggregate"
+    __table_args__ = (UniqueConstraint("achievement_id", "item_type", "type_id", name="uq_score_aggregate_item_type"),)
+    id = Column(Integer, primary_key=True)
+    achievement_id = Column(Integer, ForeignKey("student_achievements.id"), nullable=False, comment="关联成果主表ID")
+    item_type = Column(String(20), nullable=False, comment="成果项类型：paper/policy/academic/volunteer/award/custom")
+    type_id = Column(Integer, nullable=False, default=0, comment="自定义成果类型ID（内置类型为0）")
+    item_count = Column(Integer, default=0, comment="成果项数")
+    scored_count = Column(Integer, default=0, comment="有有效分数的项数")
+    reviewed_count = Column(Integer, default=0, comment="审核状态为已审核/已复核/已同意的项数")
+    completed_count = Column(Integer, default=0, comment="满足审核完成条件的项数")
+    touched_count = Column(Integer, default=0, comment="已评分或已进入审核流程的项数")
+    disagree_count = Column(Integer, default=0, comment="学生不同意的项数")
+    disagree_rescored_count = Column(Integer, default=0, comment="不同意且已复核说明的项数")
+    score_sum = Column(Float, default=0.0, comment="有效分数之和")
+
+class WhitelistImportRow(Base):
+    __tablename__ = "whitelist_import_row"
+    job_id = Column(Integer, primary_key=True, comment="所属导入任务ID")
+    row_index = Column(Integer, primary_key=True, comment="表格行号")
+    row_json = Column(Text, nullable=False, comment="学号/姓名/默认密码/是否启用四列的值JSON")
+
+class BackgroundJob(Base):
+    __tablename__ = "background_job"
+    id = Column(Integer, primary_key=True, index=True)
+    job_type = Column(String(50), nullable=False, comment="任务类型")
+    status = Column(String(20), nullable=False, default="pending", index=True, comment="状态：pending/running/completed/failed/cancelled")
+    payload_json = Column(Text, nullable=True, comment="任务参数JSON")
+    total = Column(Integer, nullable=True, comment="待处理总数")
+    processed = Column(Integer, default=0, comment="已处理数")
+    cursor = Column(Integer, default=0, comment="断点（已处理的最大主键）")
+    cancel_requested = Column(Boolean, default=False, comment="是否请求取消")
+    locked_by = Column(String(64), nullable=True, comment="持有任务的工作进程")
+    heartbeat_time = Column(DateTime, nullable=True, comment="最近心跳时间")
+    error_message = Column(String(500), nullable=True, comment="失败原因")
+    result_json = Column(Text, nullable=True, comment="任务结果JSON")
+    create_time = Column(DateTime, default=datetime.now, comment="创建时间")
+    start_time = Column(DateTime, nullable=True, comment="开始时间")
+    finish_time = Column(DateTime, nullable=True, comment="结束时间")
 
 # ========== FastAPI 初始化 ==========
 app = FastAPI(title="学生成果管理系统", version="1.0")
 
+# 上传大小预检（上限等配置见“图片上传配置”）：必须先于跨域中间件注册，
+# 后注册的中间件在外层，这样 413 响应也会带上跨域头，前端能拿到提示信息
+@app.middleware("http")
+async def reject_oversized_upload(request: Request, call_next):
+    # 按 Content-Length 提前拒绝，不等请求体解析
+    if request.method == "POST" and request.url.path in UPLOAD_PATHS:
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_FILE_SIZE + UPLOAD_MULTIPART_OVERHEAD:
+            return JSONResponse(
+                status_code=413,
+                content={"success": False, "message": f"文件大小不能超过{MAX_FILE_SIZE // (1024 * 1024)}MB"}
+            )
+    return await call_next(request)
+
 # 跨域配置
 app.add_middleware(
     CORSMiddleware,
@@ -247,16 +363,97 @@ app.add_middleware(
 )
 
 # ========== 数据库连接配置 ==========
+load_dotenv()
 # SQLite数据库路径
 DATABASE_URL = "sqlite:///./student_status.db"
 # 创建数据库引擎（SQLite需添加check_same_thread=False）
 engine = create_engine(
     DATABASE_URL, connect_args={"check_same_thread": False}
 )
+
+# SQLite 连接参数档位，通过环境变量 SQLITE_PRAGMA_PROFILE 选择（默认 wal）
+# wal：读写并发（读不阻塞写）；safe：WAL + 每次提交落盘；legacy：保持 SQLite 默认的回滚日志
+SQLITE_PRAGMA_PROFILES = {
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 10000,
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY"
+    },
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 10000,
+        "cache_size": -65536,
+        "mmap_size": 0,
+        "temp_store": "MEMORY"
+    },
+    "legacy": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT"
+    }
+}
+SQLITE_PRAGMA_PROFILE = os.getenv("SQLITE_PRAGMA_PROFILE", "wal").strip().lower()
+# PRAGMA 查询返回的是数字编码，自检时换算回名称
+SQLITE_PRAGMA_VALUE_NAMES = {
+    "synchronous": {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"},
+    "temp_store": {0: "DEFAULT", 1: "FILE", 2: "MEMORY"}
+}
+
+def get_sqlite_pragmas() -> dict:
+    profile = SQLITE_PRAGMA_PROFILES.get(SQLITE_PRAGMA_PROFILE)
+    if profile is None:
+        print(f"[SQLite] 未知的连接参数档位 {SQLITE_PRAGMA_PROFILE}，改用 wal")
+        profile = SQLITE_PRAGMA_PROFILES["wal"]
+    return profile
+
+@event.listens_for(engine, "connect")
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in get_sqlite_pragmas().items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def check_sqlite_pragmas() -> dict:
+    result = {}
+    with engine.connect() as conn:
+        for name, expected in get_sqlite_pragmas().items():
+            effective = conn.execute(text(f"PRAGMA {name}")).scalar()
+            effective = SQLITE_PRAGMA_VALUE_NAMES.get(name, {}).get(effective, effective)
+            result[name] = {
+                "expected": expected,
+                "effective": effective,
+                "ok": str(effective).upper() == str(expected).upper()
+            }
+    return result
+
+def report_sqlite_pragmas():
+    result = check_sqlite_pragmas()
+    summary = ", ".join(f"{name}={item['effective']}" for name, item in result.items())
+    print(f"[SQLite] 连接参数档位 {SQLITE_PRAGMA_PROFILE}：{summary}")
+    for name, item in result.items():
+        if not item["ok"]:
+            print(f"[SQLite] {name} 未生效：期望 {item['expected']}，实际 {item['effective']}")
+
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# 依赖：获取数据库会话
+# 异步引擎（aiosqlite 在独立线程中执行 SQL，不阻塞事件循环），与同步引擎共用同一连接参数档位
+ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./student_status.db"
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+# expire_on_commit=False：提交后仍可直接读取对象属性，避免在异步会话中触发隐式刷新
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# 依赖：获取数据库会话（同步，仅供启动迁移和脚本使用）
 def get_db():
     db = SessionLocal()
     try:
@@ -264,6 +461,11 @@ def get_db():
     finally:
         db.close()
 
+# 依赖：获取异步数据库会话（接口统一使用）
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def parse_permissions(raw_value: Optional[str]) -> List[str]:
     if not raw_value:
         return []
@@ -318,6 +520,53 @@ def serialize_whitelist_student(student: StudentUser) -> dict:
         "update_time": student.update_time.strftime("%Y-%m-%d %H:%M:%S") if student.update_time else ""
     }
 
+# ========== 密码哈希（独立线程池 + 准入控制） ==========
+# bcrypt 计算时释放 GIL，放到专用线程池执行，事件循环不再被单次 250ms 的哈希阻塞
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+# 排队+执行中的哈希任务上限，超过直接返回 503，避免请求在队列里等到超时
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", PASSWORD_HASH_WORKERS * 16))
+# 白名单导入共用同一线程池：导入任务最多同时占用与线程数相同的排队名额，且不受登录排队上限影响
+PASSWORD_HASH_IMPORT_MAX_PENDING = PASSWORD_HASH_MAX_PENDING + PASSWORD_HASH_WORKERS
+# 单次哈希耗时估计（秒），用于计算 Retry-After
+PASSWORD_HASH_SECONDS_ESTIMATE = 0.25
+PASSWORD_HASH_EXECUTOR = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+PASSWORD_HASH_PENDING = 0
+
+class PasswordHashBusy(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("密码校验繁忙")
+        self.retry_after = retry_after
+
+@app.exception_handler(PasswordHashBusy)
+async def password_hash_busy_handler(request: Request, exc: PasswordHashBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"success": False, "message": "当前登录人数较多，请稍后重试"},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+def hash_password_sync(password: str) -> str:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+
+def verify_password_sync(password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+async def run_password_task(func, *args, max_pending: Optional[int] = None):
+    global PASSWORD_HASH_PENDING
+    if PASSWORD_HASH_PENDING >= (max_pending or PASSWORD_HASH_MAX_PENDING):
+        raise PasswordHashBusy(max(1, math.ceil(PASSWORD_HASH_PENDING * PASSWORD_HASH_SECONDS_ESTIMATE / PASSWORD_HASH_WORKERS)))
+    PASSWORD_HASH_PENDING += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(PASSWORD_HASH_EXECUTOR, func, *args)
+    finally:
+        PASSWORD_HASH_PENDING -= 1
+
+async def hash_password(password: str) -> str:
+    return await run_password_task(hash_password_sync, password)
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    return await run_password_task(verify_password_sync, password, hashed_password)
+
 def parse_active_value(raw_value) -> bool:
     if raw_value is None:
         return True
@@ -328,26 +577,31 @@ def parse_active_value(raw_value) -> bool:
         return False
     return True
 
-def upsert_whitelist_student(
-    db: Session,
+async def upsert_whitelist_student(
+    db: AsyncSession,
     student_id: str,
     name: str,
     default_password: str,
     is_active: bool = True
 ):
-    student = db.query(StudentUser).filter(StudentUser.student_id == student_id).first()
-    password_bytes = default_password.encode("utf-8")
-    hashed_password = bcrypt.hashpw(password_bytes, bcrypt.gensalt()).decode("utf-8")
+    student = (await db.execute(select(StudentUser).where(StudentUser.student_id == student_id))).scalars().first()
     created = False
     if student:
-        student.name = name
-        student.default_password = default_password
-        student.password = hashed_password
-        student.is_whitelisted = True
-        student.is_active = is_active
-        student.must_change_password = True
-        student.update_time = datetime.now()
+        # 默认密码未变时不重新哈希，也不重置学生已修改的密码
+        if student.default_password != default_password:
+            student.default_password = default_password
+            student.password = await hash_password(default_password)
+            student.must_change_password = True
+            student.update_time = datetime.now()
+        if student.is_active and not is_active:
+            await revoke_student_refresh_tokens(db, student_id=student_id)
+        if student.name != name or student.is_active != is_active or not student.is_whitelisted:
+            student.name = name
+            student.is_active = is_active
+            student.is_whitelisted = True
+            student.update_time = datetime.now()
     else:
+        hashed_password = await hash_password(default_password)
         student = StudentUser(
             name=name,
             student_id=student_id,
@@ -524,27 +778,39 @@ EXCEL_ACHIEVEMENT_TYPE_TEMPLATES = [
     }
 ]
 
-def get_or_init_score_formula(db: Session) -> ScoreFormula:
-    formula = db.query(ScoreFormula).order_by(ScoreFormula.id.asc()).first()
+async def get_or_init_score_formula(db: AsyncSession) -> ScoreFormula:
+    formula = (await db.execute(select(ScoreFormula).order_by(ScoreFormula.id.asc()))).scalars().first()
     if formula:
         return formula
-    default_weights = {
-        "paper": 0.2,
-        "policy": 0.2,
-        "academic": 0.2,
-        "volunteer": 0.2,
-        "award": 0.2,
-        "custom": 0.0
-    }
+    # 只在首次创建时写入默认权重（全部按自定义成果计分），之后以管理员保存的权重为准
+    default_weights = normalize_formula_weights({
+        "paper": 0.0,
+        "policy": 0.0,
+        "academic": 0.0,
+        "volunteer": 0.0,
+        "award": 0.0,
+        "custom": 1.0
+    })
     formula = ScoreFormula(
         weights_json=json.dumps(default_weights, ensure_ascii=False),
+        version=1,
         update_time=datetime.now()
     )
     db.add(formula)
-    db.commit()
-    db.refresh(formula)
+    await db.commit()
+    await db.refresh(formula)
     return formula
 
+def save_score_formula_weights(formula: ScoreFormula, weights: dict) -> bool:
+    # 权重有变化才递增版本号，已算分的成果据此判断是否过期
+    weights_json = json.dumps(weights, ensure_ascii=False)
+    formula.update_time = datetime.now()
+    if parse_weights(formula.weights_json) == weights:
+        return False
+    formula.weights_json = weights_json
+    formula.version = (formula.version or 1) + 1
+    return True
+
 def parse_weights(raw_value: Optional[str]) -> dict:
     if not raw_value:
         return {}
@@ -576,40 +842,205 @@ def ensure_table_columns(conn, table_name: str, columns):
         if column_name not in existing_columns:
             conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_sql}"))
 
+# 热点查询索引：(索引名, 表名, 索引列, 部分索引条件)
+ACHIEVEMENT_INDEXES = [
+    ("idx_student_achievements_student_time", "student_achievements", "student_id, create_time", None),
+    ("idx_student_achievements_time", "student_achievements", "create_time", None),
+    ("idx_student_users_whitelist_time", "student_users", "is_whitelisted, create_time", None),
+    ("idx_paper_achievement", "paper", "achievement_id", None),
+    ("idx_policy_report_achievement", "policy_report", "achievement_id", None),
+    ("idx_academic_exchange_achievement", "academic_exchange", "achievement_id", None),
+    ("idx_volunteer_service_achievement", "volunteer_service", "achievement_id", None),
+    ("idx_award_achievement", "award", "achievement_id", None),
+    ("idx_custom_achievement_achievement_type", "custom_achievement", "achievement_id, type_id", None),
+    ("idx_achievement_document_achievement", "achievement_document", "achievement_id", None),
+    ("idx_achievement_document_paper", "achievement_document", "paper_id", "paper_id IS NOT NULL"),
+    ("idx_achievement_document_policy", "achievement_document", "policy_id", "policy_id IS NOT NULL"),
+    ("idx_achievement_document_academic", "achievement_document", "academic_id", "academic_id IS NOT NULL"),
+    ("idx_achievement_document_volunteer", "achievement_document", "volunteer_id", "volunteer_id IS NOT NULL"),
+    ("idx_achievement_document_award", "achievement_document", "award_id", "award_id IS NOT NULL"),
+    ("idx_achievement_document_custom", "achievement_document", "custom_id", "custom_id IS NOT NULL")
+]
+
+# 启动自检用的热点查询：(说明, 表名, SQL)，执行计划中出现全表扫描即视为缺索引。
+# 在不含统计信息的内存副本上生成执行计划，小表上规划器选择全表扫描不会被误报
+ACHIEVEMENT_INDEX_PROBES = [
+    ("学生成果列表", "student_achievements", "SELECT * FROM student_achievements WHERE student_id = '0' ORDER BY create_time DESC"),
+    ("论文明细", "paper", "SELECT * FROM paper WHERE achievement_id = 0"),
+    ("资政报告明细", "policy_report", "SELECT * FROM policy_report WHERE achievement_id = 0"),
+    ("学术交流明细", "academic_exchange", "SELECT * FROM academic_exchange WHERE achievement_id = 0"),
+    ("志愿服务明细", "volunteer_service", "SELECT * FROM volunteer_service WHERE achievement_id = 0"),
+    ("获奖明细", "award", "SELECT * FROM award WHERE achievement_id = 0"),
+    ("自定义成果明细", "custom_achievement", "SELECT * FROM custom_achievement WHERE achievement_id = 0"),
+    ("成果附件", "achievement_document", "SELECT * FROM achievement_document WHERE achievement_id = 0"),
+    ("论文附件", "achievement_document", "SELECT * FROM achievement_document WHERE paper_id = 0"),
+    ("资政报告附件", "achievement_document", "SELECT * FROM achievement_document WHERE policy_id = 0"),
+    ("学术交流附件", "achievement_document", "SELECT * FROM achievement_document WHERE academic_id = 0"),
+    ("志愿服务附件", "achievement_document", "SELECT * FROM achievement_document WHERE volunteer_id = 0"),
+    ("获奖附件", "achievement_document", "SELECT * FROM achievement_document WHERE award_id = 0"),
+    ("自定义成果附件", "achievement_document", "SELECT * FROM achievement_document WHERE custom_id = 0")
+]
+
+def get_index_columns(conn, index_name: str) -> List[str]:
+    return [row[2] for row in conn.execute(text(f"PRAGMA index_info({index_name})")).fetchall()]
+
+def build_index_sql(index_name: str, table_name: str, columns_sql: str, where_sql: Optional[str]) -> str:
+    where_clause = f" WHERE {where_sql}" if where_sql else ""
+    return f"CREATE INDEX {index_name} ON {table_name} ({columns_sql}){where_clause}"
+
+def normalize_index_sql(sql: Optional[str]) -> str:
+    # 忽略大小写、空白和 IF NOT EXISTS，只比较索引列和部分索引条件
+    normalized = " ".join((sql or "").lower().replace("if not exists", "").split())
+    for token in ["(", ")", ","]:
+        normalized = normalized.replace(f" {token}", token).replace(f"{token} ", token)
+    return normalized
+
+def explain_index_probes(conn) -> List[dict]:
+    # 把当前库的表和索引定义复制到空的内存库（没有 sqlite_stat1），规划器按默认的大表估算选择索引，
+    # 只要还出现不带索引的 SCAN 就说明这条热点查询确实缺索引
+    schema_rows = conn.execute(text(
+        "SELECT type, sql FROM sqlite_master WHERE type IN ('table', 'index') AND sql IS NOT NULL "
+        "AND name NOT LIKE 'sqlite_%' ORDER BY CASE type WHEN 'table' THEN 0 ELSE 1 END"
+    )).fetchall()
+    missing = []
+    probe_engine = create_engine("sqlite://")
+    try:
+        with probe_engine.connect() as probe_conn:
+            for _, schema_sql in schema_rows:
+                probe_conn.execute(text(schema_sql))
+            for label, table_name, probe_sql in ACHIEVEMENT_INDEX_PROBES:
+                plan_rows = probe_conn.execute(text(f"EXPLAIN QUERY PLAN {probe_sql}")).fetchall()
+                details = [str(row[-1]) for row in plan_rows]
+                if any(
+                    (detail.startswith(f"SCAN {table_name}") or detail.startswith(f"SCAN TABLE {table_name}"))
+                    and "USING" not in detail
+                    for detail in details
+                ):
+                    missing.append({"query": label, "plan": "; ".join(details)})
+    finally:
+        probe_engine.dispose()
+    return missing
+
+def ensure_achievement_indexes(conn) -> dict:
+    existing = {
+        row[0]: row[1]
+        for row in conn.execute(text("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'")).fetchall()
+    }
+    created = []
+    for index_name, table_name, columns_sql, where_sql in ACHIEVEMENT_INDEXES:
+        if index_name in existing:
+            continue
+        conn.execute(text(build_index_sql(index_name, table_name, columns_sql, where_sql)))
+        existing[index_name] = table_name
+        created.append(index_name)
+    # 校验索引定义（列和部分索引条件）与期望一致，不一致的重建
+    stored_sql = {
+        row[0]: row[1]
+        for row in conn.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'index'")).fetchall()
+    }
+    rebuilt = []
+    for index_name, table_name, columns_sql, where_sql in ACHIEVEMENT_INDEXES:
+        expected_sql = build_index_sql(index_name, table_name, columns_sql, where_sql)
+        if normalize_index_sql(stored_sql.get(index_name)) != normalize_index_sql(expected_sql):
+            conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+            conn.execute(text(expected_sql))
+            rebuilt.append(index_name)
+    conn.execute(text("PRAGMA optimize"))
+    # 缺失索引：热点查询仍走全表扫描
+    missing = explain_index_probes(conn)
+    # 无用索引：只覆盖 INTEGER PRIMARY KEY（即 rowid）的索引，查询规划器永远不会使用
+    managed_tables = {table_name for _, table_name, _, _ in ACHIEVEMENT_INDEXES}
+    unused = []
+    for index_name, table_name in existing.items():
+        if table_name not in managed_tables or index_name.startswith("sqlite_autoindex"):
+            continue
+        pk_columns = [
+            row[1] for row in conn.execute(text(f"PRAGMA table_info({table_name})")).fetchall() if row[5]
+        ]
+        if len(pk_columns) == 1 and get_index_columns(conn, index_name) == pk_columns:
+            unused.append(index_name)
+    return {
+        "created": created,
+        "rebuilt": rebuilt,
+        "missing": missing,
+        "unused": sorted(unused)
+    }
+
+def report_index_health(report: dict):
+    if report["created"]:
+        print(f"[索引] 新建索引：{', '.join(report['created'])}")
+    if report["rebuilt"]:
+        print(f"[索引] 重建索引：{', '.join(report['rebuilt'])}")
+    for item in report["missing"]:
+        print(f"[索引] 缺少索引：{item['query']} -> {item['plan']}")
+    if report["unused"]:
+        print(f"[索引] 未被使用的冗余索引（主键已隐含）：{', '.join(report['unused'])}")
+
 def ensure_achievement_schema():
     with engine.begin() as conn:
         ensure_table_columns(conn, "student_achievements", [
             ("overall_score", "FLOAT"),
-            ("review_completed", "BOOLEAN DEFAULT 0")
+            ("review_completed", "BOOLEAN DEFAULT 0"),
+            ("version", "INTEGER DEFAULT 1"),
+            ("lifecycle_status", "VARCHAR(20)"),
+            ("formula_version", "INTEGER")
+        ])
+        ensure_table_columns(conn, "score_formula", [
+            ("version", "INTEGER DEFAULT 1")
         ])
         for table_name in ["paper", "policy_report", "academic_exchange", "volunteer_service", "award", "custom_achievement"]:
             ensure_table_columns(conn, table_name, REVIEW_COLUMNS)
         ensure_table_columns(conn, "custom_achievement", [
-            ("self_score", "FLOAT")
+            ("self_score", "FLOAT"),
+            ("suggested_score", "FLOAT"),
+            ("suggested_rules_version", "INTEGER")
+        ])
+        ensure_table_columns(conn, "background_job", [
+            ("result_json", "TEXT")
+        ])
+        ensure_table_columns(conn, "achievement_type", [
+            ("rules_json", "TEXT"),
+            ("rules_version", "INTEGER DEFAULT 1")
+        ])
+        ensure_table_columns(conn, "upload_blob", [
+            ("last_seen_time", "DATETIME")
         ])
+        index_report = ensure_achievement_indexes(conn)
+    report_index_health(index_report)
 
-def sync_excel_achievement_types(db: Session):
-    existing = db.query(AchievementType).all()
+async def sync_excel_achievement_types(db: AsyncSession):
+    existing = (await db.execute(select(AchievementType))).scalars().all()
     existing_map = {item.name: item for item in existing}
     active_names = {entry["name"] for entry in EXCEL_ACHIEVEMENT_TYPE_TEMPLATES}
+    # 只有内容真正变化的类型才更新 update_time：成果详情的 ETag 包含该时间，每次启动都刷新会让所有缓存失效
     for item in existing:
-        item.is_active = item.name in active_names
-        item.update_time = datetime.now()
+        if item.is_active != (item.name in active_names):
+            item.is_active = item.name in active_names
+            item.update_time = datetime.now()
     for entry in EXCEL_ACHIEVEMENT_TYPE_TEMPLATES:
         current = existing_map.get(entry["name"])
+        default_rules = DEFAULT_SCORING_RULES.get(entry["name"])
         if current:
-            current.fields_json = json.dumps(entry["fields"], ensure_ascii=False)
-            current.is_active = True
-            current.update_time = datetime.now()
+            fields_json = json.dumps(entry["fields"], ensure_ascii=False)
+            if current.fields_json != fields_json:
+                current.fields_json = fields_json
+                current.update_time = datetime.now()
+            # 只为尚未配置规则的类型补默认规则，不覆盖管理员的修改
+            if default_rules and not current.rules_json:
+                current.rules_json = json.dumps(default_rules, ensure_ascii=False)
+                current.rules_version = (current.rules_version or 0) + 1
+                current.update_time = datetime.now()
         else:
             db.add(AchievementType(
                 name=entry["name"],
                 fields_json=json.dumps(entry["fields"], ensure_ascii=False),
+                rules_json=json.dumps(default_rules, ensure_ascii=False) if default_rules else None,
+                rules_version=1,
                 is_active=True,
                 create_time=datetime.now(),
                 update_time=datetime.now()
             ))
-    db.commit()
+    await db.commit()
 
 def serialize_document(doc: AchievementDocument) -> dict:
     return {
@@ -618,28 +1049,58 @@ def serialize_document(doc: AchievementDocument) -> dict:
         "file_name": doc.file_name or "",
         "file_ext": doc.file_ext or "",
         "mime_type": doc.mime_type or "",
-        "download_url": f"/uploads/{doc.file_path}"
+        "download_url": f"/uploads/{doc.file_path}",
+        "thumbnail_url": build_thumbnail_url(doc.file_path, 320),
+        "preview_url": build_thumbnail_url(doc.file_path, 1280)
     }
 
-def get_documents_for_item(db: Session, item_type: str, item_id: int) -> List[dict]:
-    query = db.query(AchievementDocument)
+async def get_documents_for_item(db: AsyncSession, item_type: str, item_id: int) -> List[dict]:
+    query = select(AchievementDocument)
     if item_type == "paper":
-        query = query.filter(AchievementDocument.paper_id == item_id)
+        query = query.where(AchievementDocument.paper_id == item_id)
     elif item_type == "policy":
-        query = query.filter(AchievementDocument.policy_id == item_id)
+        query = query.where(AchievementDocument.policy_id == item_id)
     elif item_type == "academic":
-        query = query.filter(AchievementDocument.academic_id == item_id)
+        query = query.where(AchievementDocument.academic_id == item_id)
     elif item_type == "volunteer":
-        query = query.filter(AchievementDocument.volunteer_id == item_id)
+        query = query.where(AchievementDocument.volunteer_id == item_id)
     elif item_type == "award":
-        query = query.filter(AchievementDocument.award_id == item_id)
+        query = query.where(AchievementDocument.award_id == item_id)
     elif item_type == "custom":
-        query = query.filter(AchievementDocument.custom_id == item_id)
+        query = query.where(AchievementDocument.custom_id == item_id)
     else:
         return []
-    return [serialize_document(item) for item in query.order_by(AchievementDocument.id.asc()).all()]
+    documents = (await db.execute(query.order_by(AchievementDocument.id.asc()))).scalars().all()
+    return [serialize_document(item) for item in documents]
 
-def append_documents_for_item(db: Session, achievement_id: int, item_type: str, item_id: int, docs: list):
+# 附件表中各成果类型对应的外键列
+DOCUMENT_ITEM_COLUMNS = {
+    "paper": "paper_id",
+    "policy": "policy_id",
+    "academic": "academic_id",
+    "volunteer": "volunteer_id",
+    "award": "award_id",
+    "custom": "custom_id"
+}
+
+async def get_documents_for_achievement(db: AsyncSession, achievement_id: int) -> dict:
+    # 一次查询取回整份成果的附件，按 (成果类型, 成果项ID) 分组
+    documents = (await db.execute(
+        select(AchievementDocument)
+        .where(AchievementDocument.achievement_id == achievement_id)
+        .order_by(AchievementDocument.id.asc())
+    )).scalars().all()
+    grouped = {}
+    for doc in documents:
+        for item_type, column_name in DOCUMENT_ITEM_COLUMNS.items():
+            item_id = getattr(doc, column_name)
+            if item_id is not None:
+                grouped.setdefault((item_type, item_id), []).append(serialize_document(doc))
+                break
+    return grouped
+
+def append_documents_for_item(db: AsyncSession, achievement_id: int, item_type: str, item_id: int, docs: list):
+    documents = []
     for entry in docs or []:
         if isinstance(entry, str):
             file_path = entry
@@ -672,26 +1133,27 @@ def append_documents_for_item(db: Session, achievement_id: int, item_type: str,
             payload["award_id"] = item_id
         elif item_type == "custom":
             payload["custom_id"] = item_id
-        db.add(AchievementDocument(**payload))
-
-def calculate_review_completed(achievement_data: dict) -> bool:
-    for key in ["papers", "policies", "academics", "volunteers", "awards", "customs"]:
-        for item in achievement_data.get(key, []):
-            review_status = item.get("review_status")
-            review_score = item.get("rescore_score") if item.get("review_status") == "rescored" else item.get("review_score")
-            if review_score is None and item.get("review_score") is None:
-                return False
-            if review_status not in ["reviewed", "rescored", "agreed"]:
-                return False
+        documents.append(AchievementDocument(**payload))
+    db.add_all(documents)
+    return documents
+
+def calculate_items_review_completed(items) -> bool:
+    for item in items:
+        review_status = item.review_status
+        review_score = item.rescore_score if review_status == "rescored" else item.review_score
+        if review_score is None and item.review_score is None:
+            return False
+        if review_status not in ["reviewed", "rescored", "agreed"]:
+            return False
     return True
 
-def get_type_items(db: Session, achievement_id: int, item_type: str):
+async def get_type_items(db: AsyncSession, achievement_id: int, item_type: str):
     item_type = (item_type or "").lower()
     model_info = REVIEW_MODEL_MAP.get(item_type)
     if not model_info:
         return []
     model_cls = model_info[0]
-    return db.query(model_cls).filter(model_cls.achievement_id == achievement_id).all()
+    return (await db.execute(select(model_cls).where(model_cls.achievement_id == achievement_id))).scalars().all()
 
 def build_type_summary(display_name: str, item_type: str, items: list):
     if not items:
@@ -746,16 +1208,19 @@ def build_type_summary(display_name: str, item_type: str, items: list):
         "indicator_text": indicator_text
     }
 
-def calculate_achievement_lifecycle_status(db: Session, achievement: StudentAchievement) -> str:
-    source_items = [
-        db.query(Paper).filter(Paper.achievement_id == achievement.id).all(),
-        db.query(PolicyReport).filter(PolicyReport.achievement_id == achievement.id).all(),
-        db.query(AcademicExchange).filter(AcademicExchange.achievement_id == achievement.id).all(),
-        db.query(VolunteerService).filter(VolunteerService.achievement_id == achievement.id).all(),
-        db.query(Award).filter(Award.achievement_id == achievement.id).all(),
-        db.query(CustomAchievement).filter(CustomAchievement.achievement_id == achievement.id).all()
-    ]
-    items = [item for group in source_items for item in group]
+async def load_achievement_items(db: AsyncSession, achievement_id: int) -> dict:
+    return {
+        item_type: (await db.execute(
+            select(model_cls).where(model_cls.achievement_id == achievement_id)
+        )).scalars().all()
+        for item_type, (model_cls, _) in REVIEW_MODEL_MAP.items()
+    }
+
+async def calculate_achievement_lifecycle_status(db: AsyncSession, achievement: StudentAchievement) -> str:
+    source_items = await load_achievement_items(db, achievement.id)
+    return calculate_items_lifecycle_status([item for group in source_items.values() for item in group])
+
+def calculate_items_lifecycle_status(items) -> str:
     if not items:
         return "已提交"
     disagree_items = [item for item in items if item.student_agree is False]
@@ -771,44 +1236,404 @@ def calculate_achievement_lifecycle_status(db: Session, achievement: StudentAchi
     )
     return "已审核" if has_reviewed else "已提交"
 
-def recalculate_achievement_score(db: Session, achievement: StudentAchievement):
-    formula = get_or_init_score_formula(db)
-    weights = parse_weights(formula.weights_json)
-    source_items = {
-        "paper": db.query(Paper).filter(Paper.achievement_id == achievement.id).all(),
-        "policy": db.query(PolicyReport).filter(PolicyReport.achievement_id == achievement.id).all(),
-        "academic": db.query(AcademicExchange).filter(AcademicExchange.achievement_id == achievement.id).all(),
-        "volunteer": db.query(VolunteerService).filter(VolunteerService.achievement_id == achievement.id).all(),
-        "award": db.query(Award).filter(Award.achievement_id == achievement.id).all(),
-        "custom": db.query(CustomAchievement).filter(CustomAchievement.achievement_id == achievement.id).all()
+# ========== 成绩聚合（按成果、按类型增量维护） ==========
+AGGREGATE_COUNTER_FIELDS = [
+    "item_count", "scored_count", "reviewed_count", "completed_count",
+    "touched_count", "disagree_count", "disagree_rescored_count", "score_sum"
+]
+REVIEWED_STATUSES = ["reviewed", "rescored", "agreed"]
+
+def item_aggregate_type_id(item_type: str, item) -> int:
+    return int(item.type_id or 0) if item_type == "custom" else 0
+
+def item_aggregate_contribution(item) -> dict:
+    # 单个成果项对聚合计数的贡献；口径与 calculate_items_review_completed / calculate_items_lifecycle_status 一致
+    review_status = item.review_status or "pending"
+    effective_score = item.rescore_score if item.rescore_score is not None else item.review_score
+    is_disagree = item.student_agree is False
+    return {
+        "item_count": 1,
+        "scored_count": 1 if effective_score is not None else 0,
+        "reviewed_count": 1 if review_status in REVIEWED_STATUSES else 0,
+        "completed_count": 1 if review_status in REVIEWED_STATUSES and (
+            item.review_score is not None or (review_status == "rescored" and item.rescore_score is not None)
+        ) else 0,
+        "touched_count": 1 if item.review_score is not None or review_status in REVIEWED_STATUSES else 0,
+        "disagree_count": 1 if is_disagree else 0,
+        "disagree_rescored_count": 1 if is_disagree and review_status == "rescored" and bool((item.rescore_comment or "").strip()) else 0,
+        "score_sum": float(effective_score) if effective_score is not None else 0.0
     }
+
+def build_item_aggregates(source_items: dict) -> dict:
+    aggregates = {}
+    for item_type, items in source_items.items():
+        for item in items:
+            bucket = aggregates.setdefault(
+                (item_type, item_aggregate_type_id(item_type, item)),
+                dict.fromkeys(AGGREGATE_COUNTER_FIELDS, 0)
+            )
+            for field, value in item_aggregate_contribution(item).items():
+                bucket[field] += value
+    return aggregates
+
+async def apply_item_aggregate_changes(db: AsyncSession, achievement_id: int, item_type: str, items: list, before: Optional[list] = None):
+    # before 为修改前各项的贡献快照（新增项传 None），按差值累加到聚合行
+    deltas = {}
+    for index, item in enumerate(items):
+        previous = before[index] if before else None
+        bucket = deltas.setdefault(item_aggregate_type_id(item_type, item), dict.fromkeys(AGGREGATE_COUNTER_FIELDS, 0))
+        for field, value in item_aggregate_contribution(item).items():
+            bucket[field] += value - (previous[field] if previous else 0)
+    for type_id, delta in deltas.items():
+        if not any(delta.values()):
+            continue
+        result = await db.execute(
+            update(AchievementScoreAggregate)
+            .where(
+                AchievementScoreAggregate.achievement_id == achievement_id,
+                AchievementScoreAggregate.item_type == item_type,
+                AchievementScoreAggregate.type_id == type_id
+            )
+            .values({field: getattr(AchievementScoreAggregate, field) + delta[field] for field in AGGREGATE_COUNTER_FIELDS})
+        )
+        if result.rowcount == 0:
+            db.add(AchievementScoreAggregate(achievement_id=achievement_id, item_type=item_type, type_id=type_id, **delta))
+            await db.flush()
+
+async def load_score_aggregates(db: AsyncSession, achievement_id: int) -> list:
+    return (await db.execute(
+        select(AchievementScoreAggregate).where(AchievementScoreAggregate.achievement_id == achievement_id)
+    )).scalars().all()
+
+def resolve_score_bucket(item_type: str, type_id: int, custom_type_weights: dict):
+    # 单独配置了权重的自定义类型自成一组，其余自定义类型仍合并计入 "custom"
+    if item_type == "custom" and str(type_id) in custom_type_weights:
+        return ("custom", int(type_id)), float(custom_type_weights[str(type_id)])
+    return item_type, None
+
+def derive_achievement_review_state(aggregates: list, weights: dict) -> dict:
+    # 只遍历类型聚合行，与成果项数量无关
+    custom_type_weights = weights.get("custom_types") or {}
+    totals = {}
+    bucket_weights = {}
+    for row in aggregates:
+        if not row.item_count:
+            continue
+        bucket_key, bucket_weight = resolve_score_bucket(row.item_type, row.type_id, custom_type_weights)
+        bucket = totals.setdefault(bucket_key, dict.fromkeys(AGGREGATE_COUNTER_FIELDS, 0))
+        for field in AGGREGATE_COUNTER_FIELDS:
+            bucket[field] += getattr(row, field) or 0
+        bucket_weights[bucket_key] = bucket_weight if bucket_weight is not None else float(weights.get(row.item_type, 0))
     weighted_total = 0.0
     weighted_factor = 0.0
     all_reviewed = True
-    for key, items in source_items.items():
-        if not items:
-            continue
-        for item in items:
-            if (item.review_status or "pending") not in ["reviewed", "rescored", "agreed"]:
-                all_reviewed = False
-        scores = []
-        for item in items:
-            effective_score = item.rescore_score if item.rescore_score is not None else item.review_score
-            if effective_score is None:
-                continue
-            scores.append(float(effective_score))
-        if len(scores) != len(items):
+    for bucket_key, bucket in totals.items():
+        if bucket["reviewed_count"] != bucket["item_count"] or bucket["scored_count"] != bucket["item_count"]:
             all_reviewed = False
-        if not scores:
+        if not bucket["scored_count"]:
             continue
-        weight = float(weights.get(key, 0))
+        weight = bucket_weights[bucket_key]
         if weight <= 0:
             continue
-        avg_score = sum(scores) / len(scores)
-        weighted_total += avg_score * weight
+        weighted_total += bucket["score_sum"] / bucket["scored_count"] * weight
         weighted_factor += weight
-    achievement.overall_score = (weighted_total / weighted_factor) if weighted_factor > 0 else None
-    achievement.review_completed = bool(all_reviewed and weighted_factor > 0)
+    disagree_count = sum(bucket["disagree_count"] for bucket in totals.values())
+    if disagree_count:
+        rescored_count = sum(bucket["disagree_rescored_count"] for bucket in totals.values())
+        lifecycle_status = "已复核" if rescored_count == disagree_count else "待复核"
+    elif any(bucket["touched_count"] for bucket in totals.values()):
+        lifecycle_status = "已审核"
+    else:
+        lifecycle_status = "已提交"
+    return {
+        "overall_score": (weighted_total / weighted_factor) if weighted_factor > 0 else None,
+        "review_completed": bool(all_reviewed and weighted_factor > 0),
+        "audit_status": all(bucket["completed_count"] == bucket["item_count"] for bucket in totals.values()),
+        "lifecycle_status": lifecycle_status
+    }
+
+async def recalculate_achievement_score(db: AsyncSession, achievement: StudentAchievement, aggregates: Optional[list] = None):
+    formula = await get_or_init_score_formula(db)
+    if aggregates is None:
+        aggregates = await load_score_aggregates(db, achievement.id)
+    state = derive_achievement_review_state(aggregates, parse_weights(formula.weights_json))
+    achievement.overall_score = state["overall_score"]
+    achievement.review_completed = state["review_completed"]
+    achievement.formula_version = formula.version or 1
+    return state
+
+async def refresh_stale_achievement_scores(db: AsyncSession, achievements: list) -> int:
+    # 读取时惰性重算：只处理公式版本过期的行，聚合一次批量取回；调用方负责提交
+    formula = await get_or_init_score_formula(db)
+    formula_version = formula.version or 1
+    stale = [item for item in achievements if item.formula_version != formula_version]
+    if not stale:
+        return 0
+    aggregates = {}
+    for row in (await db.execute(
+        select(AchievementScoreAggregate).where(AchievementScoreAggregate.achievement_id.in_([item.id for item in stale]))
+    )).scalars().all():
+        aggregates.setdefault(row.achievement_id, []).append(row)
+    weights = parse_weights(formula.weights_json)
+    for achievement in stale:
+        state = derive_achievement_review_state(aggregates.get(achievement.id, []), weights)
+        achievement.overall_score = state["overall_score"]
+        achievement.review_completed = state["review_completed"]
+        achievement.formula_version = formula_version
+    return len(stale)
+
+async def refresh_achievement_review_state(db: AsyncSession, achievement: StudentAchievement, touch_audit_time: bool = True):
+    # 审核状态只在写路径维护，详情查询保持只读；每次变更递增版本号供 ETag 使用
+    state = await recalculate_achievement_score(db, achievement)
+    achievement.audit_status = state["audit_status"]
+    achievement.lifecycle_status = state["lifecycle_status"]
+    if achievement.audit_status and (touch_audit_time or not achievement.audit_time):
+        achievement.audit_time = datetime.now()
+    achievement.version = (achievement.version or 0) + 1
+
+async def rebuild_score_aggregates(db: AsyncSession, achievement_ids: list, apply_fix: bool = True) -> list:
+    # 从成果项全量重建聚合并与现有聚合比对，返回不一致的成果ID
+    mismatched = []
+    for achievement_id in achievement_ids:
+        expected = build_item_aggregates(await load_achievement_items(db, achievement_id))
+        existing = {
+            (row.item_type, row.type_id): row
+            for row in await load_score_aggregates(db, achievement_id)
+        }
+        consistent = set(expected) == {key for key, row in existing.items() if row.item_count}
+        if consistent:
+            for key, counters in expected.items():
+                row = existing[key]
+                if any(abs((getattr(row, field) or 0) - counters[field]) > 1e-6 for field in AGGREGATE_COUNTER_FIELDS):
+                    consistent = False
+                    break
+        if consistent:
+            continue
+        mismatched.append(achievement_id)
+        if not apply_fix:
+            continue
+        for row in existing.values():
+            await db.delete(row)
+        await db.flush()
+        db.add_all([
+            AchievementScoreAggregate(achievement_id=achievement_id, item_type=item_type, type_id=type_id, **counters)
+            for (item_type, type_id), counters in expected.items()
+        ])
+        await db.flush()
+        achievement = await db.get(StudentAchievement, achievement_id)
+        if achievement:
+            await refresh_achievement_review_state(db, achievement, touch_audit_time=False)
+    if mismatched and apply_fix:
+        invalidate_score_matrix_cache()
+    return mismatched
+
+async def check_score_aggregates(apply_fix: bool = True, batch_size: int = 200) -> list:
+    # 一致性检查命令：python -m app.main rebuild-score-aggregates [--check]
+    mismatched = []
+    last_id = 0
+    async with AsyncSessionLocal() as db:
+        while True:
+            achievement_ids = (await db.execute(
+                select(StudentAchievement.id).where(StudentAchievement.id > last_id)
+                .order_by(StudentAchievement.id.asc()).limit(batch_size)
+            )).scalars().all()
+            if not achievement_ids:
+                break
+            mismatched.extend(await rebuild_score_aggregates(db, achievement_ids, apply_fix))
+            await db.commit()
+            last_id = achievement_ids[-1]
+    return mismatched
+
+# ========== 成绩公式模拟（NumPy 矩阵） ==========
+SCORE_FORMULA_KEYS = ["paper", "policy", "academic", "volunteer", "award", "custom"]
+# 矩阵缓存有效期（秒），本进程内的评分写操作会主动失效
+SCORE_MATRIX_CACHE_SECONDS = 60
+SCORE_MATRIX_CACHE = {}
+
+def normalize_formula_weights(weights: dict) -> dict:
+    normalized = {}
+    for key in SCORE_FORMULA_KEYS:
+        try:
+            normalized[key] = float(weights.get(key, 0))
+        except Exception:
+            normalized[key] = 0.0
+    # 按自定义类型ID单独配置的权重，未配置的类型沿用 "custom" 权重
+    custom_types = {}
+    raw_custom_types = weights.get("custom_types")
+    if isinstance(raw_custom_types, dict):
+        for type_id, weight in raw_custom_types.items():
+            try:
+                custom_types[str(int(type_id))] = float(weight)
+            except Exception:
+                continue
+    normalized["custom_types"] = dict(sorted(custom_types.items(), key=lambda entry: int(entry[0])))
+    return normalized
+
+def invalidate_score_matrix_cache():
+    SCORE_MATRIX_CACHE.clear()
+
+async def load_score_matrix(db: AsyncSession) -> dict:
+    # 行为成果、列为（类型, 自定义类型ID）的有效分数之和与计分项数矩阵
+    cached = SCORE_MATRIX_CACHE.get("matrix")
+    if cached and cached["expire"] > time.monotonic():
+        return cached
+    achievements = (await db.execute(
+        select(StudentAchievement.id, StudentAchievement.student_id).order_by(StudentAchievement.id.asc())
+    )).all()
+    achievement_ids = np.array([row.id for row in achievements], dtype=np.int64)
+    rows = (await db.execute(
+        select(
+            AchievementScoreAggregate.achievement_id,
+            AchievementScoreAggregate.item_type,
+            AchievementScoreAggregate.type_id,
+            func.sum(AchievementScoreAggregate.score_sum),
+            func.sum(AchievementScoreAggregate.scored_count)
+        ).group_by(
+            AchievementScoreAggregate.achievement_id,
+            AchievementScoreAggregate.item_type,
+            AchievementScoreAggregate.type_id
+        )
+    )).all()
+    columns = [(key, 0) for key in SCORE_FORMULA_KEYS if key != "custom"]
+    columns += sorted({("custom", row[2]) for row in rows if row[1] == "custom"})
+    score_sums = np.zeros((len(achievements), len(columns)))
+    scored_counts = np.zeros((len(achievements), len(columns)))
+    if rows and len(achievement_ids):
+        column_map = {column: index for index, column in enumerate(columns)}
+        row_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        positions = np.minimum(np.searchsorted(achievement_ids, row_ids), len(achievement_ids) - 1)
+        column_indexes = np.array([
+            column_map.get((row[1], row[2] if row[1] == "custom" else 0), -1) for row in rows
+        ], dtype=np.int64)
+        valid = (achievement_ids[positions] == row_ids) & (column_indexes >= 0)
+        score_sums[positions[valid], column_indexes[valid]] = np.array([row[3] or 0.0 for row in rows])[valid]
+        scored_counts[positions[valid], column_indexes[valid]] = np.array([row[4] or 0 for row in rows], dtype=float)[valid]
+    cached = {
+        "score_sums": score_sums,
+        "scored_counts": scored_counts,
+        "columns": columns,
+        "achievement_ids": achievement_ids,
+        "student_ids": [row.student_id for row in achievements],
+        "expire": time.monotonic() + SCORE_MATRIX_CACHE_SECONDS
+    }
+    SCORE_MATRIX_CACHE["matrix"] = cached
+    return cached
+
+def evaluate_score_matrix(cached: dict, weights: dict):
+    # 与 derive_achievement_review_state 同口径：先按权重分组求平均分，再按权重加权平均
+    custom_type_weights = weights.get("custom_types") or {}
+    score_sums = cached["score_sums"]
+    scored_counts = cached["scored_counts"]
+    separate_columns = []
+    separate_weights = []
+    pooled_custom_columns = []
+    for index, (item_type, type_id) in enumerate(cached["columns"]):
+        bucket_key, bucket_weight = resolve_score_bucket(item_type, type_id, custom_type_weights)
+        if bucket_key == "custom":
+            pooled_custom_columns.append(index)
+            continue
+        separate_columns.append(index)
+        separate_weights.append(bucket_weight if bucket_weight is not None else float(weights.get(item_type, 0)))
+    group_sums = [score_sums[:, separate_columns]]
+    group_counts = [scored_counts[:, separate_columns]]
+    group_weights = separate_weights
+    if pooled_custom_columns:
+        group_sums.append(score_sums[:, pooled_custom_columns].sum(axis=1, keepdims=True))
+        group_counts.append(scored_counts[:, pooled_custom_columns].sum(axis=1, keepdims=True))
+        group_weights = separate_weights + [float(weights.get("custom", 0))]
+    sums = np.hstack(group_sums)
+    counts = np.hstack(group_counts)
+    weight_vector = np.maximum(np.array(group_weights, dtype=float), 0.0)
+    averages = np.zeros_like(sums)
+    np.divide(sums, counts, out=averages, where=counts > 0)
+    weighted_factor = (counts > 0) @ weight_vector
+    weighted_total = averages @ weight_vector
+    scores = np.full(sums.shape[0], np.nan)
+    np.divide(weighted_total, weighted_factor, out=scores, where=weighted_factor > 0)
+    return scores
+
+def rank_scores(scores):
+    # 分数从高到低排名（1起），无分数的成果不参与排名，记为0
+    ranks = np.zeros(len(scores), dtype=np.int64)
+    scored_positions = np.flatnonzero(~np.isnan(scores))
+    order = scored_positions[np.argsort(-scores[scored_positions], kind="stable")]
+    ranks[order] = np.arange(1, len(order) + 1)
+    return ranks
+
+def summarize_score_distribution(scores) -> dict:
+    values = scores[~np.isnan(scores)]
+    if not len(values):
+        return {"count": 0, "mean": None, "std": None, "min": None, "p25": None, "median": None, "p75": None, "max": None, "histogram": []}
+    histogram, edges = np.histogram(np.clip(values, 0, 100), bins=10, range=(0, 100))
+    p25, median, p75 = np.percentile(values, [25, 50, 75])
+    return {
+        "count": int(len(values)),
+        "mean": round(float(values.mean()), 4),
+        "std": round(float(values.std()), 4),
+        "min": round(float(values.min()), 4),
+        "p25": round(float(p25), 4),
+        "median": round(float(median), 4),
+        "p75": round(float(p75), 4),
+        "max": round(float(values.max()), 4),
+        "histogram": [
+            {"range": f"{int(edges[index])}-{int(edges[index + 1])}", "count": int(count)}
+            for index, count in enumerate(histogram)
+        ]
+    }
+
+async def backfill_score_aggregates(db: AsyncSession, batch_size: int = 200):
+    # 旧数据没有聚合行，首次启动时为缺失聚合的成果分批补齐；完成后记一笔，之后的新成果在写入时维护聚合，
+    # 没有成果项的成果本就没有聚合行，不必每次启动重新扫描
+    if await db.get(DataMigration, "score_aggregates_backfill"):
+        return
+    last_id = 0
+    while True:
+        achievement_ids = (await db.execute(
+            select(StudentAchievement.id).where(
+                StudentAchievement.id > last_id,
+                ~select(AchievementScoreAggregate.id).where(
+                    AchievementScoreAggregate.achievement_id == StudentAchievement.id
+                ).exists()
+            ).order_by(StudentAchievement.id.asc()).limit(batch_size)
+        )).scalars().all()
+        if not achievement_ids:
+            break
+        await rebuild_score_aggregates(db, achievement_ids)
+        await db.commit()
+        last_id = achievement_ids[-1]
+    db.add(DataMigration(name="score_aggregates_backfill", finish_time=datetime.now()))
+    await db.commit()
+
+async def backfill_achievement_lifecycle_status(db: AsyncSession, batch_size: int = 200):
+    # 旧数据没有流转状态列，启动时分批补齐
+    while True:
+        achievements = (await db.execute(
+            select(StudentAchievement).where(StudentAchievement.lifecycle_status.is_(None)).limit(batch_size)
+        )).scalars().all()
+        if not achievements:
+            break
+        for achievement in achievements:
+            achievement.lifecycle_status = await calculate_achievement_lifecycle_status(db, achievement)
+        await db.commit()
+
+async def load_achievement_type_stamp(db: AsyncSession, achievement_id: int) -> str:
+    # 详情里引用的自定义成果类型（名称、字段、预评分规则）最近一次修改时间
+    latest = await db.scalar(
+        select(func.max(AchievementType.update_time)).where(
+            AchievementType.id.in_(select(CustomAchievement.type_id).where(CustomAchievement.achievement_id == achievement_id))
+        )
+    )
+    return latest.strftime("%Y%m%d%H%M%S%f") if latest else "0"
+
+def build_achievement_etag(achievement: StudentAchievement, type_stamp: str = "0") -> str:
+    # 公式版本参与 ETag：惰性重算分数后无需递增数据版本号；类型修改时间参与 ETag：管理员改类型后详情随之失效
+    return f'"achievement-{achievement.id}-v{achievement.version or 0}-f{achievement.formula_version or 0}-t{type_stamp}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
 
 def parse_suggestion_json(content) -> dict:
     def normalize(data: dict) -> dict:
@@ -844,28 +1669,1280 @@ def parse_suggestion_json(content) -> dict:
                     return normalize(data)
             except Exception:
                 continue
-    left = text_content.find("{")
-    right = text_content.rfind("}")
-    if left >= 0 and right > left:
-        snippet = text_content[left:right + 1]
+    left = text_content.find("{")
+    right = text_content.rfind("}")
+    if left >= 0 and right > left:
+        snippet = text_content[left:right + 1]
+        try:
+            data = json.loads(snippet)
+            if isinstance(data, dict):
+                return normalize(data)
+        except Exception:
+            return {}
+    return {}
+
+# ========== 幂等键（客户端重试去重） ==========
+IDEMPOTENCY_TTL_HOURS = 24
+# 每次写入时顺带清理的过期记录上限，避免单次请求承担大批量删除
+IDEMPOTENCY_PURGE_BATCH = 100
+
+def build_idempotency_request_key(scope: str, idempotency_key: str) -> str:
+    return hashlib.sha256(f"{scope}:{idempotency_key.strip()}".encode("utf-8")).hexdigest()
+
+async def load_idempotent_response(db: AsyncSession, scope: str, idempotency_key: Optional[str]) -> Optional[dict]:
+    if not idempotency_key or not idempotency_key.strip():
+        return None
+    record = await db.get(IdempotencyRecord, build_idempotency_request_key(scope, idempotency_key))
+    if not record or record.expire_time < datetime.now():
+        return None
+    return json.loads(record.response_json)
+
+async def remember_idempotent_response(db: AsyncSession, scope: str, idempotency_key: Optional[str], response: dict):
+    if not idempotency_key or not idempotency_key.strip():
+        return
+    request_key = build_idempotency_request_key(scope, idempotency_key)
+    # 过期记录可能仍占着主键，先删掉再写入
+    expired = await db.get(IdempotencyRecord, request_key)
+    if expired:
+        await db.delete(expired)
+        await db.flush()
+    db.add(IdempotencyRecord(
+        request_key=request_key,
+        response_json=json.dumps(response, ensure_ascii=False),
+        expire_time=datetime.now() + timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+    ))
+    await purge_expired_idempotency_records(db, IDEMPOTENCY_PURGE_BATCH)
+
+async def purge_expired_idempotency_records(db: AsyncSession, limit: Optional[int] = None) -> int:
+    expired_keys = select(IdempotencyRecord.request_key).where(IdempotencyRecord.expire_time < datetime.now())
+    if limit:
+        expired_keys = expired_keys.limit(limit)
+    result = await db.execute(
+        IdempotencyRecord.__table__.delete().where(IdempotencyRecord.request_key.in_(expired_keys))
+    )
+    return result.rowcount or 0
+
+# ========== 列表分页（游标 + 总数缓存） ==========
+# 总数缓存有效期（秒），本进程内的写操作会主动失效
+LIST_COUNT_CACHE_SECONDS = 30
+# 缓存键来自任意筛选条件，按最近使用淘汰，条目数不超过该值
+LIST_COUNT_CACHE_SIZE = 512
+LIST_COUNT_CACHE = OrderedDict()
+
+def encode_page_cursor(create_time: Optional[datetime], item_id: int) -> str:
+    # 时间为空的行只记 ID
+    raw = json.dumps({"t": create_time.isoformat() if create_time else None, "id": item_id})
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_page_cursor(cursor: str):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        return (datetime.fromisoformat(data["t"]) if data["t"] is not None else None), int(data["id"])
+    except Exception:
+        return None
+
+def apply_page_window(query, time_column, id_column, page: int, size: int, cursor_value):
+    # 按 (时间, ID) 倒序；有游标时从游标之后取，走索引定位，不再 OFFSET 扫描。
+    # SQLite 倒序时时间为空的行排在最后，元组比较不会命中它们，需要单独接上
+    query = query.order_by(time_column.desc(), id_column.desc())
+    if cursor_value:
+        cursor_time, cursor_id = cursor_value
+        if cursor_time is None:
+            return query.where(time_column.is_(None), id_column < cursor_id).limit(size)
+        return query.where(or_(
+            tuple_(time_column, id_column) < tuple_(cursor_time, cursor_id),
+            time_column.is_(None)
+        )).limit(size)
+    return query.offset((max(page, 1) - 1) * size).limit(size)
+
+async def count_with_cache(db: AsyncSession, cache_key: str, query) -> int:
+    cached = LIST_COUNT_CACHE.get(cache_key)
+    if cached and cached[1] > time.monotonic():
+        LIST_COUNT_CACHE.move_to_end(cache_key)
+        return cached[0]
+    total = await db.scalar(select(func.count()).select_from(query.subquery()))
+    LIST_COUNT_CACHE[cache_key] = (total, time.monotonic() + LIST_COUNT_CACHE_SECONDS)
+    LIST_COUNT_CACHE.move_to_end(cache_key)
+    while len(LIST_COUNT_CACHE) > LIST_COUNT_CACHE_SIZE:
+        LIST_COUNT_CACHE.popitem(last=False)
+    return total
+
+def invalidate_list_count_cache(prefix: str):
+    for cache_key in [key for key in LIST_COUNT_CACHE if key.startswith(prefix)]:
+        LIST_COUNT_CACHE.pop(cache_key, None)
+
+# ========== 自定义成果规则预评分 ==========
+# 规则表：{"base": 基础分, "min": 下限, "max": 上限, "rules": [规则, ...]}，按顺序执行
+#   map      按字段取值查表加分         {"field", "op": "map", "values": {取值: 分数}, "default": 0}
+#   match    字段取值命中时加分         {"field", "op": "match", "equals": 取值或取值列表, "score": 分数}
+#   per_unit 数值字段每满 unit 加分     {"field", "op": "per_unit", "unit": 1, "score": 分数, "cap": 上限}
+#   factor   按字段取值对当前总分乘系数 {"field", "op": "factor", "values": {取值: 系数}, "default": 1}
+SCORING_RULE_OPS = ["map", "match", "per_unit", "factor"]
+# 编译结果缓存：{(类型ID, 规则版本): 评分函数}
+SCORING_RULE_CACHE = {}
+
+# 默认规则仅作示例，按学院细则通过 /admin/achievement-types/{type_id}/rules 调整
+DEFAULT_SCORING_RULES = {
+    "论文成果": {
+        "base": 0, "min": 0, "max": 100,
+        "rules": [
+            {"field": "level", "op": "map", "values": {"A1": 100, "A2": 90, "B": 80, "C": 70, "D": 60, "E": 50}, "default": 0},
+            {"field": "is_first_org_ccnu_or_econ", "op": "factor", "values": {"否": 0.5}, "default": 1}
+        ]
+    },
+    "智库成果": {
+        "base": 0, "min": 0, "max": 100,
+        "rules": [
+            {"field": "level", "op": "map", "values": {"A1": 100, "A2": 90, "B": 80, "C1": 70, "C2": 60, "其他": 50}, "default": 0}
+        ]
+    },
+    "著作": {
+        "base": 0, "min": 0, "max": 100,
+        "rules": [
+            {"field": "level", "op": "map", "values": {"A": 100, "B": 85, "C": 70, "D": 60}, "default": 0}
+        ]
+    },
+    "参与竞赛获奖": {
+        "base": 0, "min": 0, "max": 100,
+        "rules": [
+            {"field": "award_level", "op": "map", "values": {"国家级": 90, "省级": 75, "校级": 60, "院级": 50}, "default": 0},
+            {"field": "award_name", "op": "factor", "values": {"特等奖": 1.1, "一等奖": 1.0, "二等奖": 0.9, "三等奖": 0.8}, "default": 0.7},
+            {"field": "cooperation_type", "op": "factor", "values": {"多人合作-2人": 0.8, "多人合作-3人及以上": 0.6}, "default": 1}
+        ]
+    },
+    "荣誉表彰": {
+        "base": 0, "min": 0, "max": 100,
+        "rules": [
+            {"field": "level", "op": "map", "values": {"国家级": 90, "省级": 75, "校级": 60, "院级": 50}, "default": 0}
+        ]
+    },
+    "参与志愿服务": {
+        "base": 0, "min": 0, "max": 100,
+        "rules": [
+            {"field": "service_hours", "op": "per_unit", "unit": 1, "score": 1, "cap": 100}
+        ]
+    },
+    "加分项": {
+        "base": 0, "min": 0, "max": 100,
+        "rules": [
+            {"field": "special_case", "op": "match", "equals": "是", "score": 5},
+            {"field": "extra_times", "op": "per_unit", "unit": 1, "score": 5, "cap": 20}
+        ]
+    }
+}
+
+def parse_rule_number(value) -> float:
+    # 兼容 "12"、"12.5小时" 这类带单位的填写
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    matched = re.match(r"\s*(-?\d+(?:\.\d+)?)", str(value or ""))
+    return float(matched.group(1)) if matched else 0.0
+
+def compile_scoring_rules(rules: dict):
+    # 把规则表编译成 (总分, 内容) -> 总分 的步骤序列；规则格式错误抛 ValueError
+    if not isinstance(rules, dict) or not isinstance(rules.get("rules", []), list):
+        raise ValueError("规则格式错误")
+    try:
+        base = float(rules.get("base", 0))
+        lower = float(rules.get("min", 0))
+        upper = float(rules.get("max", 100))
+    except Exception:
+        raise ValueError("base/min/max 必须为数字")
+    steps = []
+    for index, rule in enumerate(rules.get("rules", [])):
+        if not isinstance(rule, dict) or not str(rule.get("field") or "").strip():
+            raise ValueError(f"第{index + 1}条规则缺少字段")
+        field = str(rule["field"]).strip()
+        op = rule.get("op")
+        try:
+            if op in ["map", "factor"]:
+                if not isinstance(rule.get("values"), dict):
+                    raise ValueError
+                table = {str(key).strip(): float(value) for key, value in rule["values"].items()}
+                default = float(rule.get("default", 1 if op == "factor" else 0))
+                if op == "map":
+                    steps.append(lambda total, content, f=field, t=table, d=default: total + t.get(str(content.get(f) or "").strip(), d))
+                else:
+                    steps.append(lambda total, content, f=field, t=table, d=default: total * t.get(str(content.get(f) or "").strip(), d))
+            elif op == "match":
+                equals = rule.get("equals")
+                accepted = {str(value).strip() for value in (equals if isinstance(equals, list) else [equals])}
+                score = float(rule.get("score", 0))
+                steps.append(lambda total, content, f=field, a=accepted, sc=score: total + (sc if str(content.get(f) or "").strip() in a else 0.0))
+            elif op == "per_unit":
+                unit = float(rule.get("unit", 1))
+                score = float(rule.get("score", 0))
+                cap = float(rule["cap"]) if rule.get("cap") is not None else None
+                if unit <= 0:
+                    raise ValueError
+                def per_unit_step(total, content, f=field, u=unit, sc=score, c=cap):
+                    gained = math.floor(parse_rule_number(content.get(f)) / u) * sc
+                    return total + (min(gained, c) if c is not None else gained)
+                steps.append(per_unit_step)
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"第{index + 1}条规则（{field}）配置错误，op 可选：{'/'.join(SCORING_RULE_OPS)}")
+        except Exception:
+            raise ValueError(f"第{index + 1}条规则（{field}）配置错误")
+
+    def evaluate(content: dict) -> float:
+        total = base
+        for step in steps:
+            total = step(total, content)
+        return round(min(max(total, lower), upper), 2)
+    return evaluate
+
+def get_scoring_evaluator(achievement_type: AchievementType):
+    # 规则按 (类型, 版本) 只编译一次；未配置规则或规则无效时返回 None
+    if not achievement_type or not achievement_type.rules_json:
+        return None
+    cache_key = (achievement_type.id, achievement_type.rules_version or 1)
+    if cache_key not in SCORING_RULE_CACHE:
+        try:
+            SCORING_RULE_CACHE[cache_key] = compile_scoring_rules(json.loads(achievement_type.rules_json))
+        except Exception as e:
+            print(f"成果类型{achievement_type.id}预评分规则无效：{str(e)}")
+            SCORING_RULE_CACHE[cache_key] = None
+    return SCORING_RULE_CACHE[cache_key]
+
+# ========== 后台任务（持久化队列 + 工作协程） ==========
+# 每批处理条数，每批单独提交，避免长时间持有写锁
+JOB_CHUNK_SIZE = 100
+# 批次间隔（秒），后台任务让位于在线请求
+JOB_CHUNK_PAUSE_SECONDS = 0.05
+# 空闲时轮询间隔（秒）；本进程入队会立即唤醒
+JOB_POLL_SECONDS = 2
+# 心跳超过该时长视为持有进程已退出，其他进程可接管
+JOB_STALE_SECONDS = 60
+JOB_WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+# 唤醒事件与工作协程在 startup 中随事件循环创建
+JOB_WAKEUP = None
+JOB_WORKER_TASK = None
+
+def wake_job_worker():
+    if JOB_WAKEUP:
+        JOB_WAKEUP.set()
+
+def serialize_job(job: BackgroundJob) -> dict:
+    progress = 100.0 if job.status == "completed" else 0.0
+    if job.total and job.status != "completed":
+        progress = round(min(job.processed or 0, job.total) * 100.0 / job.total, 2)
+    return {
+        "id": job.id,
+        "job_type": job.job_type,
+        "status": job.status,
+        "total": job.total,
+        "processed": job.processed or 0,
+        "progress": progress,
+        "cancel_requested": bool(job.cancel_requested),
+        "error_message": job.error_message,
+        "result": json.loads(job.result_json) if job.result_json else None,
+        "create_time": job.create_time.strftime("%Y-%m-%d %H:%M:%S") if job.create_time else "",
+        "start_time": job.start_time.strftime("%Y-%m-%d %H:%M:%S") if job.start_time else "",
+        "finish_time": job.finish_time.strftime("%Y-%m-%d %H:%M:%S") if job.finish_time else ""
+    }
+
+async def enqueue_job(db: AsyncSession, job_type: str, payload: Optional[dict] = None, supersede: bool = False) -> BackgroundJob:
+    # supersede：同类型未完成的任务会被新任务完整覆盖，直接请求取消
+    if supersede:
+        await db.execute(
+            update(BackgroundJob)
+            .where(BackgroundJob.job_type == job_type, BackgroundJob.status.in_(["pending", "running"]))
+            .values(cancel_requested=True)
+        )
+    job = BackgroundJob(
+        job_type=job_type,
+        status="pending",
+        payload_json=json.dumps(payload or {}, ensure_ascii=False),
+        processed=0,
+        cursor=0,
+        cancel_requested=False,
+        create_time=datetime.now()
+    )
+    db.add(job)
+    await db.flush()
+    return job
+
+def claimable_job_condition(now: datetime):
+    return or_(
+        BackgroundJob.status == "pending",
+        and_(
+            BackgroundJob.status == "running",
+            BackgroundJob.heartbeat_time < now - timedelta(seconds=JOB_STALE_SECONDS)
+        )
+    )
+
+async def claim_next_job(db: AsyncSession) -> Optional[int]:
+    # 多个 uvicorn 进程共用一张表：条件 UPDATE 抢占，影响行数为 1 才算抢到
+    now = datetime.now()
+    candidate_ids = (await db.execute(
+        select(BackgroundJob.id).where(claimable_job_condition(now)).order_by(BackgroundJob.id.asc()).limit(5)
+    )).scalars().all()
+    for job_id in candidate_ids:
+        result = await db.execute(
+            update(BackgroundJob)
+            .where(BackgroundJob.id == job_id, claimable_job_condition(now))
+            .values(
+                status="running",
+                locked_by=JOB_WORKER_ID,
+                heartbeat_time=now,
+                start_time=func.coalesce(BackgroundJob.start_time, now)
+            )
+        )
+        await db.commit()
+        if result.rowcount == 1:
+            return job_id
+    return None
+
+def discard_job_file(payload_json: Optional[str]):
+    # 任务结束后删除随任务上传的临时文件
+    file_path = json.loads(payload_json or "{}").get("file_path")
+    if file_path and os.path.exists(file_path):
+        os.remove(file_path)
+
+async def finish_job(db: AsyncSession, job_id: int, status: str, error_message: Optional[str] = None):
+    payload_json = await db.scalar(select(BackgroundJob.payload_json).where(BackgroundJob.id == job_id))
+    discard_job_file(payload_json)
+    await db.execute(WhitelistImportRow.__table__.delete().where(WhitelistImportRow.job_id == job_id))
+    await db.execute(
+        update(BackgroundJob)
+        .where(BackgroundJob.id == job_id, BackgroundJob.locked_by == JOB_WORKER_ID)
+        .values(status=status, error_message=error_message, finish_time=datetime.now(), heartbeat_time=datetime.now())
+    )
+    await db.commit()
+
+async def run_score_recompute_chunk(db: AsyncSession, job: BackgroundJob) -> bool:
+    # 低优先级清扫：只重算公式版本过期的成果，读取路径已重算过的直接跳过
+    formula = await get_or_init_score_formula(db)
+    stale_condition = or_(
+        StudentAchievement.formula_version.is_(None),
+        StudentAchievement.formula_version != (formula.version or 1)
+    )
+    if job.total is None:
+        job.total = await db.scalar(select(func.count()).select_from(StudentAchievement).where(stale_condition))
+    achievements = (await db.execute(
+        select(StudentAchievement)
+        .where(StudentAchievement.id > (job.cursor or 0), stale_condition)
+        .order_by(StudentAchievement.id.asc())
+        .limit(JOB_CHUNK_SIZE)
+    )).scalars().all()
+    await refresh_stale_achievement_scores(db, achievements)
+    if achievements:
+        job.cursor = achievements[-1].id
+        job.processed = (job.processed or 0) + len(achievements)
+    return len(achievements) < JOB_CHUNK_SIZE
+
+def parse_custom_content(raw_value: Optional[str]) -> Optional[dict]:
+    # 旧数据里可能有非对象或损坏的 JSON，返回 None 由调用方跳过
+    try:
+        data = json.loads(raw_value or "{}")
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+async def run_custom_prescore_chunk(db: AsyncSession, job: BackgroundJob) -> bool:
+    # 预评分：按成果（提交后）或按类型（规则变更后）分批计算 suggested_score，不改动审核分数
+    payload = json.loads(job.payload_json or "{}")
+    result = json.loads(job.result_json) if job.result_json else {"scored": 0, "skipped_invalid": 0}
+    query = select(CustomAchievement).where(CustomAchievement.id > (job.cursor or 0))
+    if payload.get("achievement_id"):
+        query = query.where(CustomAchievement.achievement_id == int(payload["achievement_id"]))
+    if payload.get("type_id"):
+        query = query.where(CustomAchievement.type_id == int(payload["type_id"]))
+    if job.total is None:
+        job.total = await db.scalar(select(func.count()).select_from(query.subquery()))
+    items = (await db.execute(query.order_by(CustomAchievement.id.asc()).limit(JOB_CHUNK_SIZE))).scalars().all()
+    type_map = {
+        item.id: item
+        for item in (await db.execute(
+            select(AchievementType).where(AchievementType.id.in_({custom.type_id for custom in items}))
+        )).scalars().all()
+    }
+    touched_achievement_ids = set()
+    for custom in items:
+        achievement_type = type_map.get(custom.type_id)
+        evaluator = get_scoring_evaluator(achievement_type)
+        content = parse_custom_content(custom.content_json)
+        if content is None:
+            # 内容无法解析为对象：跳过该条并计数，不影响整个任务
+            result["skipped_invalid"] += 1
+            continue
+        suggested = evaluator(content) if evaluator else None
+        result["scored"] += 1
+        rules_version = achievement_type.rules_version if achievement_type else None
+        if custom.suggested_score != suggested or custom.suggested_rules_version != rules_version:
+            custom.suggested_score = suggested
+            custom.suggested_rules_version = rules_version
+            touched_achievement_ids.add(custom.achievement_id)
+    if touched_achievement_ids:
+        # 详情里展示预评分，递增版本号让 ETag 失效
+        await db.execute(
+            update(StudentAchievement)
+            .where(StudentAchievement.id.in_(touched_achievement_ids))
+            .values(version=func.coalesce(StudentAchievement.version, 0) + 1)
+        )
+    job.result_json = json.dumps(result, ensure_ascii=False)
+    if items:
+        job.cursor = items[-1].id
+        job.processed = (job.processed or 0) + len(items)
+    return len(items) < JOB_CHUNK_SIZE
+
+# 白名单导入：每批读取的表格行数
+WHITELIST_IMPORT_CHUNK_SIZE = 100
+WHITELIST_IMPORT_MAX_ERRORS = 200
+WHITELIST_IMPORT_DIR = "./imports"
+
+async def hash_passwords_in_pool(passwords: list) -> list:
+    # 复用密码哈希线程池（bcrypt 释放 GIL，可按线程数并行）；同时在途的导入哈希不超过线程数，
+    # 登录请求仍能在队列里穿插执行
+    slots = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+
+    async def hash_one(password: str) -> str:
+        async with slots:
+            while True:
+                try:
+                    return await run_password_task(hash_password_sync, password, max_pending=PASSWORD_HASH_IMPORT_MAX_PENDING)
+                except PasswordHashBusy:
+                    await asyncio.sleep(PASSWORD_HASH_SECONDS_ESTIMATE)
+
+    return list(await asyncio.gather(*[hash_one(password) for password in passwords]))
+
+def read_whitelist_rows(file_path: str) -> list:
+    # 只读模式从头到尾流式解析一遍，只保留用到的前四列；
+    # 只读模式下按起始行分段读取每次都要从表头重新解析，大表会变成平方级开销
+    workbook = load_workbook(filename=file_path, read_only=True, data_only=True)
+    try:
+        return [
+            (row_index, list(row[:4]))
+            for row_index, row in enumerate(workbook.active.iter_rows(min_row=2, values_only=True), start=2)
+        ]
+    finally:
+        workbook.close()
+
+async def stage_whitelist_rows(db: AsyncSession, job: BackgroundJob, file_path: str):
+    # 任务首批把整张表解析一次写入暂存表，之后每批按行号从暂存表读取；暂存行在任务结束时删除
+    rows = await asyncio.to_thread(read_whitelist_rows, file_path)
+    for offset in range(0, len(rows), 500):
+        await db.execute(sqlite_insert(WhitelistImportRow).values([
+            {"job_id": job.id, "row_index": row_index, "row_json": json.dumps(row, ensure_ascii=False, default=str)}
+            for row_index, row in rows[offset:offset + 500]
+        ]).on_conflict_do_nothing())
+    job.total = len(rows)
+
+def parse_whitelist_row(row_index: int, row, result: dict) -> Optional[dict]:
+    raw_student_id = row[0] if len(row) > 0 else None
+    raw_name = row[1] if len(row) > 1 else None
+    raw_default_password = row[2] if len(row) > 2 else None
+    raw_is_active = row[3] if len(row) > 3 else None
+    student_id = str(raw_student_id or "").strip()
+    name = str(raw_name or "").strip()
+    default_password = str(raw_default_password or "123456").strip()
+    if not student_id and not name:
+        result["skipped"] += 1
+        return None
+    if not student_id or not name:
+        if len(result["errors"]) < WHITELIST_IMPORT_MAX_ERRORS:
+            result["errors"].append({"row": row_index, "message": "学号或姓名为空"})
+        result["error_count"] += 1
+        return None
+    return {
+        "student_id": student_id,
+        "name": name,
+        "default_password": default_password or "123456",
+        "is_active": parse_active_value(raw_is_active)
+    }
+
+def new_whitelist_import_result() -> dict:
+    return {"created": 0, "updated": 0, "password_reset": 0, "unchanged": 0, "skipped": 0, "error_count": 0, "errors": []}
+
+async def classify_whitelist_entries(db: AsyncSession, parsed: dict):
+    # 与库中 name/default_password/is_active 比对，返回 (新增, 变更, 未变)；变更项附带字段差异
+    existing = {
+        student.student_id: student
+        for student in (await db.execute(
+            select(StudentUser).where(StudentUser.student_id.in_(list(parsed)))
+        )).scalars().all()
+    }
+    created, updated, unchanged = [], [], []
+    for student_id, entry in parsed.items():
+        student = existing.get(student_id)
+        if not student:
+            created.append(entry)
+            continue
+        changes = {
+            field: [getattr(student, field), entry[field]]
+            for field in ["name", "default_password", "is_active"]
+            if getattr(student, field) != entry[field]
+        }
+        if not student.is_whitelisted:
+            changes["is_whitelisted"] = [False, True]
+        if changes:
+            updated.append({**entry, "changes": changes})
+        else:
+            unchanged.append(entry)
+    return created, updated, unchanged
+
+async def run_whitelist_import_chunk(db: AsyncSession, job: BackgroundJob) -> bool:
+    payload = json.loads(job.payload_json or "{}")
+    result = json.loads(job.result_json) if job.result_json else new_whitelist_import_result()
+    staged = await db.scalar(select(WhitelistImportRow.job_id).where(WhitelistImportRow.job_id == job.id).limit(1))
+    if staged is None:
+        await stage_whitelist_rows(db, job, payload["file_path"])
+    # cursor 记录已处理到的表格行号，第1行为表头
+    rows = [
+        (row_index, json.loads(row_json))
+        for row_index, row_json in (await db.execute(
+            select(WhitelistImportRow.row_index, WhitelistImportRow.row_json)
+            .where(WhitelistImportRow.job_id == job.id, WhitelistImportRow.row_index > (job.cursor or 1))
+            .order_by(WhitelistImportRow.row_index.asc())
+            .limit(WHITELIST_IMPORT_CHUNK_SIZE)
+        )).all()
+    ]
+    # 同一批内学号重复时以后出现的行为准
+    parsed = {}
+    for row_index, row in rows:
+        entry = parse_whitelist_row(row_index, row, result)
+        if entry:
+            parsed[entry["student_id"]] = entry
+    if parsed:
+        created, updated, unchanged = await classify_whitelist_entries(db, parsed)
+        # 只有新增或默认密码变更的行需要哈希并重置密码；仅姓名/状态变更的行保留学生已改的密码
+        password_entries = created + [entry for entry in updated if "default_password" in entry["changes"]]
+        profile_entries = [entry for entry in updated if "default_password" not in entry["changes"]]
+        now = datetime.now()
+        if password_entries:
+            hashed_passwords = await hash_passwords_in_pool([entry["default_password"] for entry in password_entries])
+            insert_stmt = sqlite_insert(StudentUser).values([
+                {
+                    "student_id": entry["student_id"],
+                    "name": entry["name"],
+                    "password": hashed_password,
+                    "default_password": entry["default_password"],
+                    "is_active": entry["is_active"],
+                    "is_whitelisted": True,
+                    "must_change_password": True,
+                    "create_time": now,
+                    "update_time": now
+                }
+                for entry, hashed_password in zip(password_entries, hashed_passwords)
+            ])
+            await db.execute(insert_stmt.on_conflict_do_update(
+                index_elements=[StudentUser.student_id],
+                set_={
+                    "name": insert_stmt.excluded.name,
+                    "password": insert_stmt.excluded.password,
+                    "default_password": insert_stmt.excluded.default_password,
+                    "is_active": insert_stmt.excluded.is_active,
+                    "is_whitelisted": True,
+                    "must_change_password": True,
+                    "update_time": insert_stmt.excluded.update_time
+                }
+            ))
+        if profile_entries:
+            student_table = StudentUser.__table__
+            await db.execute(
+                student_table.update()
+                .where(student_table.c.student_id == bindparam("match_student_id"))
+                .values(
+                    name=bindparam("new_name"),
+                    is_active=bindparam("new_is_active"),
+                    is_whitelisted=True,
+                    update_time=now
+                ),
+                [
+                    {"match_student_id": entry["student_id"], "new_name": entry["name"], "new_is_active": entry["is_active"]}
+                    for entry in profile_entries
+                ]
+            )
+        for entry in updated:
+            if entry["changes"].get("is_active") == [True, False]:
+                await revoke_student_refresh_tokens(db, student_id=entry["student_id"])
+        result["created"] += len(created)
+        result["updated"] += len(updated)
+        result["password_reset"] += len(password_entries) - len(created)
+        result["unchanged"] += len(unchanged)
+        if updated:
+            await bump_auth_epoch(db)
+            for entry in updated:
+                invalidate_student_principal(entry["student_id"])
+        if created or updated:
+            invalidate_list_count_cache("whitelist")
+    if rows:
+        job.cursor = rows[-1][0]
+        job.processed = (job.processed or 0) + len(rows)
+    job.result_json = json.dumps(result, ensure_ascii=False)
+    return len(rows) < WHITELIST_IMPORT_CHUNK_SIZE
+
+async def preview_whitelist_import(db: AsyncSession, file_path: str) -> dict:
+    # 试运行：只读取和比对，不做哈希也不写库
+    result = new_whitelist_import_result()
+    diff = {"created": [], "updated": [], "unchanged": []}
+    all_rows = await asyncio.to_thread(read_whitelist_rows, file_path)
+    for offset in range(0, len(all_rows), WHITELIST_IMPORT_CHUNK_SIZE):
+        rows = all_rows[offset:offset + WHITELIST_IMPORT_CHUNK_SIZE]
+        parsed = {}
+        for row_index, row in rows:
+            entry = parse_whitelist_row(row_index, row, result)
+            if entry:
+                parsed[entry["student_id"]] = entry
+        if parsed:
+            created, updated, unchanged = await classify_whitelist_entries(db, parsed)
+            diff["created"].extend({"student_id": entry["student_id"], "name": entry["name"]} for entry in created)
+            diff["updated"].extend({"student_id": entry["student_id"], "changes": entry["changes"]} for entry in updated)
+            diff["unchanged"].extend(entry["student_id"] for entry in unchanged)
+    result["created"] = len(diff["created"])
+    result["updated"] = len(diff["updated"])
+    result["password_reset"] = len([entry for entry in diff["updated"] if "default_password" in entry["changes"]])
+    result["unchanged"] = len(diff["unchanged"])
+    return {**result, "diff": diff}
+
+def legacy_document_condition():
+    # 附件路径不在内容寻址存储里，即迁移前的 uuid 文件
+    return AchievementDocument.file_path.not_in(select(UploadBlob.file_path))
+
+async def run_upload_dedupe_chunk(db: AsyncSession, job: BackgroundJob) -> bool:
+    # 存量文件迁移：按附件分批计算哈希，重复内容只保留一份，旧文件名改为指向同一份数据的硬链接，未提交的旧路径依然可用
+    if job.total is None:
+        job.total = await db.scalar(select(func.count()).select_from(AchievementDocument).where(legacy_document_condition()))
+    result = json.loads(job.result_json) if job.result_json else {
+        "migrated_files": 0,
+        "deduplicated_files": 0,
+        "missing_files": 0,
+        "saved_bytes": 0
+    }
+    rows = (await db.execute(
+        select(AchievementDocument.id, AchievementDocument.file_path, AchievementDocument.mime_type)
+        .where(AchievementDocument.id > (job.cursor or 0), legacy_document_condition())
+        .order_by(AchievementDocument.id.asc())
+        .limit(JOB_CHUNK_SIZE)
+    )).all()
+    processed = 0
+    for file_path, mime_type in dict((row.file_path, row.mime_type) for row in rows).items():
+        local_path = await asyncio.to_thread(resolve_upload_path, file_path)
+        if not local_path:
+            result["missing_files"] += 1
+            processed += len([row for row in rows if row.file_path == file_path])
+            continue
+        digest, file_size = await asyncio.to_thread(hash_upload_file, local_path)
+        blob = await db.scalar(select(UploadBlob).where(UploadBlob.sha256 == digest))
+        blob_name = blob.file_path if blob else build_blob_name(digest, os.path.splitext(file_path)[1])
+        blob_path = await asyncio.to_thread(resolve_upload_path, blob_name)
+        if not blob_path:
+            blob_path = await asyncio.to_thread(ensure_upload_shard, blob_name)
+            await asyncio.to_thread(link_upload_file, local_path, blob_path)
+        elif not os.path.samefile(local_path, blob_path):
+            if await asyncio.to_thread(link_upload_file, blob_path, local_path):
+                result["deduplicated_files"] += 1
+                result["saved_bytes"] += file_size
+        if not blob:
+            blob = await get_or_create_blob(db, digest, blob_name, file_size, mime_type)
+        moved = await db.execute(
+            update(AchievementDocument).where(AchievementDocument.file_path == file_path).values(file_path=blob.file_path)
+        )
+        blob.ref_count = (blob.ref_count or 0) + moved.rowcount
+        result["migrated_files"] += 1
+        processed += moved.rowcount
+    job.result_json = json.dumps(result, ensure_ascii=False)
+    if rows:
+        job.cursor = rows[-1].id
+        job.processed = (job.processed or 0) + processed
+    return len(rows) < JOB_CHUNK_SIZE
+
+async def run_upload_shard_chunk(db: AsyncSession, job: BackgroundJob) -> bool:
+    # 在线迁移：每批把一部分平铺文件移入分片目录，移走的文件不再出现在列表里，因此不需要游标
+    if job.total is None:
+        job.total = len(await asyncio.to_thread(list_flat_uploads))
+    names = await asyncio.to_thread(list_flat_uploads, UPLOAD_SHARD_BATCH_SIZE)
+    moved = await asyncio.to_thread(move_flat_uploads, names)
+    job.processed = (job.processed or 0) + moved
+    return len(names) < UPLOAD_SHARD_BATCH_SIZE
+
+# 上传后一直没有被提交引用的文件，保留这么久后回收（需长于幂等记录的有效期）
+UPLOAD_GC_GRACE_HOURS = int(os.getenv("UPLOAD_GC_GRACE_HOURS", 7 * 24))
+# 两次自动回收之间的最短间隔
+UPLOAD_GC_INTERVAL_HOURS = 24
+
+async def run_upload_gc_chunk(db: AsyncSession, job: BackgroundJob) -> bool:
+    # 按附件表（含旧的图片表）重新计算引用数；引用为 0 且超过保留期的文件连同记录一起删除。
+    # 保留期从首次上传和最近一次去重命中/秒传确认中较晚的时间起算，客户端拿到已有文件路径后有足够时间提交
+    if job.total is None:
+        job.total = await db.scalar(select(func.count()).select_from(UploadBlob))
+    result = json.loads(job.result_json) if job.result_json else {"recounted": 0, "collected": 0, "freed_bytes": 0}
+    blobs = (await db.execute(
+        select(UploadBlob).where(UploadBlob.id > (job.cursor or 0)).order_by(UploadBlob.id.asc()).limit(JOB_CHUNK_SIZE)
+    )).scalars().all()
+    file_paths = [blob.file_path for blob in blobs]
+    reference_counts = {}
+    for model in [AchievementDocument, AchievementImage]:
+        for file_path, count in (await db.execute(
+            select(model.file_path, func.count()).where(model.file_path.in_(file_paths)).group_by(model.file_path)
+        )).all():
+            reference_counts[file_path] = reference_counts.get(file_path, 0) + count
+    expire_before = datetime.now() - timedelta(hours=UPLOAD_GC_GRACE_HOURS)
+    for blob in blobs:
+        references = reference_counts.get(blob.file_path, 0)
+        last_used_time = max([item for item in [blob.create_time, blob.last_seen_time] if item], default=None)
+        if references == 0 and last_used_time and last_used_time < expire_before:
+            # 删除语句里再确认一次无引用且未被刷新：语句执行即拿到写锁，提交前不会有新附件挂上来
+            deleted = await db.execute(
+                UploadBlob.__table__.delete().where(
+                    UploadBlob.id == blob.id,
+                    UploadBlob.create_time < expire_before,
+                    func.coalesce(UploadBlob.last_seen_time, UploadBlob.create_time) < expire_before,
+                    ~select(AchievementDocument.id).where(AchievementDocument.file_path == blob.file_path).exists(),
+                    ~select(AchievementImage.id).where(AchievementImage.file_path == blob.file_path).exists()
+                )
+            )
+            if deleted.rowcount:
+                blob_path = await asyncio.to_thread(resolve_upload_path, blob.file_path)
+                if blob_path:
+                    await asyncio.to_thread(os.remove, blob_path)
+                result["collected"] += 1
+                result["freed_bytes"] += blob.file_size or 0
+                continue
+        if blob.ref_count != references:
+            blob.ref_count = references
+            result["recounted"] += 1
+    job.result_json = json.dumps(result, ensure_ascii=False)
+    if blobs:
+        job.cursor = blobs[-1].id
+        job.processed = (job.processed or 0) + len(blobs)
+    return len(blobs) < JOB_CHUNK_SIZE
+
+JOB_HANDLERS = {
+    "score_recompute": run_score_recompute_chunk,
+    "custom_prescore": run_custom_prescore_chunk,
+    "whitelist_import": run_whitelist_import_chunk,
+    "upload_dedupe": run_upload_dedupe_chunk,
+    "upload_shard": run_upload_shard_chunk,
+    "upload_gc": run_upload_gc_chunk
+}
+
+async def run_job(job_id: int):
+    while True:
+        async with AsyncSessionLocal() as db:
+            job = await db.get(BackgroundJob, job_id)
+            if not job or job.locked_by != JOB_WORKER_ID or job.status != "running":
+                return
+            if job.cancel_requested:
+                await finish_job(db, job_id, "cancelled")
+                return
+            handler = JOB_HANDLERS.get(job.job_type)
+            if not handler:
+                await finish_job(db, job_id, "failed", f"未知任务类型：{job.job_type}")
+                return
+            try:
+                done = await handler(db, job)
+                job.heartbeat_time = datetime.now()
+                await db.flush()
+                # 进度与本批业务数据同一事务提交；任务已被其他进程接管则整批回滚
+                owned = await db.scalar(
+                    select(func.count()).select_from(BackgroundJob)
+                    .where(BackgroundJob.id == job_id, BackgroundJob.locked_by == JOB_WORKER_ID)
+                )
+                if not owned:
+                    await db.rollback()
+                    return
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                print(f"后台任务{job_id}执行失败：{str(e)}")
+                await finish_job(db, job_id, "failed", str(e)[:500])
+                return
+            if done:
+                await finish_job(db, job_id, "completed")
+                return
+        # 批次之间暂停片刻，让在线请求优先拿到写锁
+        await asyncio.sleep(JOB_CHUNK_PAUSE_SECONDS)
+
+async def job_worker_loop():
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                job_id = await claim_next_job(db)
+            if job_id:
+                await run_job(job_id)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"后台任务轮询失败：{str(e)}")
+        JOB_WAKEUP.clear()
         try:
-            data = json.loads(snippet)
-            if isinstance(data, dict):
-                return normalize(data)
-        except Exception:
-            return {}
-    return {}
+            await asyncio.wait_for(JOB_WAKEUP.wait(), timeout=JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
 
 # ========== JWT 配置（登录Token） ==========
 SECRET_KEY = "your-secret-key-20260221"  # 替换为随机字符串（建议用：openssl rand -hex 32）
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 120  # Token有效期2小时
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/student/login")
+# 刷新令牌：不透明随机串，库里只存 SHA-256；每次刷新轮换，旧令牌再次使用视为泄露并吊销整个令牌族
+REFRESH_TOKEN_EXPIRE_DAYS = 30
+
+def build_refresh_token_hash(refresh_token: str) -> str:
+    return hashlib.sha256(refresh_token.strip().encode("utf-8")).hexdigest()
+
+def create_student_access_token(student: StudentUser) -> str:
+    return jwt.encode(
+        {
+            "sub": student.student_id,
+            "name": student.name,
+            "exp": datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        },
+        SECRET_KEY,
+        algorithm=ALGORITHM
+    )
+
+async def issue_refresh_token(db: AsyncSession, student_id: str, family_id: Optional[str] = None) -> str:
+    refresh_token = secrets.token_urlsafe(32)
+    now = datetime.now()
+    # 顺带清理该学生已过期的令牌
+    await db.execute(
+        StudentRefreshToken.__table__.delete().where(
+            StudentRefreshToken.student_id == student_id,
+            StudentRefreshToken.expire_time < now
+        )
+    )
+    db.add(StudentRefreshToken(
+        token_hash=build_refresh_token_hash(refresh_token),
+        student_id=student_id,
+        family_id=family_id or uuid.uuid4().hex,
+        expire_time=now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        create_time=now
+    ))
+    return refresh_token
+
+async def revoke_student_refresh_tokens(db: AsyncSession, student_id: Optional[str] = None, family_id: Optional[str] = None):
+    conditions = [StudentRefreshToken.revoked_time.is_(None)]
+    if student_id:
+        conditions.append(StudentRefreshToken.student_id == student_id)
+    if family_id:
+        conditions.append(StudentRefreshToken.family_id == family_id)
+    await db.execute(update(StudentRefreshToken).where(*conditions).values(revoked_time=datetime.now()))
 # ========== 图片上传配置 ==========
 # 上传目录（确保存在）
 UPLOAD_DIR = "./uploads"
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
+# 单个文件大小上限与允许的后缀（扫描件按 10MB 放宽）
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 10 * 1024 * 1024))
+ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "bmp", "webp", "pdf", "doc", "docx"}
+# 流式写盘的分块大小，每个上传占用的内存以此为上限
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# multipart 边界和表单字段的额外开销
+UPLOAD_MULTIPART_OVERHEAD = 64 * 1024
+UPLOAD_PATHS = {"/upload/document", "/upload/image"}
+
+class UploadRejected(Exception):
+    pass
+
+def write_upload_chunk(buffer, digest, chunk: bytes):
+    buffer.write(chunk)
+    digest.update(chunk)
+
+async def stream_upload_to_temp(file: UploadFile):
+    # 分块读取、线程中写临时文件并顺带计算 SHA-256，超限立即中止并删除临时文件
+    temp_path = os.path.join(UPLOAD_DIR, f".tmp-{uuid.uuid4().hex}")
+    written = 0
+    digest = hashlib.sha256()
+    buffer = await asyncio.to_thread(open, temp_path, "wb")
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > MAX_FILE_SIZE:
+                raise UploadRejected(f"文件大小不能超过{MAX_FILE_SIZE // (1024 * 1024)}MB")
+            await asyncio.to_thread(write_upload_chunk, buffer, digest, chunk)
+        await asyncio.to_thread(buffer.close)
+        return temp_path, written, digest.hexdigest()
+    except BaseException:
+        buffer.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# ========== 分片目录 ==========
+# 文件按文件名的 SHA-256 前两级（各两位十六进制）分到 uploads/ab/cd/ 下，单个目录的文件数保持在几十个以内；
+# 数据库里仍只存文件名，实际位置由文件名推出，迁移前的平铺文件继续可用
+UPLOAD_SHARD_BATCH_SIZE = 200
+
+def shard_upload_path(file_name: str) -> str:
+    name_hash = hashlib.sha256(file_name.encode("utf-8")).hexdigest()
+    return os.path.join(UPLOAD_DIR, name_hash[:2], name_hash[2:4], file_name)
+
+def ensure_upload_shard(file_name: str) -> str:
+    target_path = shard_upload_path(file_name)
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    return target_path
+
+def resolve_upload_path(file_name: str) -> Optional[str]:
+    # 先查分片位置，再查旧的平铺位置；最后再查一次分片，覆盖查找期间恰好被迁移的文件
+    if not file_name or os.path.basename(file_name) != file_name or file_name.startswith("."):
+        return None
+    sharded_path = shard_upload_path(file_name)
+    for candidate in [sharded_path, os.path.join(UPLOAD_DIR, file_name), sharded_path]:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+def list_flat_uploads(limit: Optional[int] = None) -> list:
+    names = []
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            names.append(entry.name)
+            if limit and len(names) >= limit:
+                break
+    return names
+
+def move_flat_uploads(names: list) -> int:
+    # 原子改名到分片目录；分片里已有同名文件（新上传的相同内容）时删除平铺副本
+    moved = 0
+    for name in names:
+        flat_path = os.path.join(UPLOAD_DIR, name)
+        target_path = ensure_upload_shard(name)
+        try:
+            if os.path.exists(target_path):
+                os.remove(flat_path)
+            else:
+                os.replace(flat_path, target_path)
+            moved += 1
+        except FileNotFoundError:
+            continue
+    return moved
+
+# ========== 内容寻址存储 ==========
+# 文件按内容 SHA-256 命名，相同内容只存一份；upload_blob.ref_count 在提交附件时累加，
+# upload_gc 任务按附件表重新计数，并回收超过保留期仍无人引用的文件
+def build_blob_name(digest: str, ext: str) -> str:
+    return f"{digest}{ext.lower()}"
+
+def hash_upload_file(file_path: str):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest(), os.path.getsize(file_path)
+
+def link_upload_file(source_path: str, target_path: str) -> bool:
+    # 原子地让 target 指向 source 的同一份数据；文件系统不支持硬链接时退回复制，返回是否共享了存储
+    temp_path = os.path.join(os.path.dirname(target_path), f".tmp-{uuid.uuid4().hex}")
+    try:
+        os.link(source_path, temp_path)
+        linked = True
+    except OSError:
+        shutil.copy2(source_path, temp_path)
+        linked = False
+    os.replace(temp_path, target_path)
+    return linked
+
+async def get_or_create_blob(db: AsyncSession, digest: str, file_name: str, file_size: int, mime_type: Optional[str]) -> UploadBlob:
+    # 并发上传同一内容时只插入一行
+    await db.execute(
+        sqlite_insert(UploadBlob.__table__)
+        .values(sha256=digest, file_path=file_name, file_size=file_size, mime_type=mime_type or "", ref_count=0, create_time=datetime.now())
+        .on_conflict_do_nothing(index_elements=["sha256"])
+    )
+    return await db.scalar(select(UploadBlob).where(UploadBlob.sha256 == digest))
+
+async def touch_upload_blob(db: AsyncSession, blob_id: int) -> bool:
+    # 去重命中/秒传确认时刷新最近使用时间，回收任务的保留期重新起算；返回 False 表示记录已被回收
+    touched = await db.execute(
+        UploadBlob.__table__.update().where(UploadBlob.__table__.c.id == blob_id).values(last_seen_time=datetime.now())
+    )
+    return touched.rowcount > 0
+
+async def store_upload_blob(db: AsyncSession, temp_path: str, file_size: int, digest: str, ext: str, mime_type: str) -> tuple:
+    # 已有相同内容：丢弃临时文件；否则原子改名为内容哈希文件名。返回 (blob, 是否已存在)
+    blob = await db.scalar(select(UploadBlob).where(UploadBlob.sha256 == digest))
+    blob_name = blob.file_path if blob else build_blob_name(digest, ext)
+    exists = blob is not None and await asyncio.to_thread(resolve_upload_path, blob_name) is not None
+    if exists and await touch_upload_blob(db, blob.id):
+        await asyncio.to_thread(os.remove, temp_path)
+        return blob, True
+    if exists:
+        # 刚被回收任务删除：按新文件重新落盘
+        blob = None
+        blob_name = build_blob_name(digest, ext)
+    blob_path = await asyncio.to_thread(ensure_upload_shard, blob_name)
+    await asyncio.to_thread(os.replace, temp_path, blob_path)
+    if not blob:
+        blob = await get_or_create_blob(db, digest, blob_name, file_size, mime_type)
+    return blob, False
+
+async def add_blob_references(db: AsyncSession, file_paths: list):
+    # 同一文件可能被多个成果项引用，按出现次数累加
+    counts = {}
+    for file_path in file_paths:
+        counts[file_path] = counts.get(file_path, 0) + 1
+    if not counts:
+        return
+    await db.execute(
+        UploadBlob.__table__.update()
+        .where(UploadBlob.__table__.c.file_path == bindparam("b_file_path"))
+        .values(ref_count=UploadBlob.__table__.c.ref_count + bindparam("b_count")),
+        [{"b_file_path": file_path, "b_count": count} for file_path, count in counts.items()]
+    )
+
+def build_upload_result(blob: UploadBlob, original_name: str, content_type: str, exists: bool) -> dict:
+    return {
+        "success": True,
+        "file_name": original_name,
+        "stored_name": blob.file_path,
+        "file_path": blob.file_path,
+        "file_ext": os.path.splitext(original_name)[1].replace(".", "").lower(),
+        "mime_type": content_type,
+        "sha256": blob.sha256,
+        "exists": exists,
+        "message": "文件已存在，无需重复上传" if exists else "文件上传成功"
+    }
+
+# ========== 缩略图缓存 ==========
+# 证明材料图片按需生成缩小的 WebP/JPEG 预览，缓存在磁盘上，总大小超限时按最近访问时间淘汰
+THUMBNAIL_DIR = "./thumbnails"
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# 只生成固定几档宽度，请求的宽度向上取整到最近一档，避免缓存被任意尺寸撑满
+THUMBNAIL_WIDTHS = [160, 320, 640, 1280]
+THUMBNAIL_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg")
+}
+THUMBNAIL_SOURCE_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "bmp", "webp"}
+THUMBNAIL_QUALITY = 80
+# 进程内的 LRU 索引：缓存文件路径 -> 大小，首次使用时扫描缓存目录重建
+THUMBNAIL_INDEX = None
+THUMBNAIL_INDEX_BYTES = 0
+THUMBNAIL_INDEX_LOCK = threading.Lock()
+THUMBNAIL_LOCKS = {}
+
+def is_thumbnail_source(file_name: str) -> bool:
+    return os.path.splitext(file_name)[1].replace(".", "").lower() in THUMBNAIL_SOURCE_EXTENSIONS
+
+def build_thumbnail_url(file_name: str, width: int) -> Optional[str]:
+    if not is_thumbnail_source(file_name):
+        return None
+    return f"/uploads/{file_name}?w={width}&fmt=webp"
+
+def pick_thumbnail_width(width: int) -> int:
+    for candidate in THUMBNAIL_WIDTHS:
+        if width <= candidate:
+            return candidate
+    return THUMBNAIL_WIDTHS[-1]
+
+def load_thumbnail_index():
+    # 按修改时间（命中时会刷新）从旧到新排列
+    global THUMBNAIL_INDEX, THUMBNAIL_INDEX_BYTES
+    entries = []
+    if os.path.exists(THUMBNAIL_DIR):
+        for root, _, files in os.walk(THUMBNAIL_DIR):
+            for name in files:
+                if name.startswith("."):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, path, stat.st_size))
+    THUMBNAIL_INDEX = OrderedDict((path, size) for _, path, size in sorted(entries))
+    THUMBNAIL_INDEX_BYTES = sum(THUMBNAIL_INDEX.values())
+
+def touch_thumbnail(path: str) -> bool:
+    # 命中时刷新修改时间并移到 LRU 末尾；索引在线程池里被并发访问，统一加锁
+    with THUMBNAIL_INDEX_LOCK:
+        if THUMBNAIL_INDEX is None:
+            load_thumbnail_index()
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # 已被其他进程淘汰
+            forget_thumbnail(path)
+            return False
+        if path in THUMBNAIL_INDEX:
+            THUMBNAIL_INDEX.move_to_end(path)
+        else:
+            add_thumbnail(path, os.path.getsize(path))
+        return True
+
+def forget_thumbnail(path: str):
+    global THUMBNAIL_INDEX_BYTES
+    if path in THUMBNAIL_INDEX:
+        THUMBNAIL_INDEX_BYTES -= THUMBNAIL_INDEX.pop(path)
+
+def remember_thumbnail(path: str, size: int):
+    with THUMBNAIL_INDEX_LOCK:
+        if THUMBNAIL_INDEX is None:
+            load_thumbnail_index()
+        add_thumbnail(path, size)
+
+def add_thumbnail(path: str, size: int):
+    global THUMBNAIL_INDEX_BYTES
+    forget_thumbnail(path)
+    THUMBNAIL_INDEX[path] = size
+    THUMBNAIL_INDEX_BYTES += size
+    while THUMBNAIL_INDEX_BYTES > THUMBNAIL_CACHE_MAX_BYTES and len(THUMBNAIL_INDEX) > 1:
+        oldest_path, oldest_size = THUMBNAIL_INDEX.popitem(last=False)
+        THUMBNAIL_INDEX_BYTES -= oldest_size
+        try:
+            os.remove(oldest_path)
+        except FileNotFoundError:
+            pass
+
+def render_thumbnail(source_path: str, target_path: str, width: int, image_format: str) -> int:
+    # 只缩小不放大；按 EXIF 方向摆正；JPEG 不支持透明通道，透明部分铺白底
+    with Image.open(source_path) as image:
+        image.draft("RGB", (width, width * 4))
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        if image_format == "JPEG":
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(target_path), f".tmp-{uuid.uuid4().hex}")
+        try:
+            image.save(temp_path, format=image_format, quality=THUMBNAIL_QUALITY)
+            os.replace(temp_path, target_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return os.path.getsize(target_path)
+
+async def get_thumbnail(file_name: str, source_path: str, width: int, fmt: str) -> tuple:
+    # 返回 (缓存文件路径, 缓存键)；同一缩略图的并发请求只生成一次
+    image_format = THUMBNAIL_FORMATS[fmt][0]
+    cache_key = hashlib.sha256(f"{file_name}:{width}:{image_format}".encode("utf-8")).hexdigest()
+    target_path = os.path.join(THUMBNAIL_DIR, cache_key[:2], f"{cache_key}.{image_format.lower()}")
+    # 锁带引用计数：获取前加一、结束后减一，归零才移除，等待中的请求始终和持有者用同一把锁；
+    # 字典大小只与正在处理的缩略图数量有关
+    entry = THUMBNAIL_LOCKS.get(cache_key)
+    if entry is None:
+        entry = THUMBNAIL_LOCKS[cache_key] = {"lock": asyncio.Lock(), "users": 0}
+    entry["users"] += 1
+    try:
+        async with entry["lock"]:
+            if not await asyncio.to_thread(touch_thumbnail, target_path):
+                size = await asyncio.to_thread(render_thumbnail, source_path, target_path, width, image_format)
+                await asyncio.to_thread(remember_thumbnail, target_path, size)
+    finally:
+        entry["users"] -= 1
+        if entry["users"] == 0:
+            THUMBNAIL_LOCKS.pop(cache_key, None)
+    return target_path, cache_key
+
+# ========== 静态文件响应 ==========
+# 上传文件名（内容哈希或 uuid）一旦生成就不会再指向别的内容，浏览器可以永久缓存
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 交给前置 nginx 发送文件：nginx 模式返回 X-Accel-Redirect（需配置 internal 的 location 指向上传目录），
+# sendfile 模式返回 X-Sendfile（Apache/lighttpd）；留空则由 Python 进程自己发送
+UPLOAD_ACCEL_MODE = os.getenv("UPLOAD_ACCEL_MODE", "").strip().lower()
+UPLOAD_ACCEL_PREFIX = os.getenv("UPLOAD_ACCEL_PREFIX", "/protected-uploads/")
+CONTENT_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}")
+
+def build_upload_etag(file_name: str, stat_result: os.stat_result) -> str:
+    # 内容寻址的文件直接用内容哈希；旧文件用大小和修改时间（文件不会被改写，同样是强校验）
+    content_hash = CONTENT_HASH_PATTERN.match(file_name)
+    if content_hash:
+        return f'"{content_hash.group(0)}"'
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+def is_not_modified(request: Request, etag: str, stat_result: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        candidates = [item.strip() for item in if_none_match.split(",")]
+        return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def parse_byte_range(range_header: str, file_size: int) -> Optional[tuple]:
+    # 只支持单个区间；返回 (start, end)，区间不可满足时抛 ValueError，多区间或格式不认识时返回 None（按整文件返回）
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    start_text, _, end_text = [part.strip() for part in ranges.strip().partition("-")]
+    if not (start_text.isdigit() or end_text.isdigit()) or (start_text and not start_text.isdigit()) or (end_text and not end_text.isdigit()):
+        return None
+    if start_text == "":
+        suffix_length = int(end_text)
+        if suffix_length == 0:
+            raise ValueError("空区间")
+        return max(0, file_size - suffix_length), file_size - 1
+    start = int(start_text)
+    end = int(end_text) if end_text else file_size - 1
+    if start >= file_size or end < start:
+        raise ValueError("区间超出文件范围")
+    return start, min(end, file_size - 1)
+
+def iter_file_range(file_path: str, start: int, end: int):
+    # 同步生成器，StreamingResponse 会放到线程池里迭代
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def build_accel_headers(file_path: str) -> dict:
+    if UPLOAD_ACCEL_MODE == "nginx":
+        relative_path = os.path.relpath(file_path, UPLOAD_DIR).replace(os.sep, "/")
+        return {"X-Accel-Redirect": UPLOAD_ACCEL_PREFIX.rstrip("/") + "/" + relative_path}
+    if UPLOAD_ACCEL_MODE == "sendfile":
+        return {"X-Sendfile": os.path.abspath(file_path)}
+    return {}
+
+async def serve_static_file(request: Request, file_path: str, etag: Optional[str] = None, media_type: Optional[str] = None, accel: bool = False):
+    # 不可变文件的统一出口：长期缓存头、强 ETag、条件请求 304、单区间 Range 206
+    stat_result = await asyncio.to_thread(os.stat, file_path)
+    etag = etag or build_upload_etag(os.path.basename(file_path), stat_result)
+    media_type = media_type or mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    headers = {
+        "Cache-Control": STATIC_CACHE_CONTROL,
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes"
+    }
+    if is_not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+    accel_headers = build_accel_headers(file_path) if accel else {}
+    if accel_headers:
+        # 前置服务器自己处理 Range 和发送，这里只返回头
+        return Response(status_code=200, headers={**headers, **accel_headers}, media_type=media_type)
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() in [etag, headers["Last-Modified"]]):
+        try:
+            byte_range = parse_byte_range(range_header, stat_result.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat_result.st_size}"})
+        if byte_range:
+            start, end = byte_range
+            headers.update({
+                "Content-Range": f"bytes {start}-{end}/{stat_result.st_size}",
+                "Content-Length": str(end - start + 1)
+            })
+            if request.method == "HEAD":
+                return Response(status_code=206, headers=headers, media_type=media_type)
+            return StreamingResponse(iter_file_range(file_path, start, end), status_code=206, headers=headers, media_type=media_type)
+    return FileResponse(file_path, headers=headers, media_type=media_type, stat_result=stat_result, method=request.method)
 
 # ========== 接口定义 ==========
 # 1. 测试接口
@@ -879,31 +2956,31 @@ async def student_register(
     name: str = Body(...),
     student_id: str = Body(...),
     password: str = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        existing_student = db.query(StudentUser).filter(StudentUser.student_id == student_id).first()
+        existing_student = (await db.execute(select(StudentUser).where(StudentUser.student_id == student_id))).scalars().first()
         if not existing_student or not existing_student.is_whitelisted:
             return {
                 "success": False,
                 "message": "该学号不在白名单，请联系管理员"
             }
-        password_bytes = password.encode('utf-8')
-        salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(password_bytes, salt).decode('utf-8')
+        hashed_password = await hash_password(password)
         existing_student.name = name or existing_student.name
         existing_student.password = hashed_password
         existing_student.is_active = True
         existing_student.must_change_password = False
         existing_student.update_time = datetime.now()
-        db.commit()
+        await db.commit()
         return {
             "success": True,
             "message": "账号开通成功，请登录",
             "student_id": student_id
         }
+    except PasswordHashBusy:
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"注册失败：{str(e)}")
         return {
             "success": False,
@@ -915,45 +2992,40 @@ async def student_register(
 async def student_login(
     student_id: str = Body(...),
     password: str = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        student = db.query(StudentUser).filter(
+        student = (await db.execute(select(StudentUser).where(
             StudentUser.student_id == student_id,
             StudentUser.is_whitelisted == True,
             StudentUser.is_active == True
-        ).first()
+        ))).scalars().first()
         if not student:
             return {
                 "success": False,
                 "message": "账号不存在、未启用或不在白名单"
             }
-        password_bytes = password.encode('utf-8')
-        hashed_password_bytes = student.password.encode('utf-8')
-        if not bcrypt.checkpw(password_bytes, hashed_password_bytes):
+        if not await verify_password(password, student.password):
             return {
                 "success": False,
                 "message": "密码错误"
             }
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = jwt.encode(
-            {
-                "sub": student.student_id,
-                "name": student.name,
-                "exp": datetime.utcnow() + access_token_expires
-            },
-            SECRET_KEY,
-            algorithm=ALGORITHM
-        )
+        access_token = create_student_access_token(student)
+        refresh_token = await issue_refresh_token(db, student.student_id)
+        await db.commit()
         
         return {
             "success": True,
             "message": "登录成功",
             "token": access_token,
+            "refresh_token": refresh_token,
+            "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
             "student_id": student.student_id,
             "name": student.name,
             "must_change_password": bool(student.must_change_password)
         }
+    except PasswordHashBusy:
+        raise
     except Exception as e:
         print(f"登录失败：{str(e)}")
         return {
@@ -961,27 +3033,84 @@ async def student_login(
             "message": f"登录失败：{str(e)}"
         }
 
+@app.post("/student/token/refresh")
+async def refresh_student_token(
+    refresh_token: str = Body(..., embed=True),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # 凭刷新令牌换发新的访问令牌，只做一次 SHA-256 查找，不经过 bcrypt
+    record = (await db.execute(select(StudentRefreshToken).where(
+        StudentRefreshToken.token_hash == build_refresh_token_hash(refresh_token)
+    ))).scalars().first()
+    if not record or record.expire_time < datetime.now():
+        return {
+            "success": False,
+            "message": "登录已过期，请重新登录"
+        }
+    if record.revoked_time:
+        # 已轮换或已吊销的令牌被再次使用，可能已泄露：作废同族全部令牌
+        await revoke_student_refresh_tokens(db, family_id=record.family_id)
+        await db.commit()
+        return {
+            "success": False,
+            "message": "登录状态已失效，请重新登录"
+        }
+    student = (await db.execute(select(StudentUser).where(
+        StudentUser.student_id == record.student_id,
+        StudentUser.is_whitelisted == True,
+        StudentUser.is_active == True
+    ))).scalars().first()
+    if not student:
+        await revoke_student_refresh_tokens(db, student_id=record.student_id)
+        await db.commit()
+        return {
+            "success": False,
+            "message": "账号不存在、未启用或不在白名单"
+        }
+    # 条件更新保证并发刷新时同一令牌只能轮换一次
+    rotated = await db.execute(
+        update(StudentRefreshToken)
+        .where(StudentRefreshToken.id == record.id, StudentRefreshToken.revoked_time.is_(None))
+        .values(revoked_time=datetime.now())
+    )
+    if rotated.rowcount != 1:
+        await db.rollback()
+        return {
+            "success": False,
+            "message": "登录状态已失效，请重新登录"
+        }
+    new_refresh_token = await issue_refresh_token(db, student.student_id, record.family_id)
+    await db.commit()
+    return {
+        "success": True,
+        "message": "刷新成功",
+        "token": create_student_access_token(student),
+        "refresh_token": new_refresh_token,
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        "student_id": student.student_id,
+        "name": student.name,
+        "must_change_password": bool(student.must_change_password)
+    }
+
 @app.post("/admin/login")
 async def admin_login(
     username: str = Body(...),
     password: str = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        user = db.query(AdminUser).filter(AdminUser.username == username).first()
+        user = (await db.execute(select(AdminUser).where(AdminUser.username == username))).scalars().first()
         if not user or not user.is_active:
             return {
                 "success": False,
                 "message": "用户不存在或已禁用"
             }
-        password_bytes = password.encode("utf-8")
-        hashed_password_bytes = user.password.encode("utf-8")
-        if not bcrypt.checkpw(password_bytes, hashed_password_bytes):
+        if not await verify_password(password, user.password):
             return {
                 "success": False,
                 "message": "密码错误"
             }
-        role = db.query(AdminRole).filter(AdminRole.id == user.role_id).first()
+        role = (await db.execute(select(AdminRole).where(AdminRole.id == user.role_id))).scalars().first()
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = jwt.encode(
             {
@@ -998,6 +3127,8 @@ async def admin_login(
             "token": access_token,
             "user": serialize_admin_user(user, role)
         }
+    except PasswordHashBusy:
+        raise
     except Exception as e:
         return {
             "success": False,
@@ -1005,8 +3136,8 @@ async def admin_login(
         }
 
 @app.get("/admin/permissions")
-async def get_permissions(db: Session = Depends(get_db)):
-    permissions = db.query(AdminPermission).order_by(AdminPermission.id.asc()).all()
+async def get_permissions(db: AsyncSession = Depends(get_async_db)):
+    permissions = (await db.execute(select(AdminPermission).order_by(AdminPermission.id.asc()))).scalars().all()
     return {
         "code": 200,
         "data": {
@@ -1016,7 +3147,7 @@ async def get_permissions(db: Session = Depends(get_db)):
     }
 
 @app.post("/admin/permissions")
-async def create_permission(data: dict = Body(...), db: Session = Depends(get_db)):
+async def create_permission(data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
     name = (data.get("name") or "").strip()
     key = (data.get("key") or "").strip()
     if not name or not key:
@@ -1024,7 +3155,7 @@ async def create_permission(data: dict = Body(...), db: Session = Depends(get_db
             "code": 400,
             "message": "权限名称和标识不能为空"
         }
-    exists = db.query(AdminPermission).filter(AdminPermission.key == key).first()
+    exists = (await db.execute(select(AdminPermission).where(AdminPermission.key == key))).scalars().first()
     if exists:
         return {
             "code": 400,
@@ -1037,8 +3168,8 @@ async def create_permission(data: dict = Body(...), db: Session = Depends(get_db
         create_time=datetime.now()
     )
     db.add(permission)
-    db.commit()
-    db.refresh(permission)
+    await db.commit()
+    await db.refresh(permission)
     return {
         "code": 200,
         "data": serialize_permission(permission),
@@ -1049,9 +3180,9 @@ async def create_permission(data: dict = Body(...), db: Session = Depends(get_db
 async def update_permission(
     permission_id: int,
     data: dict = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    permission = db.query(AdminPermission).filter(AdminPermission.id == permission_id).first()
+    permission = (await db.execute(select(AdminPermission).where(AdminPermission.id == permission_id))).scalars().first()
     if not permission:
         return {
             "code": 404,
@@ -1064,10 +3195,10 @@ async def update_permission(
             "code": 400,
             "message": "权限名称和标识不能为空"
         }
-    exists = db.query(AdminPermission).filter(
+    exists = (await db.execute(select(AdminPermission).where(
         AdminPermission.key == key,
         AdminPermission.id != permission_id
-    ).first()
+    ))).scalars().first()
     if exists:
         return {
             "code": 400,
@@ -1076,8 +3207,8 @@ async def update_permission(
     permission.name = name
     permission.key = key
     permission.description = data.get("description", "")
-    db.commit()
-    db.refresh(permission)
+    await db.commit()
+    await db.refresh(permission)
     return {
         "code": 200,
         "data": serialize_permission(permission),
@@ -1085,23 +3216,23 @@ async def update_permission(
     }
 
 @app.delete("/admin/permissions/{permission_id}")
-async def delete_permission(permission_id: int, db: Session = Depends(get_db)):
-    permission = db.query(AdminPermission).filter(AdminPermission.id == permission_id).first()
+async def delete_permission(permission_id: int, db: AsyncSession = Depends(get_async_db)):
+    permission = (await db.execute(select(AdminPermission).where(AdminPermission.id == permission_id))).scalars().first()
     if not permission:
         return {
             "code": 404,
             "message": "权限不存在"
         }
-    db.delete(permission)
-    db.commit()
+    await db.delete(permission)
+    await db.commit()
     return {
         "code": 200,
         "message": "删除成功"
     }
 
 @app.get("/admin/roles")
-async def get_roles(db: Session = Depends(get_db)):
-    roles = db.query(AdminRole).order_by(AdminRole.id.asc()).all()
+async def get_roles(db: AsyncSession = Depends(get_async_db)):
+    roles = (await db.execute(select(AdminRole).order_by(AdminRole.id.asc()))).scalars().all()
     return {
         "code": 200,
         "data": {
@@ -1111,14 +3242,14 @@ async def get_roles(db: Session = Depends(get_db)):
     }
 
 @app.post("/admin/roles")
-async def create_role(data: dict = Body(...), db: Session = Depends(get_db)):
+async def create_role(data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
     name = (data.get("name") or "").strip()
     if not name:
         return {
             "code": 400,
             "message": "角色名称不能为空"
         }
-    exists = db.query(AdminRole).filter(AdminRole.name == name).first()
+    exists = (await db.execute(select(AdminRole).where(AdminRole.name == name))).scalars().first()
     if exists:
         return {
             "code": 400,
@@ -1132,8 +3263,8 @@ async def create_role(data: dict = Body(...), db: Session = Depends(get_db)):
         create_time=datetime.now()
     )
     db.add(role)
-    db.commit()
-    db.refresh(role)
+    await db.commit()
+    await db.refresh(role)
     return {
         "code": 200,
         "data": serialize_role(role),
@@ -1141,8 +3272,8 @@ async def create_role(data: dict = Body(...), db: Session = Depends(get_db)):
     }
 
 @app.put("/admin/roles/{role_id}")
-async def update_role(role_id: int, data: dict = Body(...), db: Session = Depends(get_db)):
-    role = db.query(AdminRole).filter(AdminRole.id == role_id).first()
+async def update_role(role_id: int, data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
+    role = (await db.execute(select(AdminRole).where(AdminRole.id == role_id))).scalars().first()
     if not role:
         return {
             "code": 404,
@@ -1154,10 +3285,10 @@ async def update_role(role_id: int, data: dict = Body(...), db: Session = Depend
             "code": 400,
             "message": "角色名称不能为空"
         }
-    exists = db.query(AdminRole).filter(
+    exists = (await db.execute(select(AdminRole).where(
         AdminRole.name == name,
         AdminRole.id != role_id
-    ).first()
+    ))).scalars().first()
     if exists:
         return {
             "code": 400,
@@ -1167,8 +3298,8 @@ async def update_role(role_id: int, data: dict = Body(...), db: Session = Depend
     role.description = data.get("description", "")
     if "permissions" in data:
         role.permissions = json.dumps(data.get("permissions") or [], ensure_ascii=False)
-    db.commit()
-    db.refresh(role)
+    await db.commit()
+    await db.refresh(role)
     return {
         "code": 200,
         "data": serialize_role(role),
@@ -1176,24 +3307,24 @@ async def update_role(role_id: int, data: dict = Body(...), db: Session = Depend
     }
 
 @app.delete("/admin/roles/{role_id}")
-async def delete_role(role_id: int, db: Session = Depends(get_db)):
-    role = db.query(AdminRole).filter(AdminRole.id == role_id).first()
+async def delete_role(role_id: int, db: AsyncSession = Depends(get_async_db)):
+    role = (await db.execute(select(AdminRole).where(AdminRole.id == role_id))).scalars().first()
     if not role:
         return {
             "code": 404,
             "message": "角色不存在"
         }
-    db.delete(role)
-    db.commit()
+    await db.delete(role)
+    await db.commit()
     return {
         "code": 200,
         "message": "删除成功"
     }
 
 @app.get("/admin/users")
-async def get_admin_users(db: Session = Depends(get_db)):
-    users = db.query(AdminUser).order_by(AdminUser.id.asc()).all()
-    role_map = {role.id: role for role in db.query(AdminRole).all()}
+async def get_admin_users(db: AsyncSession = Depends(get_async_db)):
+    users = (await db.execute(select(AdminUser).order_by(AdminUser.id.asc()))).scalars().all()
+    role_map = {role.id: role for role in (await db.execute(select(AdminRole))).scalars().all()}
     return {
         "code": 200,
         "data": {
@@ -1203,7 +3334,7 @@ async def get_admin_users(db: Session = Depends(get_db)):
     }
 
 @app.post("/admin/users")
-async def create_admin_user(data: dict = Body(...), db: Session = Depends(get_db)):
+async def create_admin_user(data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
     username = (data.get("username") or "").strip()
     name = (data.get("name") or "").strip()
     password = (data.get("password") or "").strip()
@@ -1213,20 +3344,19 @@ async def create_admin_user(data: dict = Body(...), db: Session = Depends(get_db
             "code": 400,
             "message": "用户名、姓名、密码不能为空"
         }
-    exists = db.query(AdminUser).filter(AdminUser.username == username).first()
+    exists = (await db.execute(select(AdminUser).where(AdminUser.username == username))).scalars().first()
     if exists:
         return {
             "code": 400,
             "message": "用户名已存在"
         }
-    role = db.query(AdminRole).filter(AdminRole.id == role_id).first() if role_id else None
+    role = (await db.execute(select(AdminRole).where(AdminRole.id == role_id))).scalars().first() if role_id else None
     if role_id and not role:
         return {
             "code": 400,
             "message": "角色不存在"
         }
-    password_bytes = password.encode("utf-8")
-    hashed_password = bcrypt.hashpw(password_bytes, bcrypt.gensalt()).decode("utf-8")
+    hashed_password = await hash_password(password)
     user = AdminUser(
         username=username,
         name=name,
@@ -1237,8 +3367,8 @@ async def create_admin_user(data: dict = Body(...), db: Session = Depends(get_db
         create_time=datetime.now()
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     return {
         "code": 200,
         "data": serialize_admin_user(user, role),
@@ -1249,9 +3379,9 @@ async def create_admin_user(data: dict = Body(...), db: Session = Depends(get_db
 async def update_admin_user(
     user_id: int,
     data: dict = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = db.query(AdminUser).filter(AdminUser.id == user_id).first()
+    user = (await db.execute(select(AdminUser).where(AdminUser.id == user_id))).scalars().first()
     if not user:
         return {
             "code": 404,
@@ -1264,17 +3394,17 @@ async def update_admin_user(
             "code": 400,
             "message": "用户名和姓名不能为空"
         }
-    exists = db.query(AdminUser).filter(
+    exists = (await db.execute(select(AdminUser).where(
         AdminUser.username == username,
         AdminUser.id != user_id
-    ).first()
+    ))).scalars().first()
     if exists:
         return {
             "code": 400,
             "message": "用户名已存在"
         }
     role_id = data.get("role_id")
-    role = db.query(AdminRole).filter(AdminRole.id == role_id).first() if role_id else None
+    role = (await db.execute(select(AdminRole).where(AdminRole.id == role_id))).scalars().first() if role_id else None
     if role_id and not role:
         return {
             "code": 400,
@@ -1288,10 +3418,9 @@ async def update_admin_user(
         user.is_active = bool(data.get("is_active"))
     new_password = (data.get("password") or "").strip()
     if new_password:
-        password_bytes = new_password.encode("utf-8")
-        user.password = bcrypt.hashpw(password_bytes, bcrypt.gensalt()).decode("utf-8")
-    db.commit()
-    db.refresh(user)
+        user.password = await hash_password(new_password)
+    await db.commit()
+    await db.refresh(user)
     return {
         "code": 200,
         "data": serialize_admin_user(user, role),
@@ -1299,15 +3428,15 @@ async def update_admin_user(
     }
 
 @app.delete("/admin/users/{user_id}")
-async def delete_admin_user(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(AdminUser).filter(AdminUser.id == user_id).first()
+async def delete_admin_user(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(select(AdminUser).where(AdminUser.id == user_id))).scalars().first()
     if not user:
         return {
             "code": 404,
             "message": "用户不存在"
         }
-    db.delete(user)
-    db.commit()
+    await db.delete(user)
+    await db.commit()
     return {
         "code": 200,
         "message": "删除成功"
@@ -1320,30 +3449,41 @@ async def get_whitelist_students(
     student_id: Optional[str] = None,
     name: Optional[str] = None,
     is_active: Optional[bool] = None,
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    with_total: bool = True,
+    db: AsyncSession = Depends(get_async_db)
 ):
-    query = db.query(StudentUser).filter(StudentUser.is_whitelisted == True)
+    cursor_value = decode_page_cursor(cursor) if cursor else None
+    if cursor and not cursor_value:
+        return {"code": 400, "data": None, "message": "分页游标无效"}
+    query = select(StudentUser).where(StudentUser.is_whitelisted == True)
     if student_id and student_id.strip():
-        query = query.filter(StudentUser.student_id.like(f"%{student_id.strip()}%"))
+        query = query.where(StudentUser.student_id.like(f"%{student_id.strip()}%"))
     if name and name.strip():
-        query = query.filter(StudentUser.name.like(f"%{name.strip()}%"))
+        query = query.where(StudentUser.name.like(f"%{name.strip()}%"))
     if is_active is not None:
-        query = query.filter(StudentUser.is_active == is_active)
-    total = query.count()
-    items = query.order_by(StudentUser.create_time.desc()).offset((page - 1) * size).limit(size).all()
+        query = query.where(StudentUser.is_active == is_active)
+    total = None
+    if with_total:
+        total = await count_with_cache(db, f"whitelist:{student_id}:{name}:{is_active}", query)
+    items = (await db.execute(
+        apply_page_window(query, StudentUser.create_time, StudentUser.id, page, size, cursor_value)
+    )).scalars().all()
+    next_cursor = encode_page_cursor(items[-1].create_time, items[-1].id) if len(items) == size else None
     return {
         "code": 200,
         "data": {
             "list": [serialize_whitelist_student(item) for item in items],
             "total": total,
             "page": page,
-            "size": size
+            "size": size,
+            "next_cursor": next_cursor
         },
         "message": "查询成功"
     }
 
 @app.post("/admin/whitelist")
-async def create_whitelist_student(data: dict = Body(...), db: Session = Depends(get_db)):
+async def create_whitelist_student(data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
     student_id = (data.get("student_id") or "").strip()
     name = (data.get("name") or "").strip()
     default_password = (data.get("default_password") or "123456").strip()
@@ -1353,15 +3493,18 @@ async def create_whitelist_student(data: dict = Body(...), db: Session = Depends
             "code": 400,
             "message": "学号、姓名、默认密码不能为空"
         }
-    student, _ = upsert_whitelist_student(
+    student, _ = await upsert_whitelist_student(
         db=db,
         student_id=student_id,
         name=name,
         default_password=default_password,
         is_active=is_active
     )
-    db.commit()
-    db.refresh(student)
+    await bump_auth_epoch(db)
+    await db.commit()
+    invalidate_list_count_cache("whitelist")
+    invalidate_student_principal(student_id)
+    await db.refresh(student)
     return {
         "code": 200,
         "data": serialize_whitelist_student(student),
@@ -1369,71 +3512,58 @@ async def create_whitelist_student(data: dict = Body(...), db: Session = Depends
     }
 
 @app.post("/admin/whitelist/import")
-async def import_whitelist_students(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def import_whitelist_students(
+    file: UploadFile = File(...),
+    dry_run: bool = False,
+    db: AsyncSession = Depends(get_async_db)
+):
     file_name = file.filename or ""
     if not file_name.lower().endswith(".xlsx"):
         return {
             "code": 400,
             "message": "仅支持 .xlsx 文件"
         }
+    # 文件先落盘，解析、哈希和写库都在后台任务中分批完成，进度见 /admin/jobs/{job_id}
+    os.makedirs(WHITELIST_IMPORT_DIR, exist_ok=True)
+    file_path = os.path.join(WHITELIST_IMPORT_DIR, f"{uuid.uuid4().hex}.xlsx")
     try:
-        file_content = await file.read()
-        workbook = load_workbook(filename=BytesIO(file_content), data_only=True)
-        worksheet = workbook.active
-        created_count = 0
-        updated_count = 0
-        skipped_count = 0
-        errors = []
-        for row_index, row in enumerate(worksheet.iter_rows(min_row=2, values_only=True), start=2):
-            raw_student_id = row[0] if len(row) > 0 else None
-            raw_name = row[1] if len(row) > 1 else None
-            raw_default_password = row[2] if len(row) > 2 else None
-            raw_is_active = row[3] if len(row) > 3 else None
-            student_id = str(raw_student_id or "").strip()
-            name = str(raw_name or "").strip()
-            default_password = str(raw_default_password or "123456").strip()
-            if not student_id and not name:
-                skipped_count += 1
-                continue
-            if not student_id or not name:
-                errors.append({"row": row_index, "message": "学号或姓名为空"})
-                continue
-            is_active = parse_active_value(raw_is_active)
-            _, created = upsert_whitelist_student(
-                db=db,
-                student_id=student_id,
-                name=name,
-                default_password=default_password or "123456",
-                is_active=is_active
-            )
-            if created:
-                created_count += 1
-            else:
-                updated_count += 1
-        db.commit()
+        with open(file_path, "wb") as buffer:
+            while True:
+                chunk = await file.read(1024 * 1024)
+                if not chunk:
+                    break
+                buffer.write(chunk)
+        if dry_run:
+            preview = await preview_whitelist_import(db, file_path)
+            os.remove(file_path)
+            return {
+                "code": 200,
+                "data": preview,
+                "message": "试运行完成，未写入数据"
+            }
+        job = await enqueue_job(db, "whitelist_import", {"file_path": file_path, "file_name": file_name})
+        await db.commit()
+        wake_job_worker()
         return {
             "code": 200,
-            "data": {
-                "created": created_count,
-                "updated": updated_count,
-                "skipped": skipped_count,
-                "errors": errors
-            },
-            "message": "批量导入完成"
+            "data": {"job_id": job.id},
+            "message": "导入任务已提交"
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
+        if os.path.exists(file_path):
+            os.remove(file_path)
         return {
             "code": 500,
             "message": f"批量导入失败：{str(e)}"
         }
 
 @app.put("/admin/whitelist/{student_id}")
-async def update_whitelist_student(student_id: str, data: dict = Body(...), db: Session = Depends(get_db)):
-    student = db.query(StudentUser).filter(
+async def update_whitelist_student(student_id: str, data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
+    student = (await db.execute(select(StudentUser).where(
         StudentUser.student_id == student_id,
         StudentUser.is_whitelisted == True
-    ).first()
+    ))).scalars().first()
     if not student:
         return {
             "code": 404,
@@ -1443,15 +3573,19 @@ async def update_whitelist_student(student_id: str, data: dict = Body(...), db:
         student.name = str(data.get("name")).strip()
     if "is_active" in data:
         student.is_active = bool(data.get("is_active"))
+        if not student.is_active:
+            await revoke_student_refresh_tokens(db, student_id=student.student_id)
     if "default_password" in data and str(data.get("default_password") or "").strip():
         default_password = str(data.get("default_password")).strip()
-        password_bytes = default_password.encode("utf-8")
         student.default_password = default_password
-        student.password = bcrypt.hashpw(password_bytes, bcrypt.gensalt()).decode("utf-8")
+        student.password = await hash_password(default_password)
         student.must_change_password = True
     student.update_time = datetime.now()
-    db.commit()
-    db.refresh(student)
+    await bump_auth_epoch(db)
+    await db.commit()
+    invalidate_list_count_cache("whitelist")
+    invalidate_student_principal(student.student_id)
+    await db.refresh(student)
     return {
         "code": 200,
         "data": serialize_whitelist_student(student),
@@ -1459,24 +3593,25 @@ async def update_whitelist_student(student_id: str, data: dict = Body(...), db:
     }
 
 @app.put("/admin/whitelist/{student_id}/reset-password")
-async def reset_whitelist_student_password(student_id: str, data: dict = Body({}), db: Session = Depends(get_db)):
-    student = db.query(StudentUser).filter(
+async def reset_whitelist_student_password(student_id: str, data: dict = Body({}), db: AsyncSession = Depends(get_async_db)):
+    student = (await db.execute(select(StudentUser).where(
         StudentUser.student_id == student_id,
         StudentUser.is_whitelisted == True
-    ).first()
+    ))).scalars().first()
     if not student:
         return {
             "code": 404,
             "message": "白名单学生不存在"
         }
     new_default_password = str(data.get("default_password") or student.default_password or "123456").strip()
-    password_bytes = new_default_password.encode("utf-8")
     student.default_password = new_default_password
-    student.password = bcrypt.hashpw(password_bytes, bcrypt.gensalt()).decode("utf-8")
+    student.password = await hash_password(new_default_password)
     student.must_change_password = True
     student.update_time = datetime.now()
-    db.commit()
-    db.refresh(student)
+    await bump_auth_epoch(db)
+    await db.commit()
+    invalidate_student_principal(student.student_id)
+    await db.refresh(student)
     return {
         "code": 200,
         "data": serialize_whitelist_student(student),
@@ -1484,11 +3619,11 @@ async def reset_whitelist_student_password(student_id: str, data: dict = Body({}
     }
 
 @app.delete("/admin/whitelist/{student_id}")
-async def remove_whitelist_student(student_id: str, db: Session = Depends(get_db)):
-    student = db.query(StudentUser).filter(
+async def remove_whitelist_student(student_id: str, db: AsyncSession = Depends(get_async_db)):
+    student = (await db.execute(select(StudentUser).where(
         StudentUser.student_id == student_id,
         StudentUser.is_whitelisted == True
-    ).first()
+    ))).scalars().first()
     if not student:
         return {
             "code": 404,
@@ -1497,18 +3632,68 @@ async def remove_whitelist_student(student_id: str, db: Session = Depends(get_db
     student.is_whitelisted = False
     student.must_change_password = False
     student.update_time = datetime.now()
-    db.commit()
-    db.refresh(student)
+    await revoke_student_refresh_tokens(db, student_id=student.student_id)
+    await bump_auth_epoch(db)
+    await db.commit()
+    invalidate_list_count_cache("whitelist")
+    invalidate_student_principal(student.student_id)
+    await db.refresh(student)
     return {
         "code": 200,
         "data": serialize_whitelist_student(student),
         "message": "移出白名单成功"
     }
 
+# ========== 登录学生缓存（token -> 学生） ==========
+PRINCIPAL_CACHE_SIZE = 2048
+PRINCIPAL_CACHE_TTL_SECONDS = 60
+# 每个进程最多每隔该秒数查一次全局 epoch，其他进程的变更在此时长内生效
+AUTH_EPOCH_CHECK_SECONDS = 2
+PRINCIPAL_CACHE = OrderedDict()
+AUTH_EPOCH_STATE = {"epoch": None, "checked_at": 0.0}
+
+async def bump_auth_epoch(db: AsyncSession):
+    # 与学生信息变更同事务递增，其他进程据此清空缓存
+    result = await db.execute(update(AuthEpoch).where(AuthEpoch.id == 1).values(epoch=AuthEpoch.epoch + 1))
+    if result.rowcount == 0:
+        db.add(AuthEpoch(id=1, epoch=1))
+        await db.flush()
+
+def invalidate_student_principal(student_id: str):
+    for token in [key for key, (student, _) in PRINCIPAL_CACHE.items() if student.student_id == student_id]:
+        PRINCIPAL_CACHE.pop(token, None)
+
+async def sync_auth_epoch(db: AsyncSession):
+    now = time.monotonic()
+    if now - AUTH_EPOCH_STATE["checked_at"] < AUTH_EPOCH_CHECK_SECONDS:
+        return
+    epoch = await db.scalar(select(AuthEpoch.epoch).where(AuthEpoch.id == 1))
+    if epoch != AUTH_EPOCH_STATE["epoch"]:
+        PRINCIPAL_CACHE.clear()
+        AUTH_EPOCH_STATE["epoch"] = epoch
+    AUTH_EPOCH_STATE["checked_at"] = now
+
+def get_cached_principal(token: str) -> Optional[StudentUser]:
+    cached = PRINCIPAL_CACHE.get(token)
+    if not cached:
+        return None
+    student, expire_at = cached
+    if expire_at < time.monotonic():
+        PRINCIPAL_CACHE.pop(token, None)
+        return None
+    PRINCIPAL_CACHE.move_to_end(token)
+    return student
+
+def cache_principal(token: str, student: StudentUser):
+    PRINCIPAL_CACHE[token] = (student, time.monotonic() + PRINCIPAL_CACHE_TTL_SECONDS)
+    PRINCIPAL_CACHE.move_to_end(token)
+    while len(PRINCIPAL_CACHE) > PRINCIPAL_CACHE_SIZE:
+        PRINCIPAL_CACHE.popitem(last=False)
+
 # 验证token并获取当前学生
 async def get_current_student(
     token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     credentials_exception = HTTPException(
         status_code=401,
@@ -1524,15 +3709,21 @@ async def get_current_student(
     except jwt.PyJWTError:
         raise credentials_exception
     
+    # 命中缓存直接返回（只读快照，需要写学生信息的接口自行重新加载）
+    await sync_auth_epoch(db)
+    student = get_cached_principal(token)
+    if student is not None:
+        return student
     # 从数据库查询学生信息
-    student = db.query(StudentUser).filter(
+    student = (await db.execute(select(StudentUser).where(
         StudentUser.student_id == student_id,
         StudentUser.is_active == True,
         StudentUser.is_whitelisted == True
-    ).first()
+    ))).scalars().first()
     
     if student is None:
         raise credentials_exception
+    cache_principal(token, student)
     return student
 
 # 获取学生信息接口（首页调用）
@@ -1555,27 +3746,30 @@ async def student_change_password(
     old_password: str = Body(...),
     new_password: str = Body(...),
     current_student: StudentUser = Depends(get_current_student),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        old_password_bytes = old_password.encode("utf-8")
-        hashed_password_bytes = current_student.password.encode("utf-8")
-        if not bcrypt.checkpw(old_password_bytes, hashed_password_bytes):
+        # 当前学生可能来自缓存，改密码前按主键重新加载最新数据
+        student = await db.get(StudentUser, current_student.id, populate_existing=True)
+        if not await verify_password(old_password, student.password):
             return {
                 "success": False,
                 "message": "旧密码错误"
             }
-        new_password_bytes = new_password.encode("utf-8")
-        current_student.password = bcrypt.hashpw(new_password_bytes, bcrypt.gensalt()).decode("utf-8")
-        current_student.must_change_password = False
-        current_student.update_time = datetime.now()
-        db.commit()
+        student.password = await hash_password(new_password)
+        student.must_change_password = False
+        student.update_time = datetime.now()
+        await bump_auth_epoch(db)
+        await db.commit()
+        invalidate_student_principal(student.student_id)
         return {
             "success": True,
             "message": "密码修改成功"
         }
+    except PasswordHashBusy:
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         return {
             "success": False,
             "message": f"修改失败：{str(e)}"
@@ -1585,25 +3779,94 @@ async def student_change_password(
 def save_uploaded_file(file: UploadFile):
     original_name = file.filename or "file"
     ext = os.path.splitext(original_name)[1]
-    file_name = f"{uuid.uuid4()}{ext}"
-    file_path = os.path.join(UPLOAD_DIR, file_name)
     content_type = file.content_type or mimetypes.guess_type(original_name)[0] or ""
-    return file_name, file_path, original_name, content_type
+    return ext, original_name, content_type
+
+@app.post("/upload/negotiate")
+async def negotiate_upload(
+    sha256: str = Body(...),
+    file_size: int = Body(...),
+    file_name: str = Body("file"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # 先传哈希：服务器已有相同内容（哈希和大小都一致）时直接返回存储路径，客户端无需再上传文件
+    digest = sha256.strip().lower()
+    if not re.fullmatch(r"[0-9a-f]{64}", digest):
+        return {"success": False, "message": "sha256格式错误"}
+    file_ext = os.path.splitext(file_name)[1].replace(".", "").lower()
+    if file_ext not in ALLOWED_EXTENSIONS:
+        return {"success": False, "message": f"不支持的文件类型：{file_ext or '无后缀'}"}
+    blob = await db.scalar(select(UploadBlob).where(UploadBlob.sha256 == digest))
+    if not blob or blob.file_size != file_size or not await asyncio.to_thread(resolve_upload_path, blob.file_path):
+        return {"success": True, "exists": False, "message": "服务器没有该文件，请上传"}
+    # 客户端会丢弃本地内容直接引用该文件，刷新最近使用时间，避免提交前被回收
+    if not await touch_upload_blob(db, blob.id):
+        await db.rollback()
+        return {"success": True, "exists": False, "message": "服务器没有该文件，请上传"}
+    await db.commit()
+    return build_upload_result(blob, file_name, mimetypes.guess_type(file_name)[0] or blob.mime_type or "", True)
+
+def build_upload_idempotency_scope(request: Request) -> str:
+    # 幂等键按调用方隔离：带有效登录 token 时按学号，否则按客户端地址，避免不同客户端的相同键互相命中
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        try:
+            student_id = jwt.decode(authorization[7:].strip(), SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+            if student_id:
+                return f"upload:student:{student_id}"
+        except jwt.PyJWTError:
+            pass
+    return f"upload:client:{request.client.host if request.client else ''}"
 
 @app.post("/upload/document")
-async def upload_document(file: UploadFile = File(...)):
+async def upload_document(
+    request: Request,
+    file: UploadFile = File(...),
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    idempotency_scope = build_upload_idempotency_scope(request)
+    digest = None
     try:
-        file_name, file_path, original_name, content_type = save_uploaded_file(file)
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
+        cached_response = await load_idempotent_response(db, idempotency_scope, idempotency_key)
+        ext, original_name, content_type = save_uploaded_file(file)
+        file_ext = ext.replace(".", "").lower()
+        if file_ext not in ALLOWED_EXTENSIONS:
+            return {
+                "success": False,
+                "message": f"不支持的文件类型：{file_ext or '无后缀'}"
+            }
+        try:
+            temp_path, file_size, digest = await stream_upload_to_temp(file)
+        except UploadRejected as e:
+            return {
+                "success": False,
+                "message": str(e)
+            }
+        if cached_response is not None:
+            # 重试只需核对内容哈希：同一个键对应不同文件时拒绝，而不是返回别的文件的路径
+            await asyncio.to_thread(os.remove, temp_path)
+            if cached_response.get("sha256") not in [None, digest]:
+                return {
+                    "success": False,
+                    "message": "幂等键已用于其他文件，请更换后重试"
+                }
+            return cached_response
+        blob, exists = await store_upload_blob(db, temp_path, file_size, digest, ext, content_type)
+        result = build_upload_result(blob, original_name, content_type, exists)
+        if idempotency_key:
+            await remember_idempotent_response(db, idempotency_scope, idempotency_key, result)
+        await db.commit()
+        return result
+    except IntegrityError:
+        # 并发重试抢先写入了同一幂等键：返回首次结果（内容文件按哈希共享，无需删除）
+        await db.rollback()
+        cached_response = await load_idempotent_response(db, idempotency_scope, idempotency_key)
+        if cached_response is not None and cached_response.get("sha256") in [None, digest]:
+            return cached_response
         return {
-            "success": True,
-            "file_name": original_name,
-            "stored_name": file_name,
-            "file_path": file_name,
-            "file_ext": os.path.splitext(original_name)[1].replace(".", "").lower(),
-            "mime_type": content_type,
-            "message": "文件上传成功"
+            "success": False,
+            "message": "文件上传失败：重复请求处理中，请稍后重试"
         }
     except Exception as e:
         print(f"文件上传失败：{str(e)}")
@@ -1613,8 +3876,13 @@ async def upload_document(file: UploadFile = File(...)):
         }
 
 @app.post("/upload/image")
-async def upload_image(file: UploadFile = File(...)):
-    return await upload_document(file)
+async def upload_image(
+    request: Request,
+    file: UploadFile = File(...),
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await upload_document(request, file, idempotency_key, db)
 
 @app.post("/submit/achievements")
 async def submit_achievements(
@@ -1625,10 +3893,15 @@ async def submit_achievements(
     volunteerList: List[dict] = Body([]),
     awardList: List[dict] = Body([]),
     customList: List[dict] = Body([]),
-    db: Session = Depends(get_db)
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
 ):
+    idempotency_scope = f"submit:{student_id}"
     try:
-        student = db.query(StudentUser).filter(StudentUser.student_id == student_id).first()
+        cached_response = await load_idempotent_response(db, idempotency_scope, idempotency_key)
+        if cached_response is not None:
+            return cached_response
+        student = (await db.execute(select(StudentUser).where(StudentUser.student_id == student_id))).scalars().first()
         if not student:
             return {
                 "success": False,
@@ -1639,13 +3912,17 @@ async def submit_achievements(
             student_id=student_id,
             create_time=datetime.now(),
             audit_status=False,
-            review_completed=False
+            review_completed=False,
+            version=1,
+            lifecycle_status="已提交"
         )
         db.add(achievement)
-        db.commit()
-        db.refresh(achievement)
+        # 整个提交在一个事务内完成：flush 只取回自增ID，最后统一提交一次
+        await db.flush()
         achievement_id = achievement.id
 
+        # 待写入的成果项：(类型, 模型对象, 附件列表)
+        pending_items = []
         for paper in paperList:
             if paper.get("title"):
                 new_paper = Paper(
@@ -1655,11 +3932,8 @@ async def submit_achievements(
                     publish_date=paper.get("date"),
                     review_status="pending"
                 )
-                db.add(new_paper)
-                db.commit()
-                db.refresh(new_paper)
                 all_docs = list(paper.get("documents", []) or []) + list(paper.get("images", []) or [])
-                append_documents_for_item(db, achievement_id, "paper", new_paper.id, all_docs)
+                pending_items.append(("paper", new_paper, all_docs))
 
         for policy in policyList:
             if policy.get("title"):
@@ -1670,11 +3944,8 @@ async def submit_achievements(
                     submit_date=policy.get("date"),
                     review_status="pending"
                 )
-                db.add(new_policy)
-                db.commit()
-                db.refresh(new_policy)
                 all_docs = list(policy.get("documents", []) or []) + list(policy.get("images", []) or [])
-                append_documents_for_item(db, achievement_id, "policy", new_policy.id, all_docs)
+                pending_items.append(("policy", new_policy, all_docs))
 
         participate_types = ['参会', '报告发言', '墙报展示', '其他']
         for academic in academicList:
@@ -1686,11 +3957,8 @@ async def submit_achievements(
                     exchange_date=academic.get("date"),
                     review_status="pending"
                 )
-                db.add(new_academic)
-                db.commit()
-                db.refresh(new_academic)
                 all_docs = list(academic.get("documents", []) or []) + list(academic.get("images", []) or [])
-                append_documents_for_item(db, achievement_id, "academic", new_academic.id, all_docs)
+                pending_items.append(("academic", new_academic, all_docs))
 
         for volunteer in volunteerList:
             if volunteer.get("project_name"):
@@ -1701,11 +3969,8 @@ async def submit_achievements(
                     service_date=volunteer.get("date"),
                     review_status="pending"
                 )
-                db.add(new_volunteer)
-                db.commit()
-                db.refresh(new_volunteer)
                 all_docs = list(volunteer.get("documents", []) or []) + list(volunteer.get("images", []) or [])
-                append_documents_for_item(db, achievement_id, "volunteer", new_volunteer.id, all_docs)
+                pending_items.append(("volunteer", new_volunteer, all_docs))
 
         award_levels = ['校级', '市级', '省级', '国家级', '国际级']
         for award in awardList:
@@ -1717,19 +3982,30 @@ async def submit_achievements(
                     award_date=award.get("date"),
                     review_status="pending"
                 )
-                db.add(new_award)
-                db.commit()
-                db.refresh(new_award)
                 all_docs = list(award.get("documents", []) or []) + list(award.get("images", []) or [])
-                append_documents_for_item(db, achievement_id, "award", new_award.id, all_docs)
+                pending_items.append(("award", new_award, all_docs))
 
+        # 一次查询取回本次提交涉及的全部启用类型
+        requested_type_ids = set()
+        for custom_item in customList:
+            try:
+                requested_type_ids.add(int(custom_item.get("type_id")))
+            except Exception:
+                continue
+        active_type_ids = set()
+        if requested_type_ids:
+            active_type_ids = set((await db.execute(
+                select(AchievementType.id).where(
+                    AchievementType.id.in_(requested_type_ids),
+                    AchievementType.is_active == True
+                )
+            )).scalars().all())
         for custom_item in customList:
             try:
                 type_id = int(custom_item.get("type_id"))
             except Exception:
                 continue
-            type_model = db.query(AchievementType).filter(AchievementType.id == type_id, AchievementType.is_active == True).first()
-            if not type_model:
+            if type_id not in active_type_ids:
                 continue
             content_obj = custom_item.get("content", {})
             if not isinstance(content_obj, dict):
@@ -1741,21 +4017,56 @@ async def submit_achievements(
                 content_json=json.dumps(content_obj, ensure_ascii=False),
                 review_status="pending"
             )
-            db.add(new_custom)
-            db.commit()
-            db.refresh(new_custom)
             all_docs = list(custom_item.get("documents", []) or [])
-            append_documents_for_item(db, achievement_id, "custom", new_custom.id, all_docs)
+            pending_items.append(("custom", new_custom, all_docs))
 
-        db.commit()
-        return {
+        # 批量插入全部成果项，再用 flush 分配的ID批量挂接附件
+        db.add_all([item for _, item, _ in pending_items])
+        achievement.audit_status = calculate_items_review_completed([item for _, item, _ in pending_items])
+        if achievement.audit_status:
+            achievement.audit_time = datetime.now()
+        await db.flush()
+        attached_documents = []
+        for item_type, item, all_docs in pending_items:
+            attached_documents.extend(append_documents_for_item(db, achievement_id, item_type, item.id, all_docs))
+        await add_blob_references(db, [document.file_path for document in attached_documents])
+        db.add_all([
+            AchievementScoreAggregate(achievement_id=achievement_id, item_type=item_type, type_id=type_id, **counters)
+            for (item_type, type_id), counters in build_item_aggregates({
+                item_type: [item for pending_type, item, _ in pending_items if pending_type == item_type]
+                for item_type in REVIEW_MODEL_MAP
+            }).items()
+        ])
+
+        result = {
             "success": True,
             "message": "成果提交成功，等待审核",
             "achievement_id": achievement_id,
             "student_id": student_id
         }
+        await remember_idempotent_response(db, idempotency_scope, idempotency_key, result)
+        # 自定义成果的规则预评分放到后台，与本次提交同事务入队
+        has_custom_items = any(item_type == "custom" for item_type, _, _ in pending_items)
+        if has_custom_items:
+            await enqueue_job(db, "custom_prescore", {"achievement_id": achievement_id})
+        await db.commit()
+        if has_custom_items:
+            wake_job_worker()
+        invalidate_list_count_cache("achievements")
+        invalidate_score_matrix_cache()
+        return result
+    except IntegrityError:
+        # 并发重试已用同一幂等键提交成功：本次整体回滚，返回首次结果
+        await db.rollback()
+        cached_response = await load_idempotent_response(db, idempotency_scope, idempotency_key)
+        if cached_response is not None:
+            return cached_response
+        return {
+            "success": False,
+            "message": "提交失败：重复请求处理中，请稍后重试"
+        }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"提交成果失败：{str(e)}")
         return {
             "success": False,
@@ -1771,23 +4082,39 @@ async def get_achievements(
     size: int = 10,
     audit_status: Optional[bool] = None,
     student_id: Optional[str] = None,
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    with_total: bool = True,
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
+        cursor_value = decode_page_cursor(cursor) if cursor else None
+        if cursor and not cursor_value:
+            return {"code": 400, "data": None, "message": "分页游标无效"}
         # 构建查询条件
-        query = db.query(StudentAchievement)
+        query = select(StudentAchievement)
         
         # 审核状态筛选
         if audit_status is not None:
-            query = query.filter(StudentAchievement.audit_status == audit_status)
+            query = query.where(StudentAchievement.audit_status == audit_status)
         
         # 学号筛选
         if student_id and student_id.strip():
-            query = query.filter(StudentAchievement.student_id == student_id.strip())
+            query = query.where(StudentAchievement.student_id == student_id.strip())
         
-        # 分页处理
-        total = query.count()
-        achievements = query.order_by(StudentAchievement.create_time.desc()).offset((page-1)*size).limit(size).all()
+        # 分页处理：传入 cursor 时按 (create_time, id) 游标翻页，总数可关闭或取缓存
+        total = None
+        if with_total:
+            total = await count_with_cache(db, f"achievements:{audit_status}:{student_id}", query)
+        achievements = (await db.execute(
+            apply_page_window(query, StudentAchievement.create_time, StudentAchievement.id, page, size, cursor_value)
+        )).scalars().all()
+        next_cursor = (
+            encode_page_cursor(achievements[-1].create_time, achievements[-1].id)
+            if len(achievements) == size else None
+        )
+        # 本页公式版本过期的成果就地重算，单次开销以页大小为上限
+        if await refresh_stale_achievement_scores(db, achievements):
+            await db.commit()
         
         # 组装返回数据
         result = []
@@ -1810,7 +4137,8 @@ async def get_achievements(
                 "list": result,
                 "total": total,
                 "page": page,
-                "size": size
+                "size": size,
+                "next_cursor": next_cursor
             },
             "message": "查询成功"
         }
@@ -1828,129 +4156,151 @@ async def get_achievements(
         }
 
 # 7. 管理端：获取成果详情
+async def build_achievement_detail(db: AsyncSession, achievement: StudentAchievement) -> dict:
+    achievement_id = achievement.id
+    papers = (await db.execute(select(Paper).where(Paper.achievement_id == achievement_id))).scalars().all()
+    policies = (await db.execute(select(PolicyReport).where(PolicyReport.achievement_id == achievement_id))).scalars().all()
+    academics = (await db.execute(select(AcademicExchange).where(AcademicExchange.achievement_id == achievement_id))).scalars().all()
+    volunteers = (await db.execute(select(VolunteerService).where(VolunteerService.achievement_id == achievement_id))).scalars().all()
+    awards = (await db.execute(select(Award).where(Award.achievement_id == achievement_id))).scalars().all()
+    customs = (await db.execute(select(CustomAchievement).where(CustomAchievement.achievement_id == achievement_id))).scalars().all()
+    documents_map = await get_documents_for_achievement(db, achievement_id)
+    custom_type_ids = {item.type_id for item in customs}
+    type_map = {}
+    if custom_type_ids:
+        type_map = {
+            type_info.id: type_info
+            for type_info in (await db.execute(
+                select(AchievementType).where(AchievementType.id.in_(custom_type_ids))
+            )).scalars().all()
+        }
+
+    def format_items(items, item_type):
+        result = []
+        for item in items:
+            item_data = {
+                "id": item.id,
+                "documents": documents_map.get((item_type, item.id), []),
+                "self_score": item.self_score if hasattr(item, "self_score") else None,
+                "review_score": item.review_score,
+                "rescore_score": item.rescore_score,
+                "review_status": item.review_status or "pending",
+                "review_comment": item.review_comment or "",
+                "student_agree": item.student_agree,
+                "student_feedback_comment": item.student_feedback_comment or "",
+                "rescore_comment": item.rescore_comment or ""
+            }
+            if item_type == "paper":
+                item_data.update({
+                    "title": item.title,
+                    "journal": item.journal,
+                    "publish_date": item.publish_date
+                })
+            elif item_type == "policy":
+                item_data.update({
+                    "title": item.title,
+                    "adopt_unit": item.adopt_unit,
+                    "submit_date": item.submit_date
+                })
+            elif item_type == "academic":
+                item_data.update({
+                    "name": item.name,
+                    "participate_type": item.participate_type,
+                    "exchange_date": item.exchange_date
+                })
+            elif item_type == "volunteer":
+                item_data.update({
+                    "project_name": item.project_name,
+                    "hours": item.hours,
+                    "service_date": item.service_date
+                })
+            elif item_type == "award":
+                item_data.update({
+                    "name": item.name,
+                    "level": item.level,
+                    "award_date": item.award_date
+                })
+            elif item_type == "custom":
+                type_info = type_map.get(item.type_id)
+                item_data.update({
+                    "type_id": item.type_id,
+                    "type_name": type_info.name if type_info else f"类型{item.type_id}",
+                    "content": json.loads(item.content_json or "{}"),
+                    "suggested_score": item.suggested_score
+                })
+            result.append(item_data)
+        return result
+    paper_data = format_items(papers, "paper")
+    policy_data = format_items(policies, "policy")
+    academic_data = format_items(academics, "academic")
+    volunteer_data = format_items(volunteers, "volunteer")
+    award_data = format_items(awards, "award")
+    custom_data = format_items(customs, "custom")
+    type_summaries = []
+    paper_summary = build_type_summary("论文成果", "paper", papers)
+    policy_summary = build_type_summary("资政报告", "policy", policies)
+    academic_summary = build_type_summary("学术交流", "academic", academics)
+    volunteer_summary = build_type_summary("志愿服务", "volunteer", volunteers)
+    award_summary = build_type_summary("获奖荣誉", "award", awards)
+    custom_summary = build_type_summary("自定义成果", "custom", customs)
+    for summary in [paper_summary, policy_summary, academic_summary, volunteer_summary, award_summary, custom_summary]:
+        if summary:
+            docs = []
+            source = {
+                "paper": paper_data,
+                "policy": policy_data,
+                "academic": academic_data,
+                "volunteer": volunteer_data,
+                "award": award_data,
+                "custom": custom_data
+            }.get(summary["type"], [])
+            for item in source:
+                docs.extend(item.get("documents", []))
+            summary["documents"] = docs
+            type_summaries.append(summary)
+    detail_data = {
+        "id": achievement.id,
+        "student_id": achievement.student_id,
+        "create_time": achievement.create_time.strftime("%Y-%m-%d %H:%M:%S") if achievement.create_time else "",
+        "audit_status": achievement.audit_status,
+        "audit_note": achievement.audit_note or "",
+        "audit_time": achievement.audit_time.strftime("%Y-%m-%d %H:%M:%S") if achievement.audit_time else "",
+        "overall_score": achievement.overall_score,
+        "review_completed": bool(achievement.review_completed),
+        "papers": paper_data,
+        "policies": policy_data,
+        "academics": academic_data,
+        "volunteers": volunteer_data,
+        "awards": award_data,
+        "customs": custom_data,
+        "type_summaries": type_summaries
+    }
+    return detail_data
+
 @app.get("/admin/achievements/{achievement_id}")
 async def get_achievement_detail(
     achievement_id: int,
-    db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        achievement = db.query(StudentAchievement).filter(StudentAchievement.id == achievement_id).first()
+        achievement = (await db.execute(select(StudentAchievement).where(StudentAchievement.id == achievement_id))).scalars().first()
         if not achievement:
             return {
                 "code": 404,
                 "data": None,
                 "message": "成果记录不存在"
             }
-        papers = db.query(Paper).filter(Paper.achievement_id == achievement_id).all()
-        policies = db.query(PolicyReport).filter(PolicyReport.achievement_id == achievement_id).all()
-        academics = db.query(AcademicExchange).filter(AcademicExchange.achievement_id == achievement_id).all()
-        volunteers = db.query(VolunteerService).filter(VolunteerService.achievement_id == achievement_id).all()
-        awards = db.query(Award).filter(Award.achievement_id == achievement_id).all()
-        customs = db.query(CustomAchievement).filter(CustomAchievement.achievement_id == achievement_id).all()
-
-        def format_items(items, item_type):
-            result = []
-            for item in items:
-                item_data = {
-                    "id": item.id,
-                    "documents": get_documents_for_item(db, item_type, item.id),
-                    "self_score": item.self_score if hasattr(item, "self_score") else None,
-                    "review_score": item.review_score,
-                    "rescore_score": item.rescore_score,
-                    "review_status": item.review_status or "pending",
-                    "review_comment": item.review_comment or "",
-                    "student_agree": item.student_agree,
-                    "student_feedback_comment": item.student_feedback_comment or "",
-                    "rescore_comment": item.rescore_comment or ""
-                }
-                if item_type == "paper":
-                    item_data.update({
-                        "title": item.title,
-                        "journal": item.journal,
-                        "publish_date": item.publish_date
-                    })
-                elif item_type == "policy":
-                    item_data.update({
-                        "title": item.title,
-                        "adopt_unit": item.adopt_unit,
-                        "submit_date": item.submit_date
-                    })
-                elif item_type == "academic":
-                    item_data.update({
-                        "name": item.name,
-                        "participate_type": item.participate_type,
-                        "exchange_date": item.exchange_date
-                    })
-                elif item_type == "volunteer":
-                    item_data.update({
-                        "project_name": item.project_name,
-                        "hours": item.hours,
-                        "service_date": item.service_date
-                    })
-                elif item_type == "award":
-                    item_data.update({
-                        "name": item.name,
-                        "level": item.level,
-                        "award_date": item.award_date
-                    })
-                elif item_type == "custom":
-                    type_info = db.query(AchievementType).filter(AchievementType.id == item.type_id).first()
-                    item_data.update({
-                        "type_id": item.type_id,
-                        "type_name": type_info.name if type_info else f"类型{item.type_id}",
-                        "content": json.loads(item.content_json or "{}")
-                    })
-                result.append(item_data)
-            return result
-        paper_data = format_items(papers, "paper")
-        policy_data = format_items(policies, "policy")
-        academic_data = format_items(academics, "academic")
-        volunteer_data = format_items(volunteers, "volunteer")
-        award_data = format_items(awards, "award")
-        custom_data = format_items(customs, "custom")
-        type_summaries = []
-        paper_summary = build_type_summary("论文成果", "paper", papers)
-        policy_summary = build_type_summary("资政报告", "policy", policies)
-        academic_summary = build_type_summary("学术交流", "academic", academics)
-        volunteer_summary = build_type_summary("志愿服务", "volunteer", volunteers)
-        award_summary = build_type_summary("获奖荣誉", "award", awards)
-        custom_summary = build_type_summary("自定义成果", "custom", customs)
-        for summary in [paper_summary, policy_summary, academic_summary, volunteer_summary, award_summary, custom_summary]:
-            if summary:
-                docs = []
-                source = {
-                    "paper": paper_data,
-                    "policy": policy_data,
-                    "academic": academic_data,
-                    "volunteer": volunteer_data,
-                    "award": award_data,
-                    "custom": custom_data
-                }.get(summary["type"], [])
-                for item in source:
-                    docs.extend(item.get("documents", []))
-                summary["documents"] = docs
-                type_summaries.append(summary)
-        detail_data = {
-            "id": achievement.id,
-            "student_id": achievement.student_id,
-            "create_time": achievement.create_time.strftime("%Y-%m-%d %H:%M:%S") if achievement.create_time else "",
-            "audit_status": achievement.audit_status,
-            "audit_note": achievement.audit_note or "",
-            "audit_time": achievement.audit_time.strftime("%Y-%m-%d %H:%M:%S") if achievement.audit_time else "",
-            "overall_score": achievement.overall_score,
-            "review_completed": bool(achievement.review_completed),
-            "papers": paper_data,
-            "policies": policy_data,
-            "academics": academic_data,
-            "volunteers": volunteer_data,
-            "awards": award_data,
-            "customs": custom_data,
-            "type_summaries": type_summaries
-        }
-        achievement.audit_status = calculate_review_completed(detail_data)
-        if achievement.audit_status and not achievement.audit_time:
-            achievement.audit_time = datetime.now()
-        db.commit()
+        if await refresh_stale_achievement_scores(db, [achievement]):
+            await db.commit()
+        # 详情只读：版本号未变即返回 304，不再在查询时回写审核状态
+        etag = build_achievement_etag(achievement, await load_achievement_type_stamp(db, achievement.id))
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+        detail_data = await build_achievement_detail(db, achievement)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, no-cache"
         return {
             "code": 200,
             "data": detail_data,
@@ -1969,14 +4319,14 @@ async def review_single_item(
     item_type: str,
     item_id: int,
     data: dict = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     item_type = (item_type or "").lower()
     model_info = REVIEW_MODEL_MAP.get(item_type)
     if not model_info:
         return {"code": 400, "message": "不支持的成果类型", "data": None}
     model_cls = model_info[0]
-    item = db.query(model_cls).filter(model_cls.id == item_id).first()
+    item = (await db.execute(select(model_cls).where(model_cls.id == item_id))).scalars().first()
     if not item:
         return {"code": 404, "message": "成果项不存在", "data": None}
     score = data.get("score")
@@ -1988,19 +4338,20 @@ async def review_single_item(
         return {"code": 400, "message": "评分格式错误", "data": None}
     if numeric_score < 0 or numeric_score > 100:
         return {"code": 400, "message": "评分范围必须在0到100", "data": None}
+    before = [item_aggregate_contribution(item)]
     item.review_score = numeric_score
     item.rescore_score = None
     item.review_comment = str(data.get("review_comment") or "")
     item.rescore_comment = str(data.get("rescore_comment") or "")
     item.review_status = "reviewed"
     item.review_time = datetime.now()
-    achievement = db.query(StudentAchievement).filter(StudentAchievement.id == item.achievement_id).first()
+    await apply_item_aggregate_changes(db, item.achievement_id, item_type, [item], before)
+    achievement = (await db.execute(select(StudentAchievement).where(StudentAchievement.id == item.achievement_id))).scalars().first()
     if achievement:
-        recalculate_achievement_score(db, achievement)
-        achievement.audit_status = bool(achievement.review_completed)
-        if achievement.audit_status:
-            achievement.audit_time = datetime.now()
-    db.commit()
+        await refresh_achievement_review_state(db, achievement)
+    await db.commit()
+    invalidate_list_count_cache("achievements")
+    invalidate_score_matrix_cache()
     return {
         "code": 200,
         "message": "评分成功",
@@ -2019,10 +4370,10 @@ async def review_type_score(
     achievement_id: int,
     item_type: str,
     data: dict = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     item_type = (item_type or "").lower()
-    items = get_type_items(db, achievement_id, item_type)
+    items = await get_type_items(db, achievement_id, item_type)
     if not items:
         return {"code": 404, "data": None, "message": "该类型成果不存在"}
     score = data.get("score")
@@ -2057,6 +4408,7 @@ async def review_type_score(
             return {"code": 400, "data": None, "message": "请填写复核评分"}
     elif final_review_score is None:
         return {"code": 400, "data": None, "message": "请填写评分"}
+    before = [item_aggregate_contribution(item) for item in items]
     for item in items:
         if final_review_score is not None:
             item.review_score = final_review_score
@@ -2065,13 +4417,13 @@ async def review_type_score(
         item.rescore_comment = rescore_comment
         item.review_time = datetime.now()
         item.review_status = "rescored" if should_rescore else "reviewed"
-    achievement = db.query(StudentAchievement).filter(StudentAchievement.id == achievement_id).first()
+    await apply_item_aggregate_changes(db, achievement_id, item_type, items, before)
+    achievement = (await db.execute(select(StudentAchievement).where(StudentAchievement.id == achievement_id))).scalars().first()
     if achievement:
-        recalculate_achievement_score(db, achievement)
-        achievement.audit_status = bool(achievement.review_completed)
-        if achievement.audit_status:
-            achievement.audit_time = datetime.now()
-    db.commit()
+        await refresh_achievement_review_state(db, achievement)
+    await db.commit()
+    invalidate_list_count_cache("achievements")
+    invalidate_score_matrix_cache()
     return {
         "code": 200,
         "data": {
@@ -2086,42 +4438,145 @@ async def review_type_score(
     }
 
 @app.get("/admin/score-formula")
-async def get_score_formula(db: Session = Depends(get_db)):
-    formula = get_or_init_score_formula(db)
+async def get_score_formula(db: AsyncSession = Depends(get_async_db)):
+    formula = await get_or_init_score_formula(db)
     return {
         "code": 200,
         "data": {
             "id": formula.id,
             "weights": parse_weights(formula.weights_json),
+            "version": formula.version or 1,
             "update_time": formula.update_time.strftime("%Y-%m-%d %H:%M:%S") if formula.update_time else ""
         },
         "message": "查询成功"
     }
 
 @app.put("/admin/score-formula")
-async def update_score_formula(data: dict = Body(...), db: Session = Depends(get_db)):
+async def update_score_formula(data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
     weights = data.get("weights", {})
     if not isinstance(weights, dict):
         return {"code": 400, "data": None, "message": "权重格式错误"}
-    normalized = {}
-    for key in ["paper", "policy", "academic", "volunteer", "award", "custom"]:
-        try:
-            normalized[key] = float(weights.get(key, 0))
-        except Exception:
-            normalized[key] = 0.0
-    formula = get_or_init_score_formula(db)
-    formula.weights_json = json.dumps(normalized, ensure_ascii=False)
-    formula.update_time = datetime.now()
-    db.commit()
-    for item in db.query(StudentAchievement).all():
-        recalculate_achievement_score(db, item)
-        item.audit_status = bool(item.review_completed)
-    db.commit()
-    return {"code": 200, "data": {"weights": normalized}, "message": "更新成功"}
+    normalized = normalize_formula_weights(weights)
+    formula = await get_or_init_score_formula(db)
+    changed = save_score_formula_weights(formula, normalized)
+    # 保存只递增公式版本；过期分数在读取时惰性重算，sweep 为真时另起低优先级后台清扫
+    job = None
+    if changed and data.get("sweep", True):
+        job = await enqueue_job(db, "score_recompute", supersede=True)
+    await db.commit()
+    if job:
+        wake_job_worker()
+    return {
+        "code": 200,
+        "data": {"weights": normalized, "version": formula.version, "job_id": job.id if job else None},
+        "message": "更新成功"
+    }
+
+@app.post("/admin/score-formula/simulate")
+async def simulate_score_formula(data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
+    # 只读模拟：用候选权重评估成绩分布和排名变化，不写入任何数据
+    weights = data.get("weights", {})
+    if not isinstance(weights, dict):
+        return {"code": 400, "data": None, "message": "权重格式错误"}
+    try:
+        top_n = max(1, min(int(data.get("top_n", 20)), 200))
+    except Exception:
+        return {"code": 400, "data": None, "message": "top_n格式错误"}
+    candidate = normalize_formula_weights(weights)
+    formula = await get_or_init_score_formula(db)
+    current = normalize_formula_weights(parse_weights(formula.weights_json))
+    cached = await load_score_matrix(db)
+    started = time.perf_counter()
+    current_scores = evaluate_score_matrix(cached, current)
+    candidate_scores = evaluate_score_matrix(cached, candidate)
+    current_ranks = rank_scores(current_scores)
+    candidate_ranks = rank_scores(candidate_scores)
+    both_ranked = (current_ranks > 0) & (candidate_ranks > 0)
+    rank_changes = np.where(both_ranked, current_ranks - candidate_ranks, 0)
+
+    def build_entry(position: int) -> dict:
+        return {
+            "achievement_id": int(cached["achievement_ids"][position]),
+            "student_id": cached["student_ids"][position],
+            "score": None if np.isnan(candidate_scores[position]) else round(float(candidate_scores[position]), 4),
+            "current_score": None if np.isnan(current_scores[position]) else round(float(current_scores[position]), 4),
+            "rank": int(candidate_ranks[position]) or None,
+            "current_rank": int(current_ranks[position]) or None,
+            "rank_change": int(rank_changes[position]) if both_ranked[position] else None
+        }
+
+    ranked_positions = np.flatnonzero(candidate_ranks > 0)
+    top_positions = ranked_positions[np.argsort(candidate_ranks[ranked_positions])][:top_n]
+    mover_positions = np.flatnonzero(rank_changes != 0)
+    mover_positions = mover_positions[np.argsort(-np.abs(rank_changes[mover_positions]), kind="stable")][:top_n]
+    result = {
+        "weights": candidate,
+        "current_weights": current,
+        "distribution": summarize_score_distribution(candidate_scores),
+        "current_distribution": summarize_score_distribution(current_scores),
+        "rank_changes": {
+            "moved": int(np.count_nonzero(rank_changes)),
+            "max_up": int(rank_changes.max()) if len(rank_changes) else 0,
+            "max_down": int(-rank_changes.min()) if len(rank_changes) else 0,
+            "newly_ranked": int(np.count_nonzero((candidate_ranks > 0) & (current_ranks == 0))),
+            "dropped": int(np.count_nonzero((candidate_ranks == 0) & (current_ranks > 0))),
+            "top_movers": [build_entry(position) for position in mover_positions]
+        },
+        "top": [build_entry(position) for position in top_positions],
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 3)
+    }
+    return {"code": 200, "data": result, "message": "模拟成功"}
+
+@app.post("/admin/uploads/dedupe")
+async def start_upload_dedupe(db: AsyncSession = Depends(get_async_db)):
+    # 手动触发存量附件迁移（启动时也会自动检查）
+    job = await enqueue_job(db, "upload_dedupe", supersede=True)
+    await db.commit()
+    wake_job_worker()
+    return {"code": 200, "data": {"job_id": job.id}, "message": "迁移任务已创建"}
+
+@app.post("/admin/uploads/shard")
+async def start_upload_shard(db: AsyncSession = Depends(get_async_db)):
+    # 手动触发平铺文件向分片目录的迁移（启动时也会自动检查）
+    job = await enqueue_job(db, "upload_shard", supersede=True)
+    await db.commit()
+    wake_job_worker()
+    return {"code": 200, "data": {"job_id": job.id}, "message": "迁移任务已创建"}
+
+@app.post("/admin/uploads/gc")
+async def start_upload_gc(db: AsyncSession = Depends(get_async_db)):
+    # 手动触发引用数校正和无引用文件回收（启动时按间隔自动触发）
+    job = await enqueue_job(db, "upload_gc", supersede=True)
+    await db.commit()
+    wake_job_worker()
+    return {"code": 200, "data": {"job_id": job.id}, "message": "回收任务已创建"}
+
+@app.get("/admin/jobs/{job_id}")
+async def get_job(job_id: int, db: AsyncSession = Depends(get_async_db)):
+    job = await db.get(BackgroundJob, job_id)
+    if not job:
+        return {"code": 404, "data": None, "message": "任务不存在"}
+    return {"code": 200, "data": serialize_job(job), "message": "查询成功"}
+
+@app.delete("/admin/jobs/{job_id}")
+async def cancel_job(job_id: int, db: AsyncSession = Depends(get_async_db)):
+    job = await db.get(BackgroundJob, job_id)
+    if not job:
+        return {"code": 404, "data": None, "message": "任务不存在"}
+    if job.status in ["completed", "failed", "cancelled"]:
+        return {"code": 400, "data": serialize_job(job), "message": "任务已结束，无法取消"}
+    job.cancel_requested = True
+    # 未开始的任务直接取消；运行中的任务在下一批开始前退出
+    if job.status == "pending":
+        job.status = "cancelled"
+        job.finish_time = datetime.now()
+        discard_job_file(job.payload_json)
+    await db.commit()
+    return {"code": 200, "data": serialize_job(job), "message": "已请求取消"}
 
 @app.get("/admin/achievement-types")
-async def get_achievement_types(db: Session = Depends(get_db)):
-    items = db.query(AchievementType).order_by(AchievementType.id.asc()).all()
+async def get_achievement_types(db: AsyncSession = Depends(get_async_db)):
+    items = (await db.execute(select(AchievementType).order_by(AchievementType.id.asc()))).scalars().all()
     return {
         "code": 200,
         "data": {
@@ -2139,14 +4594,14 @@ async def get_achievement_types(db: Session = Depends(get_db)):
     }
 
 @app.post("/admin/achievement-types")
-async def create_achievement_type(data: dict = Body(...), db: Session = Depends(get_db)):
+async def create_achievement_type(data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
     name = str(data.get("name") or "").strip()
     fields = data.get("fields", [])
     if not name:
         return {"code": 400, "data": None, "message": "类型名称不能为空"}
     if not isinstance(fields, list):
         return {"code": 400, "data": None, "message": "字段配置格式错误"}
-    exists = db.query(AchievementType).filter(AchievementType.name == name).first()
+    exists = (await db.execute(select(AchievementType).where(AchievementType.name == name))).scalars().first()
     if exists:
         return {"code": 400, "data": None, "message": "类型名称已存在"}
     item = AchievementType(
@@ -2157,13 +4612,13 @@ async def create_achievement_type(data: dict = Body(...), db: Session = Depends(
         update_time=datetime.now()
     )
     db.add(item)
-    db.commit()
-    db.refresh(item)
+    await db.commit()
+    await db.refresh(item)
     return {"code": 200, "data": {"id": item.id}, "message": "新增成功"}
 
 @app.put("/admin/achievement-types/{type_id}")
-async def update_achievement_type(type_id: int, data: dict = Body(...), db: Session = Depends(get_db)):
-    item = db.query(AchievementType).filter(AchievementType.id == type_id).first()
+async def update_achievement_type(type_id: int, data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
+    item = (await db.execute(select(AchievementType).where(AchievementType.id == type_id))).scalars().first()
     if not item:
         return {"code": 404, "data": None, "message": "类型不存在"}
     if "name" in data and str(data.get("name") or "").strip():
@@ -2173,9 +4628,45 @@ async def update_achievement_type(type_id: int, data: dict = Body(...), db: Sess
     if "is_active" in data:
         item.is_active = bool(data.get("is_active"))
     item.update_time = datetime.now()
-    db.commit()
+    await db.commit()
     return {"code": 200, "data": {"id": item.id}, "message": "更新成功"}
 
+@app.get("/admin/achievement-types/{type_id}/rules")
+async def get_achievement_type_rules(type_id: int, db: AsyncSession = Depends(get_async_db)):
+    item = await db.get(AchievementType, type_id)
+    if not item:
+        return {"code": 404, "data": None, "message": "类型不存在"}
+    return {
+        "code": 200,
+        "data": {
+            "id": item.id,
+            "name": item.name,
+            "rules": json.loads(item.rules_json) if item.rules_json else None,
+            "rules_version": item.rules_version or 1
+        },
+        "message": "查询成功"
+    }
+
+@app.put("/admin/achievement-types/{type_id}/rules")
+async def update_achievement_type_rules(type_id: int, data: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
+    item = await db.get(AchievementType, type_id)
+    if not item:
+        return {"code": 404, "data": None, "message": "类型不存在"}
+    rules = data.get("rules")
+    if rules is not None:
+        try:
+            compile_scoring_rules(rules)
+        except ValueError as e:
+            return {"code": 400, "data": None, "message": str(e)}
+    item.rules_json = json.dumps(rules, ensure_ascii=False) if rules is not None else None
+    item.rules_version = (item.rules_version or 1) + 1
+    item.update_time = datetime.now()
+    # 规则变更后该类型的全部成果项在后台批量重新预评分
+    job = await enqueue_job(db, "custom_prescore", {"type_id": type_id})
+    await db.commit()
+    wake_job_worker()
+    return {"code": 200, "data": {"id": item.id, "rules_version": item.rules_version, "job_id": job.id}, "message": "更新成功"}
+
 @app.post("/student/achievements/{achievement_id}/feedback")
 async def submit_student_feedback(
     achievement_id: int,
@@ -2184,21 +4675,21 @@ async def submit_student_feedback(
     agree: bool = Body(...),
     comment: str = Body(""),
     current_student: StudentUser = Depends(get_current_student),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    achievement = db.query(StudentAchievement).filter(
+    achievement = (await db.execute(select(StudentAchievement).where(
         StudentAchievement.id == achievement_id,
         StudentAchievement.student_id == current_student.student_id
-    ).first()
+    ))).scalars().first()
     if not achievement:
         return {"code": 404, "data": None, "message": "成果记录不存在"}
     model_info = REVIEW_MODEL_MAP.get((item_type or "").lower())
     if not model_info:
         return {"code": 400, "data": None, "message": "成果类型错误"}
     model_cls = model_info[0]
-    target_items = db.query(model_cls).filter(
+    target_items = (await db.execute(select(model_cls).where(
         model_cls.achievement_id == achievement_id
-    ).all()
+    ))).scalars().all()
     if not target_items:
         return {"code": 404, "data": None, "message": "成果项不存在"}
     if any(item.student_agree is not None for item in target_items):
@@ -2212,6 +4703,7 @@ async def submit_student_feedback(
         return {"code": 404, "data": None, "message": "成果项不存在"}
     is_agree = bool(agree)
     feedback_comment = str(comment or "")
+    before = [item_aggregate_contribution(item) for item in target_items]
     for item in target_items:
         item.student_agree = is_agree
         item.student_feedback_comment = feedback_comment
@@ -2220,30 +4712,28 @@ async def submit_student_feedback(
             item.review_status = "agreed"
         elif (item.review_status or "") in ["reviewed", "agreed"]:
             item.review_status = "disagreed"
-    recalculate_achievement_score(db, achievement)
-    achievement.audit_status = bool(achievement.review_completed)
-    db.commit()
+    await apply_item_aggregate_changes(db, achievement_id, (item_type or "").lower(), target_items, before)
+    await refresh_achievement_review_state(db, achievement, touch_audit_time=False)
+    await db.commit()
+    invalidate_list_count_cache("achievements")
+    invalidate_score_matrix_cache()
     return {"code": 200, "data": {"item_id": item_id, "agree": is_agree}, "message": "反馈成功"}
 
 @app.get("/student/achievements")
 async def get_student_achievements(
     current_student: StudentUser = Depends(get_current_student),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    achievements = db.query(StudentAchievement).filter(
+    achievements = (await db.execute(select(StudentAchievement).where(
         StudentAchievement.student_id == current_student.student_id
-    ).order_by(StudentAchievement.create_time.desc()).all()
+    ).order_by(StudentAchievement.create_time.desc()))).scalars().all()
+    if await refresh_stale_achievement_scores(db, achievements):
+        await db.commit()
     response_list = []
     for achievement in achievements:
-        detail_res = await get_achievement_detail(achievement.id, db)
-        if detail_res.get("code") == 200:
-            response_list.append(detail_res.get("data"))
+        response_list.append(await build_achievement_detail(db, achievement))
     return {"code": 200, "data": {"list": response_list}, "message": "查询成功"}
 
-from dotenv import load_dotenv
-
-load_dotenv()
-
 import dashscope
 from dashscope import MultiModalConversation
 
@@ -2251,7 +4741,7 @@ from dashscope import MultiModalConversation
 async def ai_extract_fields(
     achievement_type: str = Body(...),
     document_paths: List[str] = Body(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # 1. 获取API Key
     api_key = os.getenv("BAILIAN_API_KEY", "").strip()
@@ -2329,8 +4819,8 @@ async def ai_extract_fields(
         file_ext = os.path.splitext(path)[1].lower()
         if file_ext in image_extensions:
             # 优先使用本地路径（file://），避免公网下载超时问题
-            local_path = os.path.join(UPLOAD_DIR, path)
-            if os.path.exists(local_path):
+            local_path = resolve_upload_path(path)
+            if local_path:
                 abs_path = os.path.abspath(local_path)
                 image_urls.append(f"file://{abs_path}")
             else:
@@ -2392,22 +4882,40 @@ async def ai_extract_fields(
 
 
 # 9. 静态文件访问（图片预览）
-@app.get("/uploads/{file_name}")
-async def get_uploaded_file(file_name: str):
-    file_path = os.path.join(UPLOAD_DIR, file_name)
-    if not os.path.exists(file_path):
+@app.api_route("/uploads/{file_name}", methods=["GET", "HEAD"])
+async def get_uploaded_file(
+    file_name: str,
+    request: Request,
+    w: Optional[int] = None,
+    fmt: str = "webp"
+):
+    file_path = await asyncio.to_thread(resolve_upload_path, file_name)
+    if not file_path:
         raise HTTPException(status_code=404, detail="文件不存在")
-    return FileResponse(file_path)
+    if w is None:
+        return await serve_static_file(request, file_path, accel=True)
+    # 缩略图：源文件名不可变，缩略图也不会变化，同样按不可变文件发送
+    if w <= 0 or fmt.lower() not in THUMBNAIL_FORMATS:
+        raise HTTPException(status_code=400, detail="缩略图参数错误")
+    if not is_thumbnail_source(file_name):
+        raise HTTPException(status_code=400, detail="该文件不支持缩略图")
+    try:
+        thumbnail_path, cache_key = await get_thumbnail(file_name, file_path, pick_thumbnail_width(w), fmt.lower())
+    except (OSError, Image.DecompressionBombError) as e:
+        # 无法解码的图片直接返回原文件
+        print(f"缩略图生成失败：{file_name} {str(e)}")
+        return await serve_static_file(request, file_path, accel=True)
+    return await serve_static_file(request, thumbnail_path, f'"{cache_key}"', media_type=THUMBNAIL_FORMATS[fmt.lower()][1])
 
 # ========== 启动时创建数据库表 ==========
 @app.on_event("startup")
 async def startup():
+    report_sqlite_pragmas()
     Base.metadata.create_all(bind=engine)
     ensure_student_user_schema()
     ensure_achievement_schema()
-    db = SessionLocal()
-    try:
-        if db.query(AdminPermission).count() == 0:
+    async with AsyncSessionLocal() as db:
+        if await db.scalar(select(func.count()).select_from(AdminPermission)) == 0:
             default_permissions = [
                 {"name": "用户管理", "key": "user:manage", "description": "管理系统用户"},
                 {"name": "角色管理", "key": "role:manage", "description": "管理系统角色"},
@@ -2423,9 +4931,9 @@ async def startup():
                 )
                 for item in default_permissions
             ])
-            db.commit()
-        if db.query(AdminRole).count() == 0:
-            permission_keys = [item.key for item in db.query(AdminPermission).all()]
+            await db.commit()
+        if await db.scalar(select(func.count()).select_from(AdminRole)) == 0:
+            permission_keys = [item.key for item in (await db.execute(select(AdminPermission))).scalars().all()]
             roles = [
                 AdminRole(
                     name="管理员",
@@ -2447,22 +4955,11 @@ async def startup():
                 )
             ]
             db.add_all(roles)
-            db.commit()
-        get_or_init_score_formula(db)
-        formula = get_or_init_score_formula(db)
-        formula.weights_json = json.dumps({
-            "paper": 0.0,
-            "policy": 0.0,
-            "academic": 0.0,
-            "volunteer": 0.0,
-            "award": 0.0,
-            "custom": 1.0
-        }, ensure_ascii=False)
-        formula.update_time = datetime.now()
-        db.commit()
-        admin_user = db.query(AdminUser).filter(AdminUser.username == "admin").first()
+            await db.commit()
+        await get_or_init_score_formula(db)
+        admin_user = (await db.execute(select(AdminUser).where(AdminUser.username == "admin"))).scalars().first()
         if not admin_user:
-            admin_role = db.query(AdminRole).filter(AdminRole.name == "管理员").first()
+            admin_role = (await db.execute(select(AdminRole).where(AdminRole.name == "管理员"))).scalars().first()
             password_bytes = "123456".encode("utf-8")
             hashed_password = bcrypt.hashpw(password_bytes, bcrypt.gensalt()).decode("utf-8")
             admin_user = AdminUser(
@@ -2475,8 +4972,8 @@ async def startup():
                 create_time=datetime.now()
             )
             db.add(admin_user)
-            db.commit()
-        whitelist_student = db.query(StudentUser).filter(StudentUser.student_id == "20260001").first()
+            await db.commit()
+        whitelist_student = (await db.execute(select(StudentUser).where(StudentUser.student_id == "20260001"))).scalars().first()
         if not whitelist_student:
             default_password = "123456"
             password_bytes = default_password.encode("utf-8")
@@ -2493,10 +4990,57 @@ async def startup():
                 must_change_password=True
             )
             db.add(whitelist_student)
-            db.commit()
-        sync_excel_achievement_types(db)
-    finally:
-        db.close()
+            await db.commit()
+        await sync_excel_achievement_types(db)
+        await purge_expired_idempotency_records(db)
+        await db.commit()
+        await backfill_achievement_lifecycle_status(db)
+        await backfill_score_aggregates(db)
+        # 存量附件未迁入内容寻址存储时，自动排一个后台迁移任务
+        legacy_documents = await db.scalar(
+            select(func.count()).select_from(AchievementDocument).where(legacy_document_condition())
+        )
+        dedupe_running = await db.scalar(
+            select(func.count()).select_from(BackgroundJob)
+            .where(BackgroundJob.job_type == "upload_dedupe", BackgroundJob.status.in_(["pending", "running"]))
+        )
+        if legacy_documents and not dedupe_running:
+            await enqueue_job(db, "upload_dedupe")
+            await db.commit()
+        # 上传目录里还有平铺文件时，排一个分片迁移任务
+        shard_running = await db.scalar(
+            select(func.count()).select_from(BackgroundJob)
+            .where(BackgroundJob.job_type == "upload_shard", BackgroundJob.status.in_(["pending", "running"]))
+        )
+        if not shard_running and await asyncio.to_thread(list_flat_uploads, 1):
+            await enqueue_job(db, "upload_shard")
+            await db.commit()
+        # 距上次回收超过间隔时，排一个引用校正与回收任务
+        recent_gc = await db.scalar(
+            select(func.count()).select_from(BackgroundJob).where(
+                BackgroundJob.job_type == "upload_gc",
+                or_(
+                    BackgroundJob.status.in_(["pending", "running"]),
+                    BackgroundJob.create_time > datetime.now() - timedelta(hours=UPLOAD_GC_INTERVAL_HOURS)
+                )
+            )
+        )
+        if not recent_gc:
+            await enqueue_job(db, "upload_gc")
+            await db.commit()
+    global JOB_WAKEUP, JOB_WORKER_TASK
+    JOB_WAKEUP = asyncio.Event()
+    JOB_WORKER_TASK = asyncio.create_task(job_worker_loop())
+
+@app.on_event("shutdown")
+async def shutdown():
+    if JOB_WORKER_TASK:
+        JOB_WORKER_TASK.cancel()
+        try:
+            await JOB_WORKER_TASK
+        except asyncio.CancelledError:
+            pass
+    await async_engine.dispose()
 
 # ========== 新增：管理端-获取提交成果的学生列表 ==========
 @app.get("/admin/students", response_model=dict)
@@ -2506,52 +5050,70 @@ async def get_student_list(
     student_id: str = None,
     name: str = None,
     audit_status: str = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        # 1. 查询所有提交过成果的学生（去重）
-        sub_query = db.query(StudentAchievement.student_id).distinct().subquery()
-        query = db.query(StudentUser)
-        query = query.filter(StudentUser.student_id.in_(sub_query))
-        
-        # 2. 添加筛选条件
+        # 1. 每位学生的成果按时间倒序编号：第1条即最新成果，同时开窗统计提交次数
+        ranked = select(
+            StudentAchievement.student_id.label("student_id"),
+            StudentAchievement.id.label("achievement_id"),
+            StudentAchievement.create_time.label("last_submit_time"),
+            StudentAchievement.overall_score.label("latest_overall_score"),
+            StudentAchievement.formula_version.label("formula_version"),
+            func.coalesce(StudentAchievement.lifecycle_status, "已提交").label("lifecycle_status"),
+            func.count().over(partition_by=StudentAchievement.student_id).label("submit_count"),
+            func.row_number().over(
+                partition_by=StudentAchievement.student_id,
+                order_by=(StudentAchievement.create_time.desc(), StudentAchievement.id.desc())
+            ).label("row_number")
+        ).subquery()
+        query = select(
+            StudentUser.student_id,
+            StudentUser.name,
+            ranked.c.submit_count,
+            ranked.c.last_submit_time,
+            ranked.c.latest_overall_score,
+            ranked.c.lifecycle_status,
+            ranked.c.achievement_id,
+            ranked.c.formula_version
+        ).join(ranked, ranked.c.student_id == StudentUser.student_id).where(ranked.c.row_number == 1)
+
+        # 2. 筛选条件（含流转状态）全部下推到数据库
         if student_id and student_id.strip():
-            query = query.filter(StudentUser.student_id.like(f"%{student_id.strip()}%"))
+            query = query.where(StudentUser.student_id.like(f"%{student_id.strip()}%"))
         if name and name.strip():
-            query = query.filter(StudentUser.name.like(f"%{name.strip()}%"))
-        
-        # 3. 查询候选学生（后续按状态筛选再分页）
-        students = query.all()
-        
-        # 4. 组装数据（补充成果数和审核状态）
-        result = []
-        for student in students:
-            # 统计该学生的成果数
-            achievement_count = db.query(StudentAchievement).filter(
-                StudentAchievement.student_id == student.student_id
-            ).count()
-            
-            # 最后提交时间
-            last_achievement = db.query(StudentAchievement).filter(
-                StudentAchievement.student_id == student.student_id
-            ).order_by(StudentAchievement.create_time.desc()).first()
-            last_submit_time = last_achievement.create_time.strftime("%Y-%m-%d %H:%M:%S") if last_achievement else ""
-            latest_overall_score = last_achievement.overall_score if last_achievement else None
-            
-            lifecycle_status = calculate_achievement_lifecycle_status(db, last_achievement) if last_achievement else "已提交"
-            
-            result.append({
-                "student_id": student.student_id,
-                "name": student.name,
-                "submit_count": achievement_count,
-                "last_submit_time": last_submit_time,
-                "audit_status": lifecycle_status,
-                "latest_overall_score": latest_overall_score
-            })
+            query = query.where(StudentUser.name.like(f"%{name.strip()}%"))
         if audit_status and str(audit_status).strip():
-            result = [item for item in result if item["audit_status"] == str(audit_status).strip()]
-        total = len(result)
-        page_result = result[(page - 1) * size: page * size]
+            query = query.where(ranked.c.lifecycle_status == str(audit_status).strip())
+
+        # 3. 数据库内计数、排序、分页
+        total = await db.scalar(select(func.count()).select_from(query.subquery()))
+        rows = (await db.execute(
+            query.order_by(ranked.c.last_submit_time.desc(), StudentUser.student_id.asc())
+            .offset((page - 1) * size).limit(size)
+        )).all()
+        # 本页最新成果中公式版本过期的就地重算
+        formula = await get_or_init_score_formula(db)
+        stale_ids = [row.achievement_id for row in rows if row.formula_version != (formula.version or 1)]
+        refreshed_scores = {}
+        if stale_ids:
+            stale_achievements = (await db.execute(
+                select(StudentAchievement).where(StudentAchievement.id.in_(stale_ids))
+            )).scalars().all()
+            await refresh_stale_achievement_scores(db, stale_achievements)
+            await db.commit()
+            refreshed_scores = {item.id: item.overall_score for item in stale_achievements}
+        page_result = [
+            {
+                "student_id": row.student_id,
+                "name": row.name,
+                "submit_count": row.submit_count,
+                "last_submit_time": row.last_submit_time.strftime("%Y-%m-%d %H:%M:%S") if row.last_submit_time else "",
+                "audit_status": row.lifecycle_status,
+                "latest_overall_score": refreshed_scores.get(row.achievement_id, row.latest_overall_score)
+            }
+            for row in rows
+        ]
 
         return {
             "code": 200,
@@ -2578,11 +5140,11 @@ async def get_student_list(
 @app.get("/admin/students/{student_id}", response_model=dict)
 async def get_student_info(
     student_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
         # 查询学生基础信息
-        student = db.query(StudentUser).filter(StudentUser.student_id == student_id).first()
+        student = (await db.execute(select(StudentUser).where(StudentUser.student_id == student_id))).scalars().first()
         if not student:
             return {
                 "code": 404,
@@ -2591,15 +5153,15 @@ async def get_student_info(
             }
         
         # 统计该学生的成果总数
-        total_achievements = db.query(StudentAchievement).filter(
+        total_achievements = await db.scalar(select(func.count()).select_from(StudentAchievement).where(
             StudentAchievement.student_id == student_id
-        ).count()
+        ))
         
         # 整体审核状态（是否全部审核）
-        all_audited = db.query(StudentAchievement).filter(
+        all_audited = await db.scalar(select(func.count()).select_from(StudentAchievement).where(
             StudentAchievement.student_id == student_id,
             StudentAchievement.audit_status == False
-        ).count() == 0
+        )) == 0
         
         return {
             "code": 200,
@@ -2608,9 +5170,9 @@ async def get_student_info(
                 "name": student.name,
                 "total_achievements": total_achievements,
                 "audit_status": all_audited,
-                "latest_overall_score": db.query(StudentAchievement).filter(
+                "latest_overall_score": (await db.execute(select(StudentAchievement).where(
                     StudentAchievement.student_id == student_id
-                ).order_by(StudentAchievement.create_time.desc()).first().overall_score if total_achievements > 0 else None
+                ).order_by(StudentAchievement.create_time.desc()))).scalars().first().overall_score if total_achievements > 0 else None
             },
             "message": "查询成功"
         }
@@ -2625,5 +5187,16 @@ async def get_student_info(
 
 # ========== 主函数（直接运行） ==========
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-score-aggregates":
+        # 聚合一致性检查：默认发现不一致即重建，带 --check 只报告不修改
+        Base.metadata.create_all(bind=engine)
+        ensure_achievement_schema()
+        check_only = "--check" in sys.argv[2:]
+        mismatched_ids = asyncio.run(check_score_aggregates(apply_fix=not check_only))
+        print(f"聚合不一致的成果数：{len(mismatched_ids)}" + ("（仅检查，未修改）" if check_only else "（已重建）"))
+        if mismatched_ids:
+            print(f"成果ID：{mismatched_ids[:50]}")
+        sys.exit(1 if mismatched_ids and check_only else 0)
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
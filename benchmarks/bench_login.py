@@ -0,0 +1,90 @@
+# 登录压测：对比"事件循环内直接 bcrypt"（旧实现）与"专用线程池 + 准入控制"（现实现）的吞吐和延迟
+# 同时测量事件循环卡顿（定时器实际唤醒延迟），观察登录高峰期其他请求是否被拖慢
+# 用法：python benchmarks/bench_login.py [并发登录数]
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import bcrypt
+import httpx
+from fastapi import Body, Depends
+from sqlalchemy import select
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+# 数据库和上传目录都是相对路径，切到临时目录避免污染仓库里的数据库
+os.chdir(tempfile.mkdtemp(prefix="bench_login_"))
+
+from app import main  # noqa: E402
+
+# 旧实现：在 async 接口里直接调用 bcrypt.checkpw
+@main.app.post("/bench/legacy-login")
+async def legacy_login(
+    student_id: str = Body(...),
+    password: str = Body(...),
+    db=Depends(main.get_async_db)
+):
+    student = (await db.execute(select(main.StudentUser).where(main.StudentUser.student_id == student_id))).scalars().first()
+    if not student or not bcrypt.checkpw(password.encode("utf-8"), student.password.encode("utf-8")):
+        return {"success": False}
+    return {"success": True}
+
+def percentile(values: list, ratio: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))
+    return ordered[index]
+
+async def timed_post(client: httpx.AsyncClient, path: str, payload: dict):
+    started = time.perf_counter()
+    response = await client.post(path, json=payload)
+    return response.status_code, (time.perf_counter() - started) * 1000
+
+async def probe_loop(stop: asyncio.Event, lags: list):
+    # 每 10ms 唤醒一次，实际唤醒时间超出的部分即事件循环被阻塞的时长
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append((time.perf_counter() - started - 0.01) * 1000)
+
+async def run(client: httpx.AsyncClient, path: str, concurrency: int) -> dict:
+    payload = {"student_id": "20260001", "password": "123456"}
+    stop = asyncio.Event()
+    loop_lags = []
+    probe = asyncio.create_task(probe_loop(stop, loop_lags))
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    results = await asyncio.gather(*[timed_post(client, path, payload) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    ok_latencies = [latency for status, latency in results if status == 200]
+    return {
+        "ok": len(ok_latencies),
+        "rejected": len([status for status, _ in results if status == 503]),
+        "throughput": len(ok_latencies) / elapsed,
+        "p50": percentile(ok_latencies, 0.5) if ok_latencies else 0.0,
+        "p99": percentile(ok_latencies, 0.99) if ok_latencies else 0.0,
+        "loop_lag_max": max(loop_lags) if loop_lags else 0.0
+    }
+
+async def main_async(concurrency: int):
+    await main.startup()
+    try:
+        async with httpx.AsyncClient(app=main.app, base_url="http://bench") as client:
+            legacy = await run(client, "/bench/legacy-login", concurrency)
+            current = await run(client, "/student/login", concurrency)
+    finally:
+        await main.shutdown()
+    print(f"并发登录 {concurrency}，哈希线程数 {main.PASSWORD_HASH_WORKERS}，排队上限 {main.PASSWORD_HASH_MAX_PENDING}")
+    print(f"{'实现':<12}{'成功':>6}{'503':>6}{'登录/秒':>10}{'p50(ms)':>12}{'p99(ms)':>12}{'循环最大卡顿(ms)':>14}")
+    for label, result in [("循环内哈希", legacy), ("线程池哈希", current)]:
+        print(
+            f"{label:<12}{result['ok']:>6}{result['rejected']:>6}{result['throughput']:>10.2f}"
+            f"{result['p50']:>12.1f}{result['p99']:>12.1f}{result['loop_lag_max']:>14.1f}"
+        )
+
+if __name__ == "__main__":
+    asyncio.run(main_async(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
@@ -0,0 +1,93 @@
+# 成果提交压测：对比"逐项提交"（旧实现）与"单事务批量写入"（现实现）的提交次数和延迟
+# 用法：python benchmarks/bench_submit.py [提交次数] [每次成果项数]
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fastapi import Body, Depends
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+# 数据库和上传目录都是相对路径，切到临时目录避免污染仓库里的数据库
+os.chdir(tempfile.mkdtemp(prefix="bench_submit_"))
+
+from app import main  # noqa: E402
+
+commit_counter = {"count": 0}
+
+def count_commit(conn):
+    commit_counter["count"] += 1
+
+event.listen(main.async_engine.sync_engine, "commit", count_commit)
+
+# 旧实现：主表和每个成果项各自提交并刷新一次
+@main.app.post("/bench/legacy-submit")
+async def legacy_submit(
+    student_id: str = Body(...),
+    paperList: list = Body([]),
+    awardList: list = Body([]),
+    db=Depends(main.get_async_db)
+):
+    achievement = main.StudentAchievement(student_id=student_id, audit_status=False, review_completed=False)
+    db.add(achievement)
+    await db.commit()
+    await db.refresh(achievement)
+    for paper in paperList:
+        new_paper = main.Paper(achievement_id=achievement.id, title=paper.get("title"), review_status="pending")
+        db.add(new_paper)
+        await db.commit()
+        await db.refresh(new_paper)
+        main.append_documents_for_item(db, achievement.id, "paper", new_paper.id, paper.get("documents", []))
+    for award in awardList:
+        new_award = main.Award(achievement_id=achievement.id, name=award.get("name"), level="校级", review_status="pending")
+        db.add(new_award)
+        await db.commit()
+        await db.refresh(new_award)
+        main.append_documents_for_item(db, achievement.id, "award", new_award.id, award.get("documents", []))
+    await db.commit()
+    return {"success": True, "achievement_id": achievement.id}
+
+def build_payload(item_count: int) -> dict:
+    half = item_count // 2
+    return {
+        "student_id": "20260001",
+        "paperList": [{"title": f"论文{i}", "documents": [f"paper_{i}.png"]} for i in range(half)],
+        "awardList": [{"name": f"奖项{i}", "documents": [f"award_{i}.png"]} for i in range(item_count - half)]
+    }
+
+def percentile(values: list, ratio: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))
+    return ordered[index]
+
+def run(client: TestClient, path: str, payload: dict, rounds: int) -> dict:
+    latencies = []
+    commit_counter["count"] = 0
+    for _ in range(rounds):
+        started = time.perf_counter()
+        response = client.post(path, json=payload)
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response.json().get("success"), response.text
+    return {
+        "commits": commit_counter["count"] / rounds,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99)
+    }
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    item_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    payload = build_payload(item_count)
+    with TestClient(main.app) as client:
+        for path in ["/bench/legacy-submit", "/submit/achievements"]:
+            run(client, path, payload, 5)
+        legacy = run(client, "/bench/legacy-submit", payload, rounds)
+        current = run(client, "/submit/achievements", payload, rounds)
+    print(f"提交次数 {rounds}，每次成果项 {item_count}，连接参数档位 {main.SQLITE_PRAGMA_PROFILE}")
+    print(f"{'实现':<12}{'提交/次':>10}{'p50(ms)':>12}{'p99(ms)':>12}")
+    for label, result in [("逐项提交", legacy), ("单事务批量", current)]:
+        print(f"{label:<12}{result['commits']:>10.1f}{result['p50']:>12.2f}{result['p99']:>12.2f}")